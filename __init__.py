@@ -4,15 +4,14 @@ Mia Config - Gestione configurazioni dinamiche basate su tempo e orario.
 import json
 import logging
 import os
-import shutil
 from datetime import datetime, timedelta
 from pathlib import Path
 from aiohttp import web
 from homeassistant.config_entries import ConfigEntry
-from homeassistant.core import HomeAssistant, ServiceCall, ServiceResponse, SupportsResponse
+from homeassistant.core import HomeAssistant, ServiceCall, ServiceResponse, SupportsResponse, callback
 from homeassistant.helpers.typing import ConfigType
 from homeassistant.helpers.event import async_track_time_interval
-from homeassistant.exceptions import ConfigEntryNotReady
+from homeassistant.exceptions import ConfigEntryNotReady, ServiceValidationError
 import voluptuous as vol
 from homeassistant.helpers import config_validation as cv
 from homeassistant.components.http import HomeAssistantView
@@ -26,6 +25,9 @@ from .const import (
     DEFAULT_HISTORY_RETENTION_DAYS,
     DEFAULT_MAX_HISTORY_PER_NAME,
     DEFAULT_MIN_HISTORY_PER_NAME,
+    DEFAULT_SQLITE_CACHE_SIZE_KB,
+    DEFAULT_SQLITE_MMAP_SIZE_MB,
+    DEFAULT_SQLITE_PROFILE,
 )
 from .database import ConfigDatabase
 
@@ -132,11 +134,19 @@ async def async_setup_entry(hass: HomeAssistant, entry: ConfigEntry) -> bool:
     retention_days = entry.options.get("retention_days", DEFAULT_HISTORY_RETENTION_DAYS)
     max_history_per_name = entry.options.get("max_history_per_name", DEFAULT_MAX_HISTORY_PER_NAME)
     min_history_per_name = entry.options.get("min_history_per_name", DEFAULT_MIN_HISTORY_PER_NAME)
+    sqlite_profile = entry.options.get("sqlite_profile", DEFAULT_SQLITE_PROFILE)
+    sqlite_cache_size_kb = entry.options.get("sqlite_cache_size_kb", DEFAULT_SQLITE_CACHE_SIZE_KB)
+    sqlite_mmap_size_mb = entry.options.get("sqlite_mmap_size_mb", DEFAULT_SQLITE_MMAP_SIZE_MB)
     db_path = hass.config.path(f"{db_name}.db")
     
     # Inizializza il database con gestione errori
     try:
-        db = ConfigDatabase(db_path)
+        db = ConfigDatabase(
+            db_path,
+            sqlite_profile=sqlite_profile,
+            cache_size_kb=sqlite_cache_size_kb,
+            mmap_size_mb=sqlite_mmap_size_mb,
+        )
         await hass.async_add_executor_job(db.initialize)
         
         # Verifica che il database sia accessibile
@@ -207,27 +217,53 @@ async def async_setup_entry(hass: HomeAssistant, entry: ConfigEntry) -> bool:
         """Esegue il cleanup automatico dello storico e delle configurazioni scadute una volta al giorno."""
         _LOGGER.info("Avvio cleanup automatico giornaliero")
         
-        # Cleanup storico
-        all_names = await hass.async_add_executor_job(db.get_all_setup_names)
-        for name in all_names:
-            await hass.async_add_executor_job(
-                db._cleanup_history, name, 
-                retention_days, 
-                max_history_per_name, 
-                min_history_per_name
+        # Storico, configurazioni a tempo scadute e valori validi orfani in un solo job e una sola transazione
+        try:
+            stats = await hass.async_add_executor_job(
+                db.run_maintenance, retention_days, max_history_per_name, min_history_per_name, cleanup_days
             )
-        _LOGGER.info(f"Cleanup storico completato per {len(all_names)} configurazioni")
-        
-        # Cleanup configurazioni a tempo scadute
-        if cleanup_days > 0:
-            await hass.async_add_executor_job(db.cleanup_expired_events, cleanup_days)
-            _LOGGER.info(f"Cleanup configurazioni a tempo scadute oltre {cleanup_days} giorni completato")
+        except Exception as err:
+            _LOGGER.warning("Errore durante il cleanup giornaliero: %s", err)
+            return
+        _LOGGER.info(f"Cleanup giornaliero completato in {stats['duration_ms']} ms: {stats}")
     
     # Pianifica cleanup ogni 24 ore
     entry.async_on_unload(
         async_track_time_interval(hass, daily_cleanup, timedelta(days=1))
     )
     
+    # Retention dello storico ammortizzata: le scritture non la applicano più,
+    # viene eseguita in background quando gli inserimenti superano la soglia
+    history_trim = {"running": False}
+    
+    async def trim_history_in_background() -> None:
+        """Applica la retention dello storico a tutti i setup_name in un solo job."""
+        try:
+            deleted = await hass.async_add_executor_job(
+                db.trim_history, retention_days, max_history_per_name, min_history_per_name
+            )
+            _LOGGER.debug(f"Retention storico in background: {deleted} voci eliminate")
+        except Exception as err:
+            _LOGGER.warning("Errore durante la retention dello storico: %s", err)
+        finally:
+            history_trim["running"] = False
+    
+    @callback
+    def start_history_trim() -> None:
+        if history_trim["running"] or not db.history_trim_due:
+            return
+        history_trim["running"] = True
+        entry.async_create_background_task(
+            hass, trim_history_in_background(), f"{DOMAIN}_history_trim_{entry.entry_id}"
+        )
+    
+    def check_history_trim(event: dict) -> None:
+        """Listener delle modifiche (thread della scrittura): avvia la retention oltre la soglia."""
+        if db.history_trim_due:
+            hass.loop.call_soon_threadsafe(start_history_trim)
+    
+    entry.async_on_unload(db.subscribe(check_history_trim))
+    
     # Registra listener per aggiornamenti opzioni
     entry.async_on_unload(entry.add_update_listener(async_update_options))
     
@@ -265,10 +301,14 @@ async def async_remove_entry(hass: HomeAssistant, entry: ConfigEntry) -> None:
     
     _LOGGER.info(f"Removing Mia Config instance '{db_name}', deleting database file: {db_path}")
     
+    # Normalmente già chiuso da async_unload_entry: la chiusura fa il checkpoint del WAL
+    entry_data = hass.data.get(DOMAIN, {}).pop(entry.entry_id, None)
+    if entry_data and "db" in entry_data:
+        await hass.async_add_executor_job(entry_data["db"].close)
+    
     try:
-        # Verifica se il file esiste e cancellalo
-        if await hass.async_add_executor_job(os.path.exists, db_path):
-            await hass.async_add_executor_job(os.remove, db_path)
+        removed = await hass.async_add_executor_job(_delete_database_files, db_path)
+        if db_path in removed:
             _LOGGER.info(f"Successfully deleted database file: {db_path}")
         else:
             _LOGGER.warning(f"Database file not found: {db_path}")
@@ -276,6 +316,18 @@ async def async_remove_entry(hass: HomeAssistant, entry: ConfigEntry) -> None:
         _LOGGER.error(f"Error deleting database file {db_path}: {err}")
 
 
+def _delete_database_files(db_path: str) -> list:
+    """Cancella il database e i file -wal/-shm: un WAL rimasto verrebbe riapplicato a un nuovo DB con lo stesso nome."""
+    removed = []
+    for path in (db_path, f"{db_path}-wal", f"{db_path}-shm"):
+        try:
+            os.remove(path)
+            removed.append(path)
+        except FileNotFoundError:
+            pass
+    return removed
+
+
 def get_db_from_entity_id(hass: HomeAssistant, entity_id: str = None) -> ConfigDatabase:
     """Ottiene il database corretto dall'entity_id, o il database di default."""
     if entity_id:
@@ -291,6 +343,14 @@ def get_db_from_entity_id(hass: HomeAssistant, entity_id: str = None) -> ConfigD
     return hass.data[DOMAIN]["db"]
 
 
+def get_entry_data_for_db(hass: HomeAssistant, db: ConfigDatabase) -> dict:
+    """Ottiene i dati dell'istanza che possiede il database (dict vuoto se non trovata)."""
+    for entry_data in hass.data.get(DOMAIN, {}).values():
+        if isinstance(entry_data, dict) and entry_data.get("db") is db:
+            return entry_data
+    return {}
+
+
 async def async_setup_services(hass: HomeAssistant) -> None:
     """Registra i servizi del componente."""
     
@@ -308,14 +368,6 @@ async def async_setup_services(hass: HomeAssistant) -> None:
             db.set_config, setup_name, setup_value, priority, description
         )
         
-        # Forza aggiornamento e invalida cache
-        for entry_id, data in hass.data.get(DOMAIN, {}).items():
-            if isinstance(data, dict):
-                if 'clear_cache' in data:
-                    data['clear_cache']()
-                if 'coordinator' in data:
-                    await data['coordinator'].async_request_refresh()
-        
         _LOGGER.info(f"Configurazione '{setup_name}' impostata a '{setup_value}'")
     
     async def handle_set_time_config(call: ServiceCall) -> None:
@@ -337,14 +389,6 @@ async def async_setup_services(hass: HomeAssistant) -> None:
             valid_from_ora, valid_to_ora, days_of_week
         )
         
-        # Forza aggiornamento e invalida cache
-        for entry_id, data in hass.data.get(DOMAIN, {}).items():
-            if isinstance(data, dict):
-                if 'clear_cache' in data:
-                    data['clear_cache']()
-                if 'coordinator' in data:
-                    await data['coordinator'].async_request_refresh()
-        
         _LOGGER.info(f"Configurazione a tempo '{setup_name}' impostata")
     
     async def handle_set_schedule_config(call: ServiceCall) -> None:
@@ -367,14 +411,6 @@ async def async_setup_services(hass: HomeAssistant) -> None:
             db.set_schedule_config, setup_name, setup_value, valid_from_ora, valid_to_ora, days_of_week, priority
         )
         
-        # Forza aggiornamento e invalida cache
-        for entry_id, data in hass.data.get(DOMAIN, {}).items():
-            if isinstance(data, dict):
-                if 'clear_cache' in data:
-                    data['clear_cache']()
-                if 'coordinator' in data:
-                    await data['coordinator'].async_request_refresh()
-        
         _LOGGER.info(f"Configurazione a orario '{setup_name}' impostata")
     
     async def handle_set_conditional_config(call: ServiceCall) -> None:
@@ -398,14 +434,6 @@ async def async_setup_services(hass: HomeAssistant) -> None:
                 valid_from_ora, valid_to_ora
             )
             
-            # Forza aggiornamento e invalida cache
-            for entry_id, data in hass.data.get(DOMAIN, {}).items():
-                if isinstance(data, dict):
-                    if 'clear_cache' in data:
-                        data['clear_cache']()
-                    if 'coordinator' in data:
-                        await data['coordinator'].async_request_refresh()
-            
             _LOGGER.info(f"Configurazione condizionale '{setup_name}' impostata")
         except ValueError as err:
             _LOGGER.error(f"Errore nella configurazione condizionale: {err}")
@@ -425,14 +453,6 @@ async def async_setup_services(hass: HomeAssistant) -> None:
             db.update_standard_config, config_id, setup_value, priority, description
         )
         
-        # Forza aggiornamento e invalida cache
-        for entry_id, data in hass.data.get(DOMAIN, {}).items():
-            if isinstance(data, dict):
-                if 'clear_cache' in data:
-                    data['clear_cache']()
-                if 'coordinator' in data:
-                    await data['coordinator'].async_request_refresh()
-        
         _LOGGER.info(f"Configurazione ID {config_id} aggiornata")
     
     async def handle_delete_config(call: ServiceCall) -> None:
@@ -443,25 +463,33 @@ async def async_setup_services(hass: HomeAssistant) -> None:
         setup_name = call.data.get("setup_name")
         config_type = call.data.get("config_type", "all")
         
-        await hass.async_add_executor_job(
-            db.delete_config, setup_name, config_type
-        )
-        
-        # Pulisci i valori validi orfani
-        await hass.async_add_executor_job(
-            db.cleanup_orphan_valid_values
-        )
+        def _delete_and_cleanup() -> None:
+            # Eliminazione e pulizia dei valori validi orfani: un solo commit e una sola invalidazione
+            with db.batch():
+                db.delete_config(setup_name, config_type)
+                db.cleanup_orphan_valid_values()
         
-        # Forza aggiornamento e invalida cache
-        for entry_id, data in hass.data.get(DOMAIN, {}).items():
-            if isinstance(data, dict):
-                if 'clear_cache' in data:
-                    data['clear_cache']()
-                if 'coordinator' in data:
-                    await data['coordinator'].async_request_refresh()
+        await hass.async_add_executor_job(db.run_write, _delete_and_cleanup)
         
         _LOGGER.info(f"Configurazione '{setup_name}' eliminata")
     
+    async def handle_bulk_import(call: ServiceCall) -> ServiceResponse:
+        """Importa in blocco una lista di regole in un'unica transazione."""
+        entity_id = call.data.get("entity_id")
+        db = get_db_from_entity_id(hass, entity_id)
+        
+        rules = call.data.get("rules")
+        
+        try:
+            result = await hass.async_add_executor_job(db.apply_batch, rules)
+        except ValueError as err:
+            # Errore di validazione del lotto: nulla è stato scritto
+            _LOGGER.error(f"Errore nell'import in blocco: {err}")
+            raise ServiceValidationError(f"Import in blocco non valido: {err}") from err
+        
+        _LOGGER.info(f"Import in blocco completato: {result['imported']} regole")
+        return result
+    
     async def handle_simulate_schedule(call: ServiceCall) -> ServiceResponse:
         """Simula la configurazione per un periodo di tempo."""
         entity_id = call.data.get("entity_id")
@@ -520,14 +548,6 @@ async def async_setup_services(hass: HomeAssistant) -> None:
             db.delete_single_config, config_type, config_id
         )
         
-        # Forza aggiornamento e invalida cache
-        for entry_id, data in hass.data.get(DOMAIN, {}).items():
-            if isinstance(data, dict):
-                if 'clear_cache' in data:
-                    data['clear_cache']()
-                if 'coordinator' in data:
-                    await data['coordinator'].async_request_refresh()
-        
         _LOGGER.info(f"Configurazione singola {config_type} con id {config_id} eliminata")
     
     async def handle_enable_config(call: ServiceCall) -> None:
@@ -542,14 +562,6 @@ async def async_setup_services(hass: HomeAssistant) -> None:
             db.set_config_enabled, config_type, config_id, True
         )
         
-        # Forza aggiornamento e invalida cache
-        for entry_id, data in hass.data.get(DOMAIN, {}).items():
-            if isinstance(data, dict):
-                if 'clear_cache' in data:
-                    data['clear_cache']()
-                if 'coordinator' in data:
-                    await data['coordinator'].async_request_refresh()
-        
         _LOGGER.info(f"Configurazione {config_type} con id {config_id} abilitata")
     
     async def handle_disable_config(call: ServiceCall) -> None:
@@ -564,14 +576,6 @@ async def async_setup_services(hass: HomeAssistant) -> None:
             db.set_config_enabled, config_type, config_id, False
         )
         
-        # Forza aggiornamento e invalida cache
-        for entry_id, data in hass.data.get(DOMAIN, {}).items():
-            if isinstance(data, dict):
-                if 'clear_cache' in data:
-                    data['clear_cache']()
-                if 'coordinator' in data:
-                    await data['coordinator'].async_request_refresh()
-        
         _LOGGER.info(f"Configurazione {config_type} con id {config_id} disabilitata")
     
     async def handle_get_configurations(call: ServiceCall) -> ServiceResponse:
@@ -610,9 +614,11 @@ async def async_setup_services(hass: HomeAssistant) -> None:
         setup_name = call.data.get("setup_name")
         limit = call.data.get("limit", 50)
         offset = call.data.get("offset", 0)
+        before_timestamp = call.data.get("before_timestamp")
+        before_id = call.data.get("before_id")
         
         history = await hass.async_add_executor_job(
-            db.get_history, setup_name, limit, offset
+            db.get_history, setup_name, limit, offset, before_timestamp, before_id
         )
         
         # Ottieni il conteggio totale per la paginazione
@@ -620,9 +626,14 @@ async def async_setup_services(hass: HomeAssistant) -> None:
             db.get_history_count, setup_name
         )
         
+        # Cursore della pagina successiva: la voce più vecchia restituita
+        next_cursor = None
+        if len(history) == limit:
+            next_cursor = {"before_timestamp": history[-1]["timestamp"], "before_id": history[-1]["id"]}
+        
         _LOGGER.info(f"get_history chiamato, risultati: {len(history)} record (totale: {total})")
         
-        return {"history": history, "total": total}
+        return {"history": history, "total": total, "next_cursor": next_cursor}
     
     async def handle_cleanup_history(call: ServiceCall) -> None:
         """Gestisce il servizio per pulire lo storico delle configurazioni."""
@@ -641,13 +652,14 @@ async def async_setup_services(hass: HomeAssistant) -> None:
             )
             _LOGGER.info(f"Cleanup storico per '{setup_name}' completato")
         else:
-            # Cleanup per tutti i setup_name
-            all_names = await hass.async_add_executor_job(db.get_all_setup_names)
-            for name in all_names:
-                await hass.async_add_executor_job(
-                    db._cleanup_history, name, retention_days, max_entries_per_name, min_entries_per_name
-                )
-            _LOGGER.info(f"Cleanup storico globale completato per {len(all_names)} configurazioni")
+            # Manutenzione completa per tutti i setup_name in un solo job e una sola transazione,
+            # con il cleanup_days dell'istanza proprietaria del database (0 = conserva le scadute)
+            entry_data = get_entry_data_for_db(hass, db)
+            cleanup_days = entry_data.get("cleanup_days", DEFAULT_CLEANUP_DAYS)
+            stats = await hass.async_add_executor_job(
+                db.run_maintenance, retention_days, max_entries_per_name, min_entries_per_name, cleanup_days
+            )
+            _LOGGER.info(f"Cleanup storico globale completato in {stats['duration_ms']} ms: {stats}")
     
     # Schema dei servizi
     set_config_schema = vol.Schema({
@@ -714,6 +726,8 @@ async def async_setup_services(hass: HomeAssistant) -> None:
         vol.Optional("setup_name"): cv.string,
         vol.Optional("limit", default=50): cv.positive_int,
         vol.Optional("offset", default=0): cv.positive_int,
+        vol.Inclusive("before_timestamp", "cursor"): cv.string,
+        vol.Inclusive("before_id", "cursor"): cv.positive_int,
     })
     
     cleanup_history_schema = vol.Schema({
@@ -729,6 +743,11 @@ async def async_setup_services(hass: HomeAssistant) -> None:
         vol.Optional("days", default=14): cv.positive_int,
     })
 
+    bulk_import_schema = vol.Schema({
+        vol.Optional("entity_id"): cv.entity_id,
+        vol.Required("rules"): vol.All(cv.ensure_list, [dict]),
+    })
+
     force_refresh_schema = vol.Schema({
         vol.Optional("entity_id"): cv.entity_id,
     })
@@ -786,6 +805,10 @@ async def async_setup_services(hass: HomeAssistant) -> None:
         DOMAIN, "force_refresh", handle_force_refresh, schema=force_refresh_schema
     )
     
+    hass.services.async_register(
+        DOMAIN, "bulk_import", handle_bulk_import, schema=bulk_import_schema, supports_response=SupportsResponse.OPTIONAL
+    )
+    
     # Servizi per gestione valori validi
     async def handle_add_valid_value(call: ServiceCall) -> None:
         """Aggiunge un valore valido per una configurazione."""
@@ -826,18 +849,7 @@ async def async_setup_services(hass: HomeAssistant) -> None:
             return {"valid_values": valid_values}
         else:
             # Restituisci tutti i valori validi raggruppati per setup_name
-            cursor = db.conn.cursor()
-            cursor.execute("""
-                SELECT setup_name, value, description, sort_order, id
-                FROM configurazioni_valori_validi
-                ORDER BY setup_name, sort_order, value
-            """)
-            all_values = {}
-            for row in cursor.fetchall():
-                name = row['setup_name']
-                if name not in all_values:
-                    all_values[name] = []
-                all_values[name].append(dict(row))
+            all_values = await hass.async_add_executor_job(db.get_all_valid_values)
             return {"valid_values": all_values}
     
     add_valid_value_schema = vol.Schema({
@@ -889,16 +901,14 @@ async def async_setup_services(hass: HomeAssistant) -> None:
         backup_file = backup_dir / f"mia_config_backup_{timestamp}.db"
         
         try:
-            # Copia il database
-            await hass.async_add_executor_job(
-                shutil.copy2, db.db_path, str(backup_file)
-            )
-            _LOGGER.info("Backup del database creato: %s", backup_file)
+            # Backup online a passi con l'API di SQLite: consistente anche durante le scritture
+            progress = await hass.async_add_executor_job(db.backup_to_file, str(backup_file))
             return {
                 "success": True,
                 "backup_file": str(backup_file),
                 "timestamp": timestamp,
-                "message": f"Backup creato con successo: {backup_file.name}"
+                "message": f"Backup creato con successo: {backup_file.name}",
+                **progress
             }
         except Exception as e:
             _LOGGER.error("Errore durante il backup: %s", e)
@@ -921,30 +931,18 @@ async def async_setup_services(hass: HomeAssistant) -> None:
             }
         
         try:
-            # Chiudi la connessione al database corrente
-            db.conn.close()
-            
-            # Crea un backup del database corrente prima di ripristinare
+            # Backup del database corrente prima di ripristinare
             current_backup = os.path.join(
                 hass.config.path(), "backups", "mia_config",
                 f"mia_config_pre_restore_{dt_util.now().strftime('%Y%m%d_%H%M%S')}.db"
             )
             os.makedirs(os.path.dirname(current_backup), exist_ok=True)
-            await hass.async_add_executor_job(
-                shutil.copy2, db.db_path, current_backup
-            )
             
-            # Ripristina il backup
+            # Sostituzione del file e ricaricamento delle cache nel thread di scrittura
             await hass.async_add_executor_job(
-                shutil.copy2, backup_file, db.db_path
+                db.restore_from_file, backup_file, current_backup
             )
             
-            # Riapri la connessione
-            db.conn = db._open_database()
-            
-            # Invalida tutte le cache dopo il ripristino per riflettere i nuovi dati
-            db._invalidate_caches()
-            
             _LOGGER.info("Database ripristinato da: %s", backup_file)
             return {
                 "success": True,
@@ -953,11 +951,6 @@ async def async_setup_services(hass: HomeAssistant) -> None:
             }
         except Exception as e:
             _LOGGER.error(f"Errore durante il ripristino: {e}")
-            # Prova a riaprire la connessione comunque
-            try:
-                db.conn = db._open_database()
-            except:
-                pass
             return {
                 "success": False,
                 "message": f"Errore durante il ripristino: {str(e)}"
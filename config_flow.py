@@ -20,6 +20,10 @@ from .const import (
     DEFAULT_HISTORY_RETENTION_DAYS,
     DEFAULT_MAX_HISTORY_PER_NAME,
     DEFAULT_MIN_HISTORY_PER_NAME,
+    DEFAULT_SQLITE_CACHE_SIZE_KB,
+    DEFAULT_SQLITE_MMAP_SIZE_MB,
+    DEFAULT_SQLITE_PROFILE,
+    SQLITE_PROFILES,
 )
 
 _LOGGER = logging.getLogger(__name__)
@@ -125,5 +129,23 @@ class MiaConfigOptionsFlowHandler(config_entries.OptionsFlow):
                         "min_history_per_name", DEFAULT_MIN_HISTORY_PER_NAME
                     ),
                 ): cv.positive_int,
+                vol.Optional(
+                    "sqlite_profile",
+                    default=self.config_entry.options.get(
+                        "sqlite_profile", DEFAULT_SQLITE_PROFILE
+                    ),
+                ): vol.In(SQLITE_PROFILES),
+                vol.Optional(
+                    "sqlite_cache_size_kb",
+                    default=self.config_entry.options.get(
+                        "sqlite_cache_size_kb", DEFAULT_SQLITE_CACHE_SIZE_KB
+                    ),
+                ): cv.positive_int,
+                vol.Optional(
+                    "sqlite_mmap_size_mb",
+                    default=self.config_entry.options.get(
+                        "sqlite_mmap_size_mb", DEFAULT_SQLITE_MMAP_SIZE_MB
+                    ),
+                ): cv.positive_int,
             }),
         )
@@ -5,7 +5,26 @@ VERSION = "2.3.0"
 DEFAULT_NAME = "Mia Config"
 DEFAULT_LOOKAHEAD_HOURS = 168
 DEFAULT_LOOKBACK_HOURS = 24
+DEFAULT_TIMELINE_HORIZON_DAYS = 14
+CHANGE_DEBOUNCE_SECONDS = 0.5
 DEFAULT_CLEANUP_DAYS = 180
 DEFAULT_HISTORY_RETENTION_DAYS = 730
 DEFAULT_MAX_HISTORY_PER_NAME = 100
 DEFAULT_MIN_HISTORY_PER_NAME = 10
+# Inserimenti nello storico oltre i quali viene applicata la retention in background
+HISTORY_TRIM_THRESHOLD = 200
+
+# Profili di connessione SQLite (pragma applicati all'apertura, vedi ConfigDatabase._open_database)
+SQLITE_PROFILE_WAL = "wal"  # journal WAL, synchronous=NORMAL, temp_store=MEMORY
+SQLITE_PROFILE_LEGACY = "legacy"  # rollback journal, synchronous=FULL (comportamento precedente)
+SQLITE_PROFILES = [SQLITE_PROFILE_WAL, SQLITE_PROFILE_LEGACY]
+DEFAULT_SQLITE_PROFILE = SQLITE_PROFILE_WAL
+DEFAULT_SQLITE_CACHE_SIZE_KB = 8192
+DEFAULT_SQLITE_MMAP_SIZE_MB = 0  # 0 = memory-mapped I/O disabilitato
+SQLITE_BUSY_TIMEOUT_MS = 5000
+
+# Backup online (API di backup di SQLite): pagine copiate per passo, pausa tra i passi e
+# ripartenze tollerate (solo journal legacy) prima di copiare il resto in un unico passo
+BACKUP_PAGES_PER_STEP = 256
+BACKUP_STEP_PAUSE_MS = 10
+BACKUP_MAX_RESTARTS = 3
@@ -1,45 +1,288 @@
 """Database manager per Dynamic Config."""
 import sqlite3
+import functools
+import heapq
 import logging
 import math
-from datetime import datetime, timedelta, time
-from typing import Optional, List, Dict, Any
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Optional, Callable, Iterator, List, Dict, Any
 
 from homeassistant.util import dt as dt_util
 
+from .const import (
+    BACKUP_MAX_RESTARTS,
+    BACKUP_PAGES_PER_STEP,
+    BACKUP_STEP_PAUSE_MS,
+    DEFAULT_CLEANUP_DAYS,
+    DEFAULT_HISTORY_RETENTION_DAYS,
+    DEFAULT_MAX_HISTORY_PER_NAME,
+    DEFAULT_MIN_HISTORY_PER_NAME,
+    DEFAULT_SQLITE_CACHE_SIZE_KB,
+    DEFAULT_SQLITE_MMAP_SIZE_MB,
+    DEFAULT_SQLITE_PROFILE,
+    DEFAULT_TIMELINE_HORIZON_DAYS,
+    HISTORY_TRIM_THRESHOLD,
+    SQLITE_BUSY_TIMEOUT_MS,
+    SQLITE_PROFILE_WAL,
+)
+from .rules import compile_rule, mask_to_days, parse_days_mask, to_epoch
+from .timeline import Timeline
+
 _LOGGER = logging.getLogger(__name__)
 
+# Tabelle delle regole caricate nella cache in-memory (ordine di caricamento)
+RULE_TABLES = (
+    'configurazioni',
+    'configurazioni_a_orario',
+    'configurazioni_a_tempo',
+    'configurazioni_condizionali',
+)
+
+# Colonne inserite da apply_batch per tabella (stesso ordine delle tuple costruite)
+BATCH_INSERT_COLUMNS = {
+    'configurazioni': ('setup_name', 'setup_value', 'priority'),
+    'configurazioni_a_orario': (
+        'setup_name', 'setup_value', 'valid_from_ora', 'valid_to_ora', 'days_of_week', 'priority', 'days_mask',
+    ),
+    'configurazioni_a_tempo': (
+        'setup_name', 'setup_value', 'valid_from_date', 'valid_to_date', 'priority',
+        'valid_from_ora', 'valid_to_ora', 'days_of_week', 'valid_from_epoch', 'valid_to_epoch', 'days_mask',
+    ),
+    'configurazioni_condizionali': (
+        'setup_name', 'setup_value', 'conditional_config', 'conditional_operator', 'conditional_value',
+        'valid_from_ora', 'valid_to_ora', 'priority',
+    ),
+}
+
+# Operatori supportati dalle configurazioni condizionali
+CONDITIONAL_OPERATORS = ('==', '!=', '>', '<', '>=', '<=', 'contains', 'not_contains')
+
+
+def _writer(method):
+    """Decoratore dei metodi che modificano il database: li esegue nel thread di scrittura."""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        return self.run_write(method, self, *args, **kwargs)
+    return wrapper
+
+
+def _reader(method):
+    """Decoratore dei metodi di lettura: fissa uno snapshot della cache per tutta la chiamata."""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._pinned_snapshot():
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+def _uses_timelines(method):
+    """Decoratore dei metodi che interrogano le timeline in cache (estese pigramente):
+    le serializza tra i lettori, senza coinvolgere il thread di scrittura."""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._timeline_lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+class _BackupRestarted(Exception):
+    """Il backup a passi è ripartito troppe volte per le scritture concorrenti."""
+
 
 class ConfigDatabase:
     """Gestisce il database SQLite per le configurazioni dinamiche."""
     
-    def __init__(self, db_path: str):
-        """Inizializza il database manager."""
+    def __init__(
+        self,
+        db_path: str,
+        timeline_horizon_days: int = DEFAULT_TIMELINE_HORIZON_DAYS,
+        sqlite_profile: str = DEFAULT_SQLITE_PROFILE,
+        cache_size_kb: int = DEFAULT_SQLITE_CACHE_SIZE_KB,
+        mmap_size_mb: int = DEFAULT_SQLITE_MMAP_SIZE_MB
+    ):
+        """Inizializza il database manager.
+        
+        Args:
+            db_path: Percorso del file SQLite
+            timeline_horizon_days: Giorni futuri coperti dalle timeline compilate per setup_name
+            sqlite_profile: Profilo dei pragma di connessione ('wal' o 'legacy')
+            cache_size_kb: Dimensione della page cache SQLite in KiB
+            mmap_size_mb: Dimensione del memory-mapped I/O in MiB (0 = disabilitato)
+        """
         self.db_path = db_path
+        self.timeline_horizon_days = timeline_horizon_days
+        self.sqlite_profile = sqlite_profile
+        self.cache_size_kb = cache_size_kb
+        self.mmap_size_mb = mmap_size_mb
         self.conn = None
-        # Cache per descrizioni (raramente cambiano, evita query ripetute)
-        self._descriptions_cache = None
-        self._cache_timestamp = None
         # Cache per get_next_changes: evita ricalcoli se il valore corrente e le configurazioni non cambiano
-        # Struttura: {(setup_name, limit_hours, max_results): {'value': str, 'config_version': int, 'result': list, 'timestamp': str}}
+        # Struttura: {(setup_name, limit_hours, max_results): {'value': str, 'config_version': int (del setup_name), 'result': list, 'timestamp': str}}
         self._next_changes_cache = {}
-        # Cache per event_times: evita ricalcolo degli stessi timestamp eventi quando le configurazioni non cambiano
-        self._event_times_cache = set()
-        self._event_times_config_version = None
-        self._event_times_generation_start = None
-        self._event_times_generation_end = None
-        self._config_version = 0  # Incrementato ad ogni modifica di configurazione
+        # Timeline compilate per setup_name (punti di cambiamento con stato vincente), estese
+        # pigramente dagli eventi candidati. Struttura: {setup_name: (versione del nome, Timeline)},
+        # invalidata per nome. Le timeline vengono estese dai lettori: _timeline_lock le serializza
+        self._timeline_cache = {}
+        self._timeline_lock = threading.RLock()
+        # Stato per thread: snapshot fissato (lettori) o copia di lavoro (thread di scrittura),
+        # e memo della risoluzione per istante {setup_name: stato vincente o None}, valido solo
+        # per la chiave (timestamp, config_version) corrente e condiviso dalla ricorsione sui
+        # condizionali così ogni setup_name viene risolto al più una volta per istante
+        self._local = threading.local()
+        # Thread unico di scrittura: tutte le modifiche passano dalla sua coda (vedi run_write)
+        self._writer_ident = None
+        self._writer = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='mia_config_writer', initializer=self._init_writer_thread
+        )
+        # True se l'operazione di scrittura in corso ha fatto un commit non ancora pubblicato
+        self._commit_unpublished = False
+        # Pool di connessioni in sola lettura per le query dei lettori: {ident del thread: connessione}
+        self._read_connections = {}
+        self._read_connections_lock = threading.Lock()
+        # Sottoscrittori degli eventi di modifica (vedi subscribe) e id delle regole
+        # modificate dall'ultima notifica: {tabella: set(id)}
+        self._listeners = []
+        self._changed_rule_ids = {}
+        # Inserimenti nello storico dall'ultima applicazione della retention (vedi history_trim_due)
+        self._history_inserts = 0
+        # Sessione batch() in corso: profondità di annidamento e invalidazioni accumulate
+        self._batch_depth = 0
+        self._batch_names = set()
+        self._batch_full_reload = False
+        # Inserimenti nello storico coperti da un trim_history globale della sessione batch():
+        # vengono scalati da _history_inserts solo quando la DELETE è confermata dal commit
+        self._batch_history_trimmed = 0
         
         # CACHE IN-MEMORY per tutte le configurazioni (caricata all'avvio, aggiornata solo su modifiche)
-        # Questo elimina ~40 query al minuto, caricando tutto UNA VOLTA e lavorando in memoria
-        self._memory_cache = {
+        # Questo elimina ~40 query al minuto, caricando tutto UNA VOLTA e lavorando in memoria.
+        # È uno snapshot immutabile: il thread di scrittura ne modifica una copia e la pubblica
+        # con un solo assegnamento dopo il commit, i lettori usano quello pubblicato (_memory_cache)
+        self._snapshot = {
             'configurazioni': [],  # Lista di dict con tutte le config standard
             'configurazioni_a_orario': [],  # Lista di dict con tutte le config a orario
             'configurazioni_a_tempo': [],  # Lista di dict con tutte le config a tempo
             'configurazioni_condizionali': [],  # Lista di dict con tutte le config condizionali
             'descrizioni': {},  # Dict {setup_name: description}
+            'by_name': {},  # Indice {setup_name: {tabella: [righe ordinate per priorità]}}
+            'compiled': {},  # Dict {tabella: [regole compilate]} (ricostruito ad ogni config_version)
+            'compiled_by_name': {},  # Indice {setup_name: {tabella: [regole compilate]}}
+            'dependents': {},  # Grafo inverso {setup_name: {setup_name dei condizionali che dipendono da lui}}
+            'config_version': 0,  # Incrementato ad ogni modifica di configurazione
+            # Versioni per setup_name: config_version dell'ultima modifica che ha toccato il nome
+            # (direttamente o tramite una dipendenza condizionale). Un ricaricamento completo
+            # vale come modifica di tutti i nomi (full_reload_version)
+            'name_versions': {},
+            'full_reload_version': 0,
             'loaded': False  # Flag per sapere se la cache è stata caricata
         }
+    
+    @property
+    def _memory_cache(self) -> Dict[str, Any]:
+        """Snapshot della cache in uso nel thread corrente.
+        
+        Nel thread di scrittura è la copia di lavoro (se esiste), in un metodo
+        @_reader lo snapshot fissato all'ingresso, altrimenti quello pubblicato.
+        """
+        snapshot = getattr(self._local, 'snapshot', None)
+        return self._snapshot if snapshot is None else snapshot
+    
+    @contextmanager
+    def _pinned_snapshot(self) -> Iterator[Dict[str, Any]]:
+        """Fissa lo snapshot pubblicato per la durata del blocco (rientrante)."""
+        if getattr(self._local, 'snapshot', None) is not None:
+            # Chiamata annidata o thread di scrittura: lo snapshot è già fissato
+            yield self._local.snapshot
+            return
+        self._local.snapshot = self._snapshot
+        try:
+            yield self._local.snapshot
+        finally:
+            self._local.snapshot = None
+    
+    def _writable_cache(self) -> Dict[str, Any]:
+        """Copia di lavoro della cache, creata alla prima modifica dopo l'ultima pubblicazione.
+        
+        La copia è superficiale: le liste per tabella e le voci degli indici sono
+        condivise con lo snapshot pubblicato e vanno sostituite, mai modificate.
+        """
+        if threading.get_ident() != self._writer_ident:
+            raise RuntimeError("La cache in-memory può essere modificata solo dal thread di scrittura")
+        cache = getattr(self._local, 'snapshot', None)
+        if cache is None or cache is self._snapshot:
+            cache = dict(self._snapshot)
+            for key in ('compiled', 'by_name', 'compiled_by_name', 'descrizioni', 'name_versions'):
+                cache[key] = dict(cache[key])
+            self._local.snapshot = cache
+        return cache
+    
+    def _publish_snapshot(self) -> None:
+        """Rende visibile ai lettori la copia di lavoro con un solo assegnamento (atomico)."""
+        cache = getattr(self._local, 'snapshot', None)
+        if cache is not None:
+            self._snapshot = cache
+        self._commit_unpublished = False
+    
+    def _init_writer_thread(self) -> None:
+        """Inizializzatore del thread di scrittura: ne registra l'identificativo."""
+        self._writer_ident = threading.get_ident()
+    
+    def submit_write(self, func: Callable[..., Any], *args: Any, **kwargs: Any) -> Future:
+        """Accoda func al thread di scrittura e restituisce il Future del risultato."""
+        return self._writer.submit(self._run_write_operation, func, args, kwargs)
+    
+    def run_write(self, func: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        """Esegue func nel thread di scrittura e ne attende il risultato.
+        
+        Tutte le modifiche passano da qui (i metodi di scrittura sono decorati con
+        @_writer): sono serializzate dalla coda di un unico thread, mentre i lettori
+        continuano a lavorare sullo snapshot pubblicato senza attendere. Chiamato dal
+        thread di scrittura esegue func direttamente: così funzioni composte (ad es.
+        più scritture in una sessione batch()) restano un'unica operazione.
+        """
+        if threading.get_ident() == self._writer_ident:
+            return func(*args, **kwargs)
+        return self.submit_write(func, *args, **kwargs).result()
+    
+    def _run_write_operation(self, func: Callable[..., Any], args: tuple, kwargs: dict) -> Any:
+        """Esegue un'operazione accodata; se fallisce annulla la transazione e la copia di lavoro.
+        
+        Il ricaricamento completo dopo un errore serve solo se è questa operazione ad
+        aver fatto commit senza pubblicare: i commit che non toccano la cache delle
+        regole (valori validi, retention dello storico) non devono farlo scattare
+        per le operazioni successive.
+        """
+        self._commit_unpublished = False
+        try:
+            return func(*args, **kwargs)
+        except BaseException:
+            if self.conn is not None and self.conn.in_transaction:
+                self.conn.rollback()
+            self._local.snapshot = None
+            if self._commit_unpublished:
+                # Il DB è già cambiato ma lo snapshot no: riallinea ricaricando tutto
+                self._invalidate_caches()
+            raise
+        finally:
+            self._local.snapshot = None
+    
+    def _ensure_loaded(self) -> None:
+        """Carica la cache in-memory nel thread di scrittura se non ancora caricata."""
+        if self._memory_cache['loaded']:
+            return
+        self.run_write(self._load_and_publish)
+        if getattr(self._local, 'snapshot', None) is not None:
+            self._local.snapshot = self._snapshot
+    
+    def _load_and_publish(self) -> None:
+        """Carica tutte le configurazioni (aprendo la connessione se serve) e pubblica lo snapshot."""
+        if self.conn is None:
+            self.conn = self._open_database()
+        self._load_all_to_memory()
+        self._publish_snapshot()
 
     def _ensure_local_dt(self, value: datetime) -> datetime:
         """Assicura un datetime locale senza shiftare orari locali."""
@@ -74,53 +317,360 @@ class ConfigDatabase:
         return setup_name
     
     def _open_database(self):
-        """Apre la connessione al database."""
-        conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        """Apre la connessione al database applicando il profilo dei pragma."""
+        conn = sqlite3.connect(self.db_path, check_same_thread=False, timeout=SQLITE_BUSY_TIMEOUT_MS / 1000)
         conn.row_factory = sqlite3.Row
+        self._apply_pragmas(conn)
         return conn
     
+    def _open_read_connection(self) -> sqlite3.Connection:
+        """Apre una connessione in sola lettura (URI mode=ro) sullo stesso file."""
+        uri = f"{Path(self.db_path).resolve().as_uri()}?mode=ro"
+        conn = sqlite3.connect(uri, uri=True, check_same_thread=False, timeout=SQLITE_BUSY_TIMEOUT_MS / 1000)
+        conn.row_factory = sqlite3.Row
+        self._apply_pragmas(conn, read_only=True)
+        return conn
+    
+    def _read_connection(self) -> sqlite3.Connection:
+        """Connessione per le query di sola lettura del thread corrente.
+        
+        Ogni thread dell'executor ha la propria connessione in sola lettura, aperta
+        alla prima richiesta: con il journal WAL legge l'ultimo commit senza attendere
+        la transazione in corso sulla connessione di scrittura. Il thread di scrittura
+        usa la propria connessione, così vede anche le modifiche non ancora confermate.
+        """
+        ident = threading.get_ident()
+        if ident == self._writer_ident:
+            return self.conn
+        conn = self._read_connections.get(ident)
+        if conn is None:
+            conn = self._open_read_connection()
+            with self._read_connections_lock:
+                self._read_connections[ident] = conn
+        return conn
+    
+    def _close_read_connections(self) -> None:
+        """Chiude tutte le connessioni in sola lettura (verranno riaperte alla prossima query)."""
+        with self._read_connections_lock:
+            connections = list(self._read_connections.values())
+            self._read_connections.clear()
+        for conn in connections:
+            conn.close()
+    
+    def _apply_pragmas(self, conn: sqlite3.Connection, read_only: bool = False) -> None:
+        """Applica i pragma del profilo di connessione configurato.
+        
+        Profilo 'wal': journal WAL (i lettori non bloccano lo scrittore) con
+        synchronous=NORMAL, che fa fsync solo ai checkpoint e non ad ogni commit:
+        su host con SD card è la principale fonte di latenza delle scritture.
+        Profilo 'legacy': rollback journal con synchronous=FULL, come in passato.
+        cache_size, mmap_size e busy_timeout valgono per entrambi i profili.
+        Le connessioni in sola lettura non impostano journal e sincronizzazione,
+        che appartengono al file e alla connessione di scrittura.
+        """
+        conn.execute(f"PRAGMA busy_timeout = {int(SQLITE_BUSY_TIMEOUT_MS)}")
+        if read_only:
+            if self.sqlite_profile == SQLITE_PROFILE_WAL:
+                conn.execute("PRAGMA temp_store = MEMORY")
+        elif self.sqlite_profile == SQLITE_PROFILE_WAL:
+            journal_mode = conn.execute("PRAGMA journal_mode = WAL").fetchone()[0]
+            if str(journal_mode).lower() != 'wal':
+                _LOGGER.warning(f"Journal WAL non disponibile per {self.db_path}, in uso: {journal_mode}")
+            conn.execute("PRAGMA synchronous = NORMAL")
+            conn.execute("PRAGMA temp_store = MEMORY")
+        else:
+            conn.execute("PRAGMA journal_mode = DELETE")
+            conn.execute("PRAGMA synchronous = FULL")
+        # Valore negativo: dimensione in KiB invece che in pagine
+        conn.execute(f"PRAGMA cache_size = {-int(self.cache_size_kb)}")
+        conn.execute(f"PRAGMA mmap_size = {int(self.mmap_size_mb) * 1024 * 1024}")
+    
+    @_writer
+    def get_connection_info(self) -> Dict[str, Any]:
+        """Profilo e valori effettivi dei pragma della connessione (per la diagnostica).
+        
+        Legge i pragma della connessione di scrittura, quindi va eseguito nel suo thread.
+        """
+        cursor = self.conn.cursor()
+        info = {
+            'profile': self.sqlite_profile,
+            'sqlite_version': sqlite3.sqlite_version,
+        }
+        for pragma in ('journal_mode', 'synchronous', 'temp_store', 'cache_size', 'mmap_size', 'busy_timeout'):
+            info[pragma] = cursor.execute(f"PRAGMA {pragma}").fetchone()[0]
+        info['read_connections'] = len(self._read_connections)
+        return info
+    
+    @_writer
     def _load_all_to_memory(self) -> None:
         """Carica TUTTE le configurazioni in memoria in un'unica operazione batch.
         
         Questo elimina la necessità di fare query ripetute ogni scan_interval.
         Con pochi setup (7) e pochi override (20), tutto può stare in RAM.
         La cache viene invalidata e ricaricata solo quando ci sono modifiche.
+        Scrive nella copia di lavoro del thread di scrittura: diventa visibile ai
+        lettori solo con _publish_snapshot.
         """
+        cache = self._writable_cache()
         cursor = self.conn.cursor()
         
         # Carica configurazioni standard (abilitate e non)
-        cursor.execute("SELECT * FROM configurazioni ORDER BY priority")
-        self._memory_cache['configurazioni'] = [dict(row) for row in cursor.fetchall()]
+        # ORDER BY priority, id: ordine deterministico anche a parità di priorità
+        cursor.execute("SELECT * FROM configurazioni ORDER BY priority, id")
+        cache['configurazioni'] = [dict(row) for row in cursor.fetchall()]
         
         # Carica configurazioni a orario
-        cursor.execute("SELECT * FROM configurazioni_a_orario ORDER BY priority")
-        self._memory_cache['configurazioni_a_orario'] = [dict(row) for row in cursor.fetchall()]
+        cursor.execute("SELECT * FROM configurazioni_a_orario ORDER BY priority, id")
+        cache['configurazioni_a_orario'] = [dict(row) for row in cursor.fetchall()]
         
         # Carica configurazioni a tempo
-        cursor.execute("SELECT * FROM configurazioni_a_tempo ORDER BY priority")
-        self._memory_cache['configurazioni_a_tempo'] = [dict(row) for row in cursor.fetchall()]
+        cursor.execute("SELECT * FROM configurazioni_a_tempo ORDER BY priority, id")
+        cache['configurazioni_a_tempo'] = [dict(row) for row in cursor.fetchall()]
         
         # Carica configurazioni condizionali
-        cursor.execute("SELECT * FROM configurazioni_condizionali ORDER BY priority")
-        self._memory_cache['configurazioni_condizionali'] = [dict(row) for row in cursor.fetchall()]
+        cursor.execute("SELECT * FROM configurazioni_condizionali ORDER BY priority, id")
+        cache['configurazioni_condizionali'] = [dict(row) for row in cursor.fetchall()]
         
         # Carica descrizioni
         cursor.execute("SELECT setup_name, description FROM configurazioni_descrizioni")
-        self._memory_cache['descrizioni'] = {row['setup_name']: row['description'] for row in cursor.fetchall()}
+        cache['descrizioni'] = {row['setup_name']: row['description'] for row in cursor.fetchall()}
         
-        self._memory_cache['loaded'] = True
+        # Regole compilate (date, orari e giorni già parsati) usate dal resolver
+        cache['compiled'] = {
+            table: [compile_rule(table, row) for row in cache[table]]
+            for table in RULE_TABLES
+        }
+        
+        # Indici per setup_name: la risoluzione mirata tocca solo le regole di quel nome
+        cache['by_name'] = self._build_name_index(self._memory_cache)
+        cache['compiled_by_name'] = self._build_name_index(cache['compiled'])
+        cache['dependents'] = self._build_dependents_index(cache['compiled']['configurazioni_condizionali'])
+        
+        cache['loaded'] = True
         
         _LOGGER.debug(
-            f"Cache in-memory caricata: {len(self._memory_cache['configurazioni'])} standard, "
-            f"{len(self._memory_cache['configurazioni_a_orario'])} orario, "
-            f"{len(self._memory_cache['configurazioni_a_tempo'])} tempo, "
-            f"{len(self._memory_cache['configurazioni_condizionali'])} condizionali"
+            f"Cache in-memory caricata: {len(cache['configurazioni'])} standard, "
+            f"{len(cache['configurazioni_a_orario'])} orario, "
+            f"{len(cache['configurazioni_a_tempo'])} tempo, "
+            f"{len(cache['configurazioni_condizionali'])} condizionali"
         )
     
+    @staticmethod
+    def _build_name_index(rules_by_table: Dict[str, list]) -> Dict[str, Dict[str, list]]:
+        """Costruisce l'indice {setup_name: {tabella: [regole]}} dalle liste per tabella.
+        
+        Funziona sia con le righe (dict) sia con le regole compilate. Le liste di
+        origine sono già ordinate per priorità, quindi anche le liste dell'indice
+        lo sono (l'inserimento preserva l'ordine).
+        """
+        index = {}
+        for table in RULE_TABLES:
+            for rule in rules_by_table[table]:
+                name = rule['setup_name'] if isinstance(rule, dict) else rule.setup_name
+                rules = index.get(name)
+                if rules is None:
+                    rules = {t: [] for t in RULE_TABLES}
+                    index[name] = rules
+                rules[table].append(rule)
+        return index
+    
+    @staticmethod
+    def _build_dependents_index(conditionals: list) -> Dict[str, set]:
+        """Costruisce il grafo inverso delle dipendenze dai condizionali compilati.
+        
+        Include anche i condizionali disabilitati: riabilitarli non deve richiedere
+        di ricostruire il grafo per sapere chi invalidare.
+        """
+        dependents = {}
+        for rule in conditionals:
+            dependents.setdefault(rule.conditional_config, set()).add(rule.setup_name)
+        return dependents
+    
+    def _get_rules(self, table: str, setup_name: Optional[str] = None) -> List[Dict[str, Any]]:
+        """Restituisce le righe in cache di una tabella, filtrate per setup_name se fornito.
+        
+        Con setup_name usa l'indice per nome (O(regole del nome)) invece di
+        scansionare l'intera lista.
+        """
+        if setup_name is None:
+            return self._memory_cache[table]
+        rules = self._memory_cache['by_name'].get(setup_name)
+        if rules is None:
+            return []
+        return rules[table]
+    
+    def _get_compiled_rules(self, table: str, setup_name: Optional[str] = None) -> list:
+        """Come _get_rules, ma restituisce le regole compilate."""
+        if setup_name is None:
+            return self._memory_cache['compiled'][table]
+        rules = self._memory_cache['compiled_by_name'].get(setup_name)
+        if rules is None:
+            return []
+        return rules[table]
+    
+    def _sync_cache_rows(self, table: str, column: str, value: Any) -> set:
+        """Applica alla cache in-memory il delta delle righe di `table` con column = value.
+        
+        Rilegge dal DB solo le righe interessate (inserite, modificate o eliminate),
+        le sostituisce nelle liste per tabella e nell'indice per nome mantenendo
+        l'ordine (priority, id), e compila solo le regole nuove. Lavora sulla copia
+        di lavoro: liste e voci dell'indice vengono sostituite e non modificate sul
+        posto, perché sono condivise con lo snapshot che i lettori stanno usando.
+        
+        Returns:
+            Set dei setup_name toccati (prima e dopo la modifica)
+        """
+        if not self._memory_cache['loaded']:
+            self._load_all_to_memory()
+            return set()
+        
+        if column == 'id':
+            value = int(value)
+        cursor = self.conn.cursor()
+        cursor.execute(f"SELECT * FROM {table} WHERE {column} = ? ORDER BY priority, id", (value,))
+        fresh = [dict(row) for row in cursor.fetchall()]
+        return self._apply_cache_delta(table, fresh, lambda row: row[column] == value)
+    
+    def _sync_cache_ids(self, table: str, ids: List[int]) -> set:
+        """Come _sync_cache_rows, per le righe di `table` con gli id indicati (es. inserite da apply_batch).
+        
+        Rilegge le righe a blocchi di id (entro il limite di parametri di SQLite).
+        """
+        if not self._memory_cache['loaded']:
+            self._load_all_to_memory()
+            return set()
+        
+        cursor = self.conn.cursor()
+        fresh = []
+        for start in range(0, len(ids), 500):
+            chunk = ids[start:start + 500]
+            cursor.execute(f"SELECT * FROM {table} WHERE id IN ({', '.join('?' * len(chunk))})", chunk)
+            fresh.extend(dict(row) for row in cursor.fetchall())
+        fresh.sort(key=lambda row: (row['priority'], row['id']))
+        id_set = set(ids)
+        return self._apply_cache_delta(table, fresh, lambda row: row['id'] in id_set)
+    
+    def _apply_cache_delta(self, table: str, fresh: List[Dict[str, Any]], is_stale: Callable[[Dict[str, Any]], bool]) -> set:
+        """Sostituisce nella copia di lavoro le righe in cache per cui is_stale è vero con `fresh`.
+        
+        `fresh` sono le righe correnti nel DB (ordinate per priority, id) per lo stesso
+        criterio: le righe stale assenti da `fresh` sono state eliminate.
+        
+        Returns:
+            Set dei setup_name toccati (prima e dopo la modifica)
+        """
+        fresh_compiled = [compile_rule(table, row) for row in fresh]
+        
+        cache = self._writable_cache()
+        rows = cache[table]
+        stale = {row['id']: row for row in rows if is_stale(row)}
+        stale_ids = set(stale)
+        touched = {row['setup_name'] for row in stale.values()}
+        touched.update(row['setup_name'] for row in fresh)
+        if not stale_ids and not fresh:
+            return touched
+        
+        # Regole effettivamente inserite, modificate o eliminate (per la notifica ai sottoscrittori)
+        changed_ids = {row['id'] for row in fresh if stale.get(row['id']) != row}
+        changed_ids.update(stale_ids - {row['id'] for row in fresh})
+        if changed_ids:
+            self._changed_rule_ids.setdefault(table, set()).update(changed_ids)
+        
+        sort_key = lambda row: (row['priority'], row['id'])
+        compiled_key = lambda rule: (rule.priority, rule.id)
+        cache[table] = list(heapq.merge(
+            [row for row in rows if row['id'] not in stale_ids], fresh, key=sort_key
+        ))
+        cache['compiled'][table] = list(heapq.merge(
+            [rule for rule in cache['compiled'][table] if rule.id not in stale_ids],
+            fresh_compiled, key=compiled_key
+        ))
+        
+        # Aggiorna l'indice per nome solo per i setup_name toccati
+        fresh_by_name = {}
+        for row, rule in zip(fresh, fresh_compiled):
+            name_rows, name_rules = fresh_by_name.setdefault(row['setup_name'], ([], []))
+            name_rows.append(row)
+            name_rules.append(rule)
+        for name in touched:
+            name_rows, name_rules = fresh_by_name.get(name, ([], []))
+            for index, items, key in (
+                (cache['by_name'], name_rows, sort_key),
+                (cache['compiled_by_name'], name_rules, compiled_key),
+            ):
+                entry = index.get(name)
+                entry = {t: [] for t in RULE_TABLES} if entry is None else dict(entry)
+                entry[table] = list(heapq.merge(
+                    [item for item in entry[table] if (item['id'] if isinstance(item, dict) else item.id) not in stale_ids],
+                    items, key=key
+                ))
+                if any(entry.values()):
+                    index[name] = entry
+                else:
+                    index.pop(name, None)
+        
+        if table == 'configurazioni_condizionali':
+            # Poche righe: ricostruire il grafo inverso costa meno che aggiornarlo per archi
+            cache['dependents'] = self._build_dependents_index(cache['compiled'][table])
+        
+        return touched
+    
+    def _sync_cache_description(self, setup_name: str) -> None:
+        """Aggiorna nella cache in-memory la descrizione di un singolo setup_name."""
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT description FROM configurazioni_descrizioni WHERE setup_name = ?", (setup_name,))
+        row = cursor.fetchone()
+        descriptions = self._writable_cache()['descrizioni']
+        if row is None:
+            descriptions.pop(setup_name, None)
+        else:
+            descriptions[setup_name] = row['description']
+    
+    def _get_transitive_dependents(self, setup_names: set) -> set:
+        """Restituisce setup_names più tutti i setup che ne dipendono (anche indirettamente).
+        
+        Visita in ampiezza il grafo inverso delle dipendenze: costa O(nomi coinvolti),
+        indipendentemente dal numero totale di condizionali.
+        """
+        dependents = self._memory_cache['dependents']
+        affected = set(setup_names)
+        frontier = list(setup_names)
+        while frontier:
+            name = frontier.pop()
+            for dependent in dependents.get(name, ()):
+                if dependent not in affected:
+                    affected.add(dependent)
+                    frontier.append(dependent)
+        return affected
+    
+    def get_config_version(self, setup_name: str) -> int:
+        """Versione delle configurazioni che influenzano un setup_name.
+        
+        Cambia solo se una scrittura ha toccato il setup_name o una sua dipendenza
+        (diretta o transitiva): le cache derivate (prossimi cambiamenti, dati
+        predittivi del sensore) dei nomi non coinvolti restano valide.
+        """
+        cache = self._memory_cache
+        return max(cache['name_versions'].get(setup_name, 0), cache['full_reload_version'])
+    
+    @_writer
     def initialize(self) -> None:
-        """Crea le tabelle se non esistono e applica migrazioni."""
+        """Apre il database, crea lo schema mancante e carica la cache in-memory."""
         self.conn = self._open_database()
+        self._ensure_schema()
+        
+        # Carica tutte le configurazioni in memoria per eliminare query ripetute
+        self._load_all_to_memory()
+        self._publish_snapshot()
         
+        _LOGGER.info("Database inizializzato con indici ottimizzati e cache in-memory: %s", self.db_path)
+    
+    def _ensure_schema(self) -> None:
+        """Crea tabelle, indici e trigger se non esistono e applica migrazioni.
+        
+        Idempotente: eseguito all'apertura e dopo un ripristino, perché il backup
+        ripristinato può avere uno schema di una versione precedente.
+        """
         cursor = self.conn.cursor()
         
         # Tabella configurazioni standard
@@ -144,7 +694,8 @@ class ConfigDatabase:
                 valid_to_ora REAL,
                 days_of_week TEXT DEFAULT '0,1,2,3,4,5,6',
                 priority INTEGER NOT NULL DEFAULT 99,
-                enabled INTEGER NOT NULL DEFAULT 1
+                enabled INTEGER NOT NULL DEFAULT 1,
+                days_mask INTEGER
             )
         """)
         
@@ -160,7 +711,10 @@ class ConfigDatabase:
                 valid_to_ora REAL,
                 days_of_week TEXT,
                 priority INTEGER NOT NULL DEFAULT 99,
-                enabled INTEGER NOT NULL DEFAULT 1
+                enabled INTEGER NOT NULL DEFAULT 1,
+                valid_from_epoch INTEGER,
+                valid_to_epoch INTEGER,
+                days_mask INTEGER
             )
         """)
         
@@ -218,6 +772,15 @@ class ConfigDatabase:
             )
         """)
         
+        # Migrazione: secondi epoch e bitmask dei giorni accanto alle colonne testuali legacy
+        self._add_missing_columns(cursor, 'configurazioni_a_orario', {'days_mask': 'INTEGER'})
+        self._add_missing_columns(cursor, 'configurazioni_a_tempo', {
+            'valid_from_epoch': 'INTEGER',
+            'valid_to_epoch': 'INTEGER',
+            'days_mask': 'INTEGER',
+        })
+        self._sync_derived_columns(cursor)
+        
         # Crea indici per ottimizzare le query in _get_configurations_at_time
         # Questi indici velocizzano le query eseguite ad ogni scan_interval
         
@@ -233,10 +796,12 @@ class ConfigDatabase:
             ON configurazioni_a_orario(valid_from_ora, valid_to_ora)
         """)
         
-        # Indice per configurazioni a tempo (filtro su date)
+        # Indice per configurazioni a tempo su epoch interi (scadenze e finestre attive).
+        # Sostituisce idx_tempo_date, inutilizzabile dai confronti datetime(valid_to_date)
+        cursor.execute("DROP INDEX IF EXISTS idx_tempo_date")
         cursor.execute("""
-            CREATE INDEX IF NOT EXISTS idx_tempo_date 
-            ON configurazioni_a_tempo(valid_from_date, valid_to_date)
+            CREATE INDEX IF NOT EXISTS idx_tempo_epoch 
+            ON configurazioni_a_tempo(valid_to_epoch, valid_from_epoch)
         """)
         
         # Indice per configurazioni condizionali (lookup per conditional_config)
@@ -245,18 +810,108 @@ class ConfigDatabase:
             ON configurazioni_condizionali(conditional_config, priority)
         """)
         
-        # Indice per storico (filtro per setup_name e timestamp per grafici)
+        # Indici per storico: paginazione keyset su (timestamp, id), per nome e globale.
+        # Coprono la ricerca della pagina (setup_name, timestamp, id): le righe complete
+        # vengono lette solo per gli id della pagina. Sostituiscono idx_storico_name_timestamp
+        cursor.execute("DROP INDEX IF EXISTS idx_storico_name_timestamp")
         cursor.execute("""
-            CREATE INDEX IF NOT EXISTS idx_storico_name_timestamp 
-            ON configurazioni_storico(setup_name, timestamp)
+            CREATE INDEX IF NOT EXISTS idx_storico_name_timestamp_id 
+            ON configurazioni_storico(setup_name, timestamp, id)
+        """)
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_storico_timestamp_id 
+            ON configurazioni_storico(timestamp, id)
+        """)
+        
+        # Conteggi dello storico per setup_name, mantenuti dai trigger: get_history_count
+        # non scansiona più lo storico
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'configurazioni_storico_conteggi'")
+        counts_exist = cursor.fetchone() is not None
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS configurazioni_storico_conteggi (
+                setup_name TEXT PRIMARY KEY NOT NULL,
+                entries INTEGER NOT NULL
+            )
+        """)
+        if not counts_exist:
+            # Migrazione: popola i conteggi dallo storico esistente (stessa transazione dei trigger)
+            cursor.execute("""
+                INSERT INTO configurazioni_storico_conteggi (setup_name, entries)
+                SELECT setup_name, COUNT(*) FROM configurazioni_storico GROUP BY setup_name
+            """)
+        cursor.execute("""
+            CREATE TRIGGER IF NOT EXISTS trg_storico_conteggi_insert
+            AFTER INSERT ON configurazioni_storico
+            BEGIN
+                INSERT INTO configurazioni_storico_conteggi (setup_name, entries)
+                VALUES (NEW.setup_name, 1)
+                ON CONFLICT(setup_name) DO UPDATE SET entries = entries + 1;
+            END
+        """)
+        cursor.execute("""
+            CREATE TRIGGER IF NOT EXISTS trg_storico_conteggi_delete
+            AFTER DELETE ON configurazioni_storico
+            BEGIN
+                UPDATE configurazioni_storico_conteggi SET entries = entries - 1
+                WHERE setup_name = OLD.setup_name;
+                DELETE FROM configurazioni_storico_conteggi
+                WHERE setup_name = OLD.setup_name AND entries <= 0;
+            END
         """)
         
         self.conn.commit()
+    
+    @staticmethod
+    def _add_missing_columns(cursor: sqlite3.Cursor, table: str, columns: Dict[str, str]) -> None:
+        """Aggiunge a una tabella esistente le colonne mancanti (migrazione idempotente)."""
+        cursor.execute(f"PRAGMA table_info({table})")
+        existing = {row[1] for row in cursor.fetchall()}
+        for column, column_type in columns.items():
+            if column not in existing:
+                cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}")
+                _LOGGER.info(f"Migrazione schema: aggiunta colonna {table}.{column}")
+    
+    def _sync_derived_columns(self, cursor: sqlite3.Cursor) -> None:
+        """Ricalcola epoch e bitmask dalle colonne testuali e aggiorna le righe che differiscono.
         
-        # Carica tutte le configurazioni in memoria per eliminare query ripetute
-        self._load_all_to_memory()
+        Le colonne testuali restano la fonte di verità: oltre al backfill dopo la
+        migrazione (o dopo il ripristino di un backup precedente) riallinea gli epoch
+        se il fuso orario di Home Assistant è cambiato dall'ultima scrittura.
+        """
+        cursor.execute("""
+            SELECT id, valid_from_date, valid_to_date, days_of_week, valid_from_epoch, valid_to_epoch, days_mask
+            FROM configurazioni_a_tempo
+        """)
+        updates = []
+        for row in cursor.fetchall():
+            try:
+                derived = (to_epoch(row[1]), to_epoch(row[2]), parse_days_mask(row[3]))
+            except (TypeError, ValueError) as err:
+                _LOGGER.warning(f"Configurazione a tempo id={row[0]} con date o giorni non validi: {err}")
+                continue
+            if derived != tuple(row[4:]):
+                updates.append(derived + (row[0],))
+        if updates:
+            cursor.executemany("""
+                UPDATE configurazioni_a_tempo SET valid_from_epoch = ?, valid_to_epoch = ?, days_mask = ?
+                WHERE id = ?
+            """, updates)
         
-        _LOGGER.info("Database inizializzato con indici ottimizzati e cache in-memory: %s", self.db_path)
+        cursor.execute("SELECT id, days_of_week, days_mask FROM configurazioni_a_orario")
+        schedule_updates = []
+        for row in cursor.fetchall():
+            try:
+                days_mask = parse_days_mask(row[1])
+            except (TypeError, ValueError) as err:
+                _LOGGER.warning(f"Configurazione a orario id={row[0]} con giorni non validi: {err}")
+                continue
+            if days_mask != row[2]:
+                schedule_updates.append((days_mask, row[0]))
+        if schedule_updates:
+            cursor.executemany("UPDATE configurazioni_a_orario SET days_mask = ? WHERE id = ?", schedule_updates)
+        
+        if updates or schedule_updates:
+            _LOGGER.info(f"Colonne epoch/bitmask aggiornate: {len(updates)} a tempo, {len(schedule_updates)} a orario")
     
     def _get_configurations_at_time(self, target_datetime: datetime, target_setup_name: Optional[str] = None, visited: Optional[set] = None) -> Dict[str, Any]:
         """
@@ -266,7 +921,9 @@ class ConfigDatabase:
         per risolvere quel setup specifico, usando chiamate ricorsive per le dipendenze
         condizionali. Questo evita di calcolare inutilmente centinaia di configurazioni.
         
-        Quando target_setup_name è None, mantiene il comportamento legacy di calcolare tutto.
+        Quando target_setup_name è None, risolve tutti i setup_name con lo stesso motore.
+        In entrambi i casi ogni regola viene valutata al più una volta e il filtro sul
+        target vale per tutti i tipi di configurazione.
         
         OTTIMIZZAZIONI PERFORMANCE:
         - USA CACHE IN-MEMORY invece di query ripetute (elimina ~40 query/minuto)
@@ -282,16 +939,15 @@ class ConfigDatabase:
         Args:
             target_datetime: Il momento per cui calcolare le configurazioni attive
             target_setup_name: Se fornito, calcola solo le configurazioni necessarie per questo setup.
-                              Se None, calcola tutte le configurazioni (comportamento legacy)
+                              Se None, calcola tutte le configurazioni
             visited: Set interno per tracciare le configurazioni già visitate (previene cicli)
         
         Returns:
             Dict con le configurazioni risolte ricorsivamente per quel momento.
-            Se target_setup_name è fornito, contiene almeno quella configurazione.
+            Se target_setup_name è fornito, contiene solo quella configurazione (se risolta).
         """
         # Assicurati che la cache sia caricata
-        if not self._memory_cache['loaded']:
-            self._load_all_to_memory()
+        self._ensure_loaded()
         
         if visited is None:
             visited = set()
@@ -307,119 +963,15 @@ class ConfigDatabase:
             visited.add(target_setup_name)
         
         current_day = target_datetime.weekday()
-        current_time = target_datetime.hour + target_datetime.minute / 60.0
+        current_minute = target_datetime.hour * 60 + target_datetime.minute
         
         # Raccogli le configurazioni rilevanti (filtrate per target se specificato)
-        relevant_configs = self._get_relevant_configs_for_target(target_setup_name, target_datetime, current_day, current_time)
-        
-        all_active_configs = relevant_configs
+        # Unico passaggio: ogni regola a tempo/orario/standard viene valutata una sola volta
+        all_active_configs = self._get_relevant_configs_for_target(target_setup_name, target_datetime, current_day, current_minute)
         
         # Configurazioni condizionali (valutate ricorsivamente) - DA CACHE IN-MEMORY
-        conditional_configs = [row for row in self._memory_cache['configurazioni_condizionali'] if row['enabled']]
-        
-        # Se abbiamo un target specifico, filtra solo i condizionali rilevanti
-        if target_setup_name:
-            conditional_configs = [row for row in conditional_configs if row['setup_name'] == target_setup_name]
-        
-        # Configurazioni a tempo attive - FILTRA DA CACHE IN-MEMORY
-        for row in self._memory_cache['configurazioni_a_tempo']:
-            if not row['enabled']:
-                continue
-            
-            # Verifica validità temporale
-            valid_from = self._to_local_datetime(row['valid_from_date'])
-            valid_to = self._to_local_datetime(row['valid_to_date'])
-            if not (valid_from <= target_datetime < valid_to):
-                continue
-            
-            # Verifica filtri opzionali orari
-            if row['valid_from_ora'] is not None and row['valid_to_ora'] is not None:
-                valid_from = row['valid_from_ora']
-                valid_to = row['valid_to_ora']
-                
-                is_valid_time = False
-                # Caso speciale: se from == to significa 24 ore (sempre attivo)
-                if valid_from == valid_to:
-                    is_valid_time = True
-                elif valid_to < valid_from:  # Attraversa la mezzanotte
-                    is_valid_time = (current_time >= valid_from or current_time < valid_to)
-                else:
-                    is_valid_time = (valid_from <= current_time < valid_to)
-                
-                if not is_valid_time:
-                    continue
-            
-            # Verifica filtri opzionali giorni
-            if row['days_of_week'] is not None:
-                valid_days = [int(d) for d in row['days_of_week'].split(',') if d]
-                if current_day not in valid_days:
-                    continue
-            
-            _LOGGER.debug(f"[TIME_CONFIG] Adding time config {row['setup_name']} (id={row['id']}) at {target_datetime} with valid_from_ora={row['valid_from_ora']}, valid_to_ora={row['valid_to_ora']}")
-            
-            all_active_configs.append({
-                'setup_name': row['setup_name'],
-                'value': row['setup_value'],
-                'priority': row['priority'],
-                'source': 'time',
-                'source_order': 1,
-                'id': row['id']
-            })
-        
-        # Configurazioni a orario attive - FILTRA DA CACHE IN-MEMORY
-        for row in self._memory_cache['configurazioni_a_orario']:
-            if not row['enabled']:
-                continue
-            days_of_week = row['days_of_week'] if row['days_of_week'] else '0,1,2,3,4,5,6'
-            if isinstance(days_of_week, list):
-                valid_days = days_of_week
-            else:
-                valid_days = [int(d) for d in str(days_of_week).split(',') if d.strip()]
-            
-            valid_from = row['valid_from_ora']
-            valid_to = row['valid_to_ora']
-            
-            # Verifica validità oraria
-            is_valid = False
-            # Caso speciale: se from == to significa 24 ore (sempre attivo, ma filtrare per giorni)
-            if valid_from == valid_to:
-                # All-day schedule (0.0-0.0): match only on specified days
-                is_valid = current_day in valid_days
-            elif valid_to < valid_from:  # Attraversa la mezzanotte
-                is_valid = (current_time >= valid_from or current_time <= valid_to) and current_day in valid_days
-            else:
-                # Usa intervallo semi-aperto [from, to) per evitare overlap al minuto di confine
-                is_valid = (valid_from <= current_time < valid_to) and current_day in valid_days
-            
-            if is_valid:
-                all_active_configs.append({
-                    'setup_name': row['setup_name'],
-                    'value': row['setup_value'],
-                    'priority': row['priority'],
-                    'source': 'schedule',
-                    'source_order': 2,
-                    'id': row['id']
-                })
-        
-        # Configurazioni standard (sempre attive) - DA CACHE IN-MEMORY
-        for row in self._memory_cache['configurazioni']:
-            if not row['enabled']:
-                continue
-            all_active_configs.append({
-                'setup_name': row['setup_name'],
-                'value': row['setup_value'],
-                'priority': row['priority'],
-                'source': 'standard',
-                'source_order': 3,
-                'id': row['id']
-            })
-        
-        # Configurazioni condizionali (valutate ricorsivamente) - DA CACHE IN-MEMORY
-        conditional_configs = [row for row in self._memory_cache['configurazioni_condizionali'] if row['enabled']]
-        
-        # Se abbiamo un target specifico, filtra solo i condizionali rilevanti
-        if target_setup_name:
-            conditional_configs = [row for row in conditional_configs if row['setup_name'] == target_setup_name]
+        # Se abbiamo un target specifico, l'indice per nome restituisce solo i condizionali rilevanti
+        conditional_configs = [rule for rule in self._get_compiled_rules('configurazioni_condizionali', target_setup_name or None) if rule.enabled]
         
         # NUOVA LOGICA: Valutazione ricorsiva dei condizionali
         # Invece di valutare tutti i condizionali insieme, per ogni condizionale
@@ -427,53 +979,36 @@ class ConfigDatabase:
         # della configurazione da cui dipende
         
         evaluated_conditionals = []
-        for row in conditional_configs:
-            dependent_config_name = row['conditional_config']
-            dependent_configs = self._get_configurations_at_time(
-                target_datetime,
-                target_setup_name=dependent_config_name,
-                visited=visited
-            )
+        for rule in conditional_configs:
+            # Verifica filtro orario se presente (prima della risoluzione ricorsiva, più costosa)
+            if not rule.in_window(current_minute):
+                continue
+            
+            dependent_config_name = rule.conditional_config
+            dependent_config = self._resolve_dependency(target_datetime, dependent_config_name, visited)
             
-            if dependent_config_name not in dependent_configs:
+            if dependent_config is None:
                 continue
                 
-            dependent_value = dependent_configs[dependent_config_name]['value']
+            dependent_value = dependent_config['value']
             
-            operator = row['conditional_operator']
-            expected_value = row['conditional_value']
+            operator = rule.conditional_operator
+            expected_value = rule.conditional_value
             condition_met = self._evaluate_condition(dependent_value, operator, expected_value)
             
             if not condition_met:
                 continue
             
-            # Verifica filtro orario se presente
-            if row['valid_from_ora'] is not None and row['valid_to_ora'] is not None:
-                valid_from = row['valid_from_ora']
-                valid_to = row['valid_to_ora']
-                
-                is_valid_time = False
-                # Caso speciale: se from == to significa 24 ore (sempre attivo)
-                if valid_from == valid_to:
-                    is_valid_time = True
-                elif valid_to < valid_from:  # Attraversa la mezzanotte
-                    is_valid_time = (current_time >= valid_from or current_time < valid_to)
-                else:
-                    is_valid_time = (valid_from <= current_time < valid_to)
-                
-                if not is_valid_time:
-                    continue
-            
             evaluated_conditionals.append({
-                'setup_name': row['setup_name'],
-                'value': row['setup_value'],
-                'priority': row['priority'],
-                'source': 'conditional',
-                'source_order': 2,
+                'setup_name': rule.setup_name,
+                'value': rule.value,
+                'priority': rule.priority,
+                'source': rule.source,
+                'source_order': rule.source_order,
                 'conditional_config': dependent_config_name,
                 'conditional_operator': operator,
                 'conditional_value': expected_value,
-                'id': row['id']
+                'id': rule.id
             })
         
         # Aggiungi i condizionali valutati
@@ -494,361 +1029,408 @@ class ConfigDatabase:
                     'id': config['id']
                 }
         
+        if target_setup_name is None:
+            # Il calcolo completo risolve ogni setup_name: popola il memo dell'istante
+            # così le risoluzioni mirate successive allo stesso istante sono gratuite
+            memo = self._get_resolution_memo(target_datetime)
+            for name in self._memory_cache['compiled_by_name']:
+                memo.setdefault(name, result.get(name))
+        
         return result
 
-    def _get_relevant_configs_for_target(self, target_setup_name: Optional[str], target_datetime: datetime, current_day: int, current_time: float) -> List[Dict[str, Any]]:
+    def _get_resolution_memo(self, target_datetime: datetime) -> Dict[str, Optional[Dict[str, Any]]]:
+        """Memo delle risoluzioni per (timestamp, config_version), distinto per thread.
+        
+        Tiene una sola chiave alla volta: le timeline e la simulazione risolvono
+        gli istanti in sequenza, quindi cambiare istante azzera il memo.
+        """
+        key = (target_datetime, self._memory_cache['config_version'])
+        local = self._local
+        if getattr(local, 'memo_key', None) != key:
+            local.memo_key = key
+            local.memo = {}
+        return local.memo
+    
+    def _resolve_dependency(self, target_datetime: datetime, setup_name: str, visited: set) -> Optional[Dict[str, Any]]:
+        """Risolve una dipendenza condizionale usando il memo dell'istante.
+        
+        In un grafo a diamante (molti condizionali che dipendono dagli stessi
+        setup "modalità") ogni dipendenza viene risolta una sola volta per istante.
+        Il risultato non dipende da visited perché i cicli sono rifiutati in scrittura.
+        """
+        memo = self._get_resolution_memo(target_datetime)
+        if setup_name in memo:
+            return memo[setup_name]
+        config = self._get_configurations_at_time(target_datetime, setup_name, visited).get(setup_name)
+        # Un ciclo (warning e risultato vuoto nel resolver) dipende dal percorso: non memorizzarlo
+        if setup_name not in visited:
+            memo[setup_name] = config
+        return config
+    
+    def _get_relevant_configs_for_target(self, target_setup_name: Optional[str], target_datetime: datetime, current_day: int, current_minute: int) -> List[Dict[str, Any]]:
         """Raccoglie le configurazioni rilevanti.
         
         Args:
             target_setup_name: Se specificato, filtra solo per questo setup.
-                             Se None, raccoglie tutte le configurazioni attive (comportamento legacy).
+                             Se None, raccoglie tutte le configurazioni attive.
+            target_datetime: Momento da valutare (aware, fuso locale)
+            current_day: Giorno della settimana di target_datetime (0=lunedì)
+            current_minute: Minuti dalla mezzanotte di target_datetime
         
         Include:
         - Configurazioni standard (per il target o tutte)
         - Configurazioni a orario (per il target o tutte)
         - Configurazioni a tempo (per il target o tutte)
         - NON include condizionali (gestiti separatamente con logica ricorsiva)
+        
+        Lavora sulle regole compilate: nessun parsing di date, orari o giorni qui.
         """
         relevant_configs = []
         
-        # Configurazioni a tempo attive - FILTRA DA CACHE IN-MEMORY
-        for row in self._memory_cache['configurazioni_a_tempo']:
-            if not row['enabled']:
-                continue
-            # Se target_setup_name è specificato, filtra solo quel setup
-            if target_setup_name and row['setup_name'] != target_setup_name:
-                continue
-            
-            # Verifica validità temporale
-            valid_from = self._to_local_datetime(row['valid_from_date'])
-            valid_to = self._to_local_datetime(row['valid_to_date'])
-            # Usa < valid_to per rendere l'orario di fine esclusivo (scheduling standard)
-            if not (valid_from <= target_datetime < valid_to):
-                continue
-            
-            # Verifica filtri opzionali orari
-            if row['valid_from_ora'] is not None and row['valid_to_ora'] is not None:
-                valid_from = row['valid_from_ora']
-                valid_to = row['valid_to_ora']
-                
-                is_valid_time = False
-                # Caso speciale: se from == to significa 24 ore (sempre attivo)
-                if valid_from == valid_to:
-                    is_valid_time = True
-                elif valid_to < valid_from:  # Attraversa la mezzanotte
-                    is_valid_time = (current_time >= valid_from or current_time < valid_to)
-                else:
-                    is_valid_time = (valid_from <= current_time < valid_to)
-                
-                if not is_valid_time:
-                    continue
-            
-            # Verifica filtri opzionali giorni
-            if row['days_of_week'] is not None:
-                if isinstance(row['days_of_week'], list):
-                    valid_days = row['days_of_week']
-                else:
-                    valid_days = [int(d) for d in str(row['days_of_week']).split(',') if d.strip()]
-                if current_day not in valid_days:
-                    continue
-            
-            relevant_configs.append({
-                'setup_name': row['setup_name'],
-                'value': row['setup_value'],
-                'priority': row['priority'],
-                'source': 'time',
-                'source_order': 0,
-                'id': row['id']
-            })
+        # Con target_setup_name l'indice per nome restituisce solo le regole di quel setup
+        target_setup_name = target_setup_name or None
         
-        # Configurazioni a orario attive - FILTRA DA CACHE IN-MEMORY
-        for row in self._memory_cache['configurazioni_a_orario']:
-            if not row['enabled']:
-                continue
-            # Se target_setup_name è specificato, filtra solo quel setup
-            if target_setup_name and row['setup_name'] != target_setup_name:
-                continue
-            
-            # Forza parsing days_of_week
-            days_raw = row['days_of_week']
-            if days_raw is not None:
-                if isinstance(days_raw, list):
-                    valid_days = [int(d) for d in days_raw]
-                else:
-                    valid_days = [int(d) for d in str(days_raw).split(',') if d.strip()]
-            else:
-                valid_days = [0, 1, 2, 3, 4, 5, 6]
-            # Forza parsing orari
-            try:
-                valid_from = float(row['valid_from_ora'])
-                valid_to = float(row['valid_to_ora'])
-            except (ValueError, TypeError):
-                continue
-            # LOGICA v2.1: gestione fasce che attraversano la mezzanotte
-            is_valid = False
-            if valid_from == valid_to:
-                # All-day schedule (0.0-0.0): match only on specified days
-                is_valid = current_day in valid_days
-            elif valid_to < valid_from:  # Attraversa la mezzanotte
-                # Se l'orario è dopo valid_from, il giorno deve essere quello della fascia
-                if current_time >= valid_from and current_day in valid_days:
-                    is_valid = True
-                # Se l'orario è prima di valid_to, il giorno deve essere quello successivo della fascia
-                elif current_time < valid_to and ((current_day - 1) % 7) in valid_days:
-                    is_valid = True
-            else:
-                is_valid = (current_time >= valid_from and current_time < valid_to and current_day in valid_days)
-            
-            if is_valid:
+        # Configurazioni a tempo attive (fine esclusiva, fascia oraria e giorni opzionali)
+        for rule in self._get_compiled_rules('configurazioni_a_tempo', target_setup_name):
+            if rule.enabled and rule.is_active(target_datetime, current_minute, current_day):
                 relevant_configs.append({
-                    'setup_name': row['setup_name'],
-                    'value': row['setup_value'],
-                    'priority': row['priority'],
-                    'source': 'schedule',
-                    'source_order': 1,
-                    'id': row['id']
+                    'setup_name': rule.setup_name,
+                    'value': rule.value,
+                    'priority': rule.priority,
+                    'source': rule.source,
+                    'source_order': rule.source_order,
+                    'id': rule.id
                 })
         
-        # Configurazioni standard (sempre attive) - DA CACHE IN-MEMORY
-        for row in self._memory_cache['configurazioni']:
-            if not row['enabled']:
-                continue
-            # Se target_setup_name è specificato, filtra solo quel setup
-            if target_setup_name and row['setup_name'] != target_setup_name:
-                continue
-                
-            relevant_configs.append({
-                'setup_name': row['setup_name'],
-                'value': row['setup_value'],
-                'priority': row['priority'],
-                'source': 'standard',
-                'source_order': 3,
-                'id': row['id']
-            })
+        # Configurazioni a orario attive (LOGICA v2.1 per le fasce che attraversano la mezzanotte)
+        for rule in self._get_compiled_rules('configurazioni_a_orario', target_setup_name):
+            if rule.enabled and rule.is_active(current_minute, current_day):
+                relevant_configs.append({
+                    'setup_name': rule.setup_name,
+                    'value': rule.value,
+                    'priority': rule.priority,
+                    'source': rule.source,
+                    'source_order': rule.source_order,
+                    'id': rule.id
+                })
+        
+        # Configurazioni standard (sempre attive)
+        for rule in self._get_compiled_rules('configurazioni', target_setup_name):
+            if rule.enabled:
+                relevant_configs.append({
+                    'setup_name': rule.setup_name,
+                    'value': rule.value,
+                    'priority': rule.priority,
+                    'source': rule.source,
+                    'source_order': rule.source_order,
+                    'id': rule.id
+                })
         
         return relevant_configs
     
-    def _invalidate_caches(self):
-        """Invalida tutte le cache dopo modifiche alle configurazioni.
+    def _invalidate_caches(self, setup_names: Optional[set] = None):
+        """Invalida le cache dopo modifiche alle configurazioni.
         
         Chiamato automaticamente da tutti i metodi che modificano le configurazioni
         (set_config, set_time_config, delete_config, etc.) per garantire che
         tutte le cache siano sincronizzate con il database.
         
+        Senza setup_names (es. dopo un ripristino) ricarica tutto da DB e svuota
+        tutte le cache. Con setup_names la cache in-memory è già stata aggiornata
+        col delta (_sync_cache_rows) e vengono invalidate solo le cache dei nomi
+        toccati e dei loro dipendenti transitivi.
+        
         Invalida:
         - Cache dei prossimi cambiamenti (next_changes_cache)
-        - Cache degli event times (event_times_cache)
-        - Cache in-memory di tutte le configurazioni
-        - Incrementa config_version per tracciare modifiche
+        - Timeline compilate per setup_name (timeline_cache)
+        - Incrementa config_version (e la versione dei nomi coinvolti) per tracciare modifiche
+        
+        Infine pubblica lo snapshot: regole e versioni diventano visibili ai lettori
+        insieme, con un solo assegnamento.
+        
+        Args:
+            setup_names: setup_name modificati (None = invalidazione completa)
         """
-        self._next_changes_cache.clear()
-        self._event_times_cache.clear()
-        self._event_times_config_version = None
-        self._event_times_generation_start = None
-        self._event_times_generation_end = None
-        self._config_version += 1
-        
-        # Ricarica la cache in-memory dopo modifiche (mantiene tutto sincronizzato)
-        self._load_all_to_memory()
-        _LOGGER.debug(f"Tutte le cache invalidate e ricaricate (config_version: {self._config_version})")
+        if self._batch_depth:
+            # Sessione batch(): accumula, l'invalidazione avviene una sola volta all'uscita
+            if setup_names is None:
+                self._batch_full_reload = True
+            else:
+                self._batch_names.update(setup_names)
+            return
+        
+        cache = self._writable_cache()
+        cache['config_version'] += 1
+        version = cache['config_version']
+        
+        if setup_names is None:
+            self._next_changes_cache.clear()
+            self._timeline_cache.clear()
+            # Ricarica la cache in-memory (es. database sostituito da un ripristino)
+            self._load_all_to_memory()
+            cache['name_versions'] = {}
+            cache['full_reload_version'] = version
+            affected = None
+        else:
+            affected = self._get_transitive_dependents(setup_names)
+            for name in affected:
+                cache['name_versions'][name] = version
+            # Le voci sono marcate con la versione del nome: rimuoverle libera solo memoria,
+            # una voce reinserita da un lettore sullo snapshot precedente non verrà usata
+            for key in list(self._next_changes_cache):
+                if key[0] in affected:
+                    self._next_changes_cache.pop(key, None)
+            for name in affected:
+                self._timeline_cache.pop(name, None)
+        
+        self._publish_snapshot()
+        
+        if affected is None:
+            _LOGGER.debug(f"Tutte le cache invalidate e ricaricate (config_version: {version})")
+        else:
+            _LOGGER.debug(f"Cache invalidate per {sorted(affected)} (config_version: {version})")
+        
+        self._notify_listeners(setup_names, affected)
     
-    def _get_all_event_times(self, min_end_time: Optional[datetime] = None) -> set:
-        """Ottiene tutti i timestamp eventi possibili dalle configurazioni abilitate.
+    @contextmanager
+    def batch(self) -> Iterator['ConfigDatabase']:
+        """Sessione di scrittura con commit e invalidazione differiti.
+        
+        Dentro ``with db.batch():`` i metodi di scrittura aggiornano subito la cache
+        in-memory, così i controlli di priorità e di dipendenze circolari vedono le
+        modifiche pendenti, ma non fanno commit né invalidano le cache derivate:
+        all'uscita vengono eseguiti un solo commit e una sola invalidazione (con una
+        sola notifica ai sottoscrittori). Se il blocco solleva un'eccezione tutte le
+        modifiche vengono annullate insieme alla copia di lavoro della cache: i
+        lettori non hanno mai visto le righe annullate.
+        Le sessioni annidate confluiscono in quella più esterna.
+        
+        Va usata nel thread di scrittura: dall'esterno eseguire il blocco in una
+        funzione passata a run_write.
+        """
+        if threading.get_ident() != self._writer_ident:
+            raise RuntimeError("batch() va usato nel thread di scrittura (vedi run_write)")
+        self._batch_depth += 1
+        try:
+            yield self
+        except BaseException:
+            self._batch_depth -= 1
+            if not self._batch_depth:
+                self._batch_names = set()
+                self._batch_full_reload = False
+                self._batch_history_trimmed = 0
+                self._changed_rule_ids = {}
+                self.conn.rollback()
+                # Lo snapshot pubblicato corrisponde ancora al DB: basta scartare la copia di lavoro
+                self._local.snapshot = None
+            raise
+        else:
+            self._batch_depth -= 1
+            if not self._batch_depth:
+                names, full_reload = self._batch_names, self._batch_full_reload
+                self._batch_names = set()
+                self._batch_full_reload = False
+                self.conn.commit()
+                self._commit_unpublished = True
+                self._history_inserts = max(0, self._history_inserts - self._batch_history_trimmed)
+                self._batch_history_trimmed = 0
+                if full_reload:
+                    self._invalidate_caches()
+                elif names:
+                    self._invalidate_caches(names)
+    
+    def _commit(self) -> None:
+        """Commit della transazione corrente, differito all'uscita se è attiva una sessione batch()."""
+        if not self._batch_depth:
+            self.conn.commit()
+            self._commit_unpublished = True
+    
+    def subscribe(self, listener: Callable[[Dict[str, Any]], None]) -> Callable[[], None]:
+        """Registra una funzione chiamata ad ogni modifica delle configurazioni.
         
-        Usa cache per evitare ricalcoli quando le configurazioni non cambiano, ma
-        rigenera automaticamente quando l'orizzonte temporale è scaduto o non copre
-        il periodo richiesto.
+        Il listener riceve un dict con:
+        - 'setup_names': setup_name modificati direttamente (None = ricaricamento completo)
+        - 'affected': setup_name modificati più i loro dipendenti transitivi (None = tutti)
+        - 'rule_ids': {tabella: [id delle regole inserite, modificate o eliminate]}
+        - 'config_version': config_version dopo la modifica
         
-        Args:
-            min_end_time: opzionale, richiede che la cache copra almeno fino a questo timestamp
+        Viene chiamato nel thread di scrittura, dopo la pubblicazione dello snapshot:
+        chi deve lavorare nell'event loop deve rimandarvi la notifica.
         
         Returns:
-            Set di datetime con tutti i possibili timestamp di cambiamento
+            Funzione che annulla la sottoscrizione
+        """
+        self._listeners.append(listener)
+        
+        def unsubscribe() -> None:
+            if listener in self._listeners:
+                self._listeners.remove(listener)
+        
+        return unsubscribe
+    
+    def _notify_listeners(self, setup_names: Optional[set], affected: Optional[set]) -> None:
+        """Pubblica l'evento di modifica ai sottoscrittori e azzera gli id accumulati."""
+        rule_ids = {table: sorted(ids) for table, ids in self._changed_rule_ids.items()}
+        self._changed_rule_ids = {}
+        if not self._listeners:
+            return
+        event = {
+            'setup_names': None if setup_names is None else sorted(setup_names),
+            'affected': None if affected is None else sorted(affected),
+            'rule_ids': rule_ids,
+            'config_version': self._memory_cache['config_version'],
+        }
+        for listener in list(self._listeners):
+            try:
+                listener(event)
+            except Exception as e:
+                _LOGGER.error(f"Errore nel listener delle modifiche: {e}")
+    
+    def _get_transitive_dependencies(self, setup_name: str) -> set:
+        """Restituisce setup_name più tutti i setup da cui dipende tramite condizionali abilitati."""
+        dependencies = {setup_name}
+        frontier = [setup_name]
+        while frontier:
+            name = frontier.pop()
+            for rule in self._get_compiled_rules('configurazioni_condizionali', name):
+                if rule.enabled and rule.conditional_config not in dependencies:
+                    dependencies.add(rule.conditional_config)
+                    frontier.append(rule.conditional_config)
+        return dependencies
+    
+    def _iter_event_times(self, after: datetime, setup_name: Optional[str] = None) -> Iterator[datetime]:
+        """Genera in ordine, senza duplicati, gli istanti > after in cui una regola abilitata
+        può cambiare attivazione.
+        
+        Ogni regola compilata fornisce un generatore pigro dei propri confini
+        ("prossimo confine dopo t"); heapq.merge li fonde in un unico flusso ordinato.
+        Il costo è proporzionale agli eventi effettivamente consumati, non a
+        regole × giorni: chi si ferma dopo N cambiamenti non genera il resto.
+        
+        Args:
+            setup_name: Se fornito, considera solo le regole del setup e delle sue
+                        dipendenze condizionali transitive: le altre non possono
+                        cambiarne il valore
+        """
+        self._ensure_loaded()
+        
+        event_tables = ('configurazioni_a_tempo', 'configurazioni_a_orario', 'configurazioni_condizionali')
+        if setup_name is None:
+            rules = [rule for table in event_tables for rule in self._get_compiled_rules(table)]
+        else:
+            rules = [
+                rule
+                for name in self._get_transitive_dependencies(setup_name)
+                for table in event_tables
+                for rule in self._get_compiled_rules(table, name)
+            ]
+        streams = [rule.boundaries(after) for rule in rules if rule.enabled]
+        last = None
+        for event_time in heapq.merge(*streams):
+            if event_time != last:
+                last = event_time
+                yield event_time
+    
+    def _iter_event_owners(self, after: datetime) -> Iterator[tuple]:
+        """Come _iter_event_times su tutte le regole, ma restituisce (istante, setup_name delle
+        regole che hanno un confine in quell'istante)."""
+        self._ensure_loaded()
+        
+        def tagged(rule):
+            for event_time in rule.boundaries(after):
+                yield event_time, rule.setup_name
+        
+        streams = [
+            tagged(rule)
+            for table in ('configurazioni_a_tempo', 'configurazioni_a_orario', 'configurazioni_condizionali')
+            for rule in self._get_compiled_rules(table)
+            if rule.enabled
+        ]
+        current_time = None
+        owners = set()
+        for event_time, setup_name in heapq.merge(*streams, key=lambda item: item[0]):
+            if event_time != current_time:
+                if owners:
+                    yield current_time, owners
+                current_time = event_time
+                owners = set()
+            owners.add(setup_name)
+        if owners:
+            yield current_time, owners
+    
+    def _resolve_state(self, setup_name: str, when: datetime) -> Optional[Dict[str, Any]]:
+        """Stato vincente di un setup_name ad un istante ({'value', 'source', 'priority', 'id'})."""
+        memo = self._get_resolution_memo(when)
+        if setup_name in memo:
+            config = memo[setup_name]
+        else:
+            config = self._get_configurations_at_time(when, target_setup_name=setup_name).get(setup_name)
+            self._get_resolution_memo(when)[setup_name] = config
+        if config is None:
+            return None
+        return {
+            'value': config['value'],
+            'source': config['source'],
+            'priority': config['priority'],
+            'id': config['id']
+        }
+    
+    def _get_timeline(self, setup_name: str, start: datetime, end: datetime, force: bool = False) -> Timeline:
+        """Restituisce la timeline compilata di un setup_name che copre [start, end].
+        
+        La timeline viene creata una volta per versione del setup_name e riusata da
+        get_next_changes e dalla simulazione: gli eventi vengono risolti pigramente,
+        solo fin dove le query arrivano. L'orizzonte scorre invece di essere
+        rigenerato: se la richiesta va oltre, la timeline esistente viene estesa
+        (i nuovi giorni si risolvono su richiesta) e il prefisso precedente alla
+        mezzanotte di oggi viene scartato. Se va ricreata, copre almeno da
+        mezzanotte di oggi a now + timeline_horizon_days.
+        
+        Va chiamato da un metodo @_uses_timelines: la timeline restituita viene
+        estesa pigramente da chi la interroga.
+        
+        Args:
+            force: Ricostruisce partendo esattamente da `start`, ignorando la cache
         """
-        # Assicurati che la cache in-memory sia caricata (può essere vuota subito dopo lo startup)
-        if not self._memory_cache['loaded']:
-            if self.conn is None:
-                self.conn = self._open_database()
-            self._load_all_to_memory()
-
-        MAX_DAYS = 30
         now = dt_util.now()
-        horizon_end = now + timedelta(days=MAX_DAYS)
-
-        def cache_valid() -> bool:
-            valid = (
-                self._event_times_config_version == self._config_version
-                and self._event_times_cache
-                and self._event_times_generation_start is not None
-                and self._event_times_generation_end is not None
-                and now < self._event_times_generation_end
-                and (min_end_time is None or self._event_times_generation_end >= min_end_time)
-            )
-            if not valid and self._event_times_cache:
-                # Log motivo invalidazione cache per debugging
-                if self._event_times_config_version != self._config_version:
-                    _LOGGER.debug(f"[EVENT_TIMES] Cache stale: config_version changed {self._event_times_config_version} -> {self._config_version}")
-                elif now >= self._event_times_generation_end:
-                    _LOGGER.info(f"[EVENT_TIMES] Cache expired: now={now} >= horizon_end={self._event_times_generation_end}")
-                elif min_end_time and self._event_times_generation_end < min_end_time:
-                    _LOGGER.debug(f"[EVENT_TIMES] Cache insufficient: horizon_end={self._event_times_generation_end} < required={min_end_time}")
-            return valid
-
-        if cache_valid():
-            return self._event_times_cache
-
-        # Cache non valida: rigenera (senza lock)
-        event_times = set()
-
-        # Eventi da configurazioni a tempo
-        time_config_count = 0
-        for row in self._memory_cache['configurazioni_a_tempo']:
-            if not row['enabled']: continue
-            time_config_count += 1
-            valid_from = self._to_local_datetime(row['valid_from_date'])
-            valid_to = self._to_local_datetime(row['valid_to_date']) if row['valid_to_date'] else None
-
-            event_times.add(valid_from)
-            if valid_to:
-                event_times.add(valid_to)
-            
-            # Se ha filtri orari, genera eventi giornalieri di inizio e fine durante il periodo di validità
-            if row['valid_from_ora'] is not None and row['valid_to_ora'] is not None:
-                try:
-                    # valid_from_ora e valid_to_ora sono float (es. 18.5 per 18:30)
-                    from_decimal = row['valid_from_ora']
-                    to_decimal = row['valid_to_ora']
-                    
-                    from_hour = int(from_decimal)
-                    from_min = int((from_decimal - from_hour) * 60)
-                    start_time = time(from_hour, from_min)
-                    
-                    to_hour = int(to_decimal)
-                    to_min = int((to_decimal - to_hour) * 60)
-                    end_time = time(to_hour, to_min)
-                    
-                    current_day = valid_from
-                    end_day = valid_to or (now + timedelta(days=MAX_DAYS))
-                    while current_day <= end_day:
-                        # Verifica filtri giorni se presenti
-                        should_generate = True
-                        if row['days_of_week'] is not None:
-                            if isinstance(row['days_of_week'], list):
-                                valid_days = row['days_of_week']
-                            else:
-                                valid_days = [int(d) for d in str(row['days_of_week']).split(',') if d.strip()]
-                            if current_day.weekday() not in valid_days:
-                                should_generate = False
-                        
-                        if should_generate:
-                            start_dt = dt_util.as_local(datetime.combine(current_day.date(), start_time))
-                            if to_decimal < from_decimal:  # Attraversa la mezzanotte
-                                end_dt = dt_util.as_local(datetime.combine(current_day.date() + timedelta(days=1), end_time))
-                            else:
-                                end_dt = dt_util.as_local(datetime.combine(current_day.date(), end_time))
-                            event_times.add(start_dt)
-                            event_times.add(end_dt)
-                        current_day += timedelta(days=1)
-                except (ValueError, TypeError):
-                    # Se il formato ora non è valido, ignora
-                    pass
-
-        # Eventi da configurazioni a orario (calcola per i prossimi 30 giorni)
-        for row in self._memory_cache['configurazioni_a_orario']:
-            if not row['enabled']: continue
-            if row['days_of_week'] is not None:
-                if isinstance(row['days_of_week'], list):
-                    days_list = row['days_of_week']
-                else:
-                    days_list = [int(d) for d in str(row['days_of_week']).split(',') if d.strip()]
-            else:
-                days_list = [0, 1, 2, 3, 4, 5, 6]
-
-            events_generated = 0
-            last_was_matching = False
-            for day_offset in range(MAX_DAYS):
-                check_date = now + timedelta(days=day_offset)
-                weekday = check_date.weekday()
-
-                if weekday in days_list:
-                    from_decimal = row['valid_from_ora']
-                    to_decimal = row['valid_to_ora']
-
-                    from_hour = int(from_decimal)
-                    from_min = int((from_decimal - from_hour) * 60)
-                    event_from = check_date.replace(hour=from_hour, minute=from_min, second=0, microsecond=0)
-
-                    to_hour = int(to_decimal)
-                    to_min = int((to_decimal - to_hour) * 60)
-
-                    if to_decimal < from_decimal:  # Attraversa la mezzanotte
-                        event_to = (check_date + timedelta(days=1)).replace(hour=to_hour, minute=to_min, second=0, microsecond=0)
-                    else:
-                        event_to = check_date.replace(hour=to_hour, minute=to_min, second=0, microsecond=0)
-
-                    event_times.add(event_from)
-                    event_times.add(event_to)
-                    events_generated += 2
-                    last_was_matching = True
-                else:
-                    # Se il giorno precedente era abilitato ma questo no, aggiungi evento a mezzanotte
-                    if last_was_matching:
-                        boundary_event = check_date.replace(hour=0, minute=0, second=0, microsecond=0)
-                        event_times.add(boundary_event)
-                        events_generated += 1
-                        last_was_matching = False
-
-        conditional_config_count = 0
-        for row in self._memory_cache['configurazioni_condizionali']:
-            if not row['enabled'] or row['valid_from_ora'] is None or row['valid_to_ora'] is None: continue
-            conditional_config_count += 1
-            events_generated = 0
-            for day_offset in range(MAX_DAYS):
-                check_date = now + timedelta(days=day_offset)
-
-                from_decimal = row['valid_from_ora']
-                to_decimal = row['valid_to_ora']
-
-                from_hour = int(from_decimal)
-                from_min = int((from_decimal - from_hour) * 60)
-                event_from = check_date.replace(hour=from_hour, minute=from_min, second=0, microsecond=0)
-
-                to_hour = int(to_decimal)
-                to_min = int((to_decimal - to_hour) * 60)
-
-                if to_decimal < from_decimal:
-                    event_to = (check_date + timedelta(days=1)).replace(hour=to_hour, minute=to_min, second=0, microsecond=0)
-                else:
-                    event_to = check_date.replace(hour=to_hour, minute=to_min, second=0, microsecond=0)
-
-                event_times.add(event_from)
-                event_times.add(event_to)
-                events_generated += 2
-
-        # Salva in cache
-        self._event_times_cache = event_times
-        self._event_times_config_version = self._config_version
-        self._event_times_generation_start = now
-        self._event_times_generation_end = horizon_end
-        _LOGGER.info(f"[EVENT_TIMES] Regenerated cache: {len(event_times)} events from {now} to {horizon_end} (time_configs={time_config_count}, conditional_configs={conditional_config_count})")
-        return self._event_times_cache
-
+        today = now.replace(hour=0, minute=0, second=0, microsecond=0)
+        build_end = max(end, now + timedelta(days=self.timeline_horizon_days))
+        version = self.get_config_version(setup_name)
+        
+        cached_version, cached = self._timeline_cache.get(setup_name, (None, None))
+        if cached_version != version:
+            # Costruita su uno snapshot diverso da quello in uso: non riutilizzabile
+            cached = None
+        if not force and cached is not None and cached.start <= start:
+            if not cached.covers(start, end):
+                cached.extend_horizon(build_end)
+            cached.trim(min(start, today))
+            return cached
+        
+        build_start = start if force else min(start, today)
+        
+        timeline = Timeline(
+            setup_name, build_start, build_end, self._iter_event_times(build_start, setup_name),
+            lambda when: self._resolve_state(setup_name, when)
+        )
+        self._timeline_cache[setup_name] = (version, timeline)
+        _LOGGER.debug(f"[TIMELINE] {setup_name}: timeline creata ({build_start} -> {build_end})")
+        return timeline
     
     def _check_priority_conflict(self, setup_name: str, priority: int, exclude_id: int = None) -> bool:
-        """Verifica se esiste già una configurazione standard con la stessa priorità per questo nome."""
-        cursor = self.conn.cursor()
-        if exclude_id:
-            cursor.execute("""
-                SELECT id FROM configurazioni 
-                WHERE setup_name = ? AND priority = ? AND id != ?
-            """, (setup_name, priority, exclude_id))
-        else:
-            cursor.execute("""
-                SELECT id FROM configurazioni 
-                WHERE setup_name = ? AND priority = ?
-            """, (setup_name, priority))
-        return cursor.fetchone() is not None
+        """Verifica se esiste già una configurazione standard con la stessa priorità per questo nome.
+        
+        Usa la cache in-memory, che include anche le scritture pendenti di una sessione batch().
+        """
+        if not self._memory_cache['loaded']:
+            self._load_all_to_memory()
+        exclude_id = int(exclude_id) if exclude_id else None
+        return any(
+            row['priority'] == priority and row['id'] != exclude_id
+            for row in self._get_rules('configurazioni', setup_name)
+        )
     
+    @_writer
     def set_config(self, setup_name: str, setup_value: str, priority: int = 99, description: str = None) -> None:
         """Imposta una configurazione standard."""
         setup_name = self.validate_setup_name(setup_name)
@@ -871,8 +1453,6 @@ class ConfigDatabase:
                 INSERT OR REPLACE INTO configurazioni_descrizioni (setup_name, description)
                 VALUES (?, ?)
             """, (setup_name, description))
-            # Invalida cache descrizioni
-            self._descriptions_cache = None
         
         # Salva nello storico
         self._save_to_history(
@@ -881,12 +1461,16 @@ class ConfigDatabase:
             'INSERT'
         )
         
-        self.conn.commit()
+        self._commit()
         _LOGGER.debug(f"Set config: {setup_name} = {setup_value} (priority: {priority})")
         
-        # Invalida tutte le cache dopo modifica configurazione
-        self._invalidate_caches()
+        # Aggiorna la cache in-memory col delta e invalida solo i nomi coinvolti
+        touched = self._sync_cache_rows('configurazioni', 'setup_name', setup_name)
+        if description is not None:
+            self._sync_cache_description(setup_name)
+        self._invalidate_caches(touched)
     
+    @_writer
     def update_standard_config(self, config_id: int, setup_value: str, priority: int, description: str = None) -> None:
         """Aggiorna una configurazione standard esistente."""
         cursor = self.conn.cursor()
@@ -916,8 +1500,6 @@ class ConfigDatabase:
                 INSERT OR REPLACE INTO configurazioni_descrizioni (setup_name, description)
                 VALUES (?, ?)
             """, (setup_name, description))
-            # Invalida cache descrizioni
-            self._descriptions_cache = None
         
         # Salva nello storico
         self._save_to_history(
@@ -926,12 +1508,16 @@ class ConfigDatabase:
             'UPDATE'
         )
         
-        self.conn.commit()
+        self._commit()
         _LOGGER.debug(f"Updated config id {config_id}: {setup_name} = {setup_value} (priority: {priority})")
         
-        # Invalida tutte le cache dopo modifica configurazione
-        self._invalidate_caches()
+        # Aggiorna la cache in-memory col delta e invalida solo i nomi coinvolti
+        touched = self._sync_cache_rows('configurazioni', 'id', config_id)
+        if description is not None:
+            self._sync_cache_description(setup_name)
+        self._invalidate_caches(touched)
     
+    @_writer
     def set_time_config(
         self, 
         setup_name: str, 
@@ -956,9 +1542,11 @@ class ConfigDatabase:
         cursor = self.conn.cursor()
         cursor.execute("""
             INSERT INTO configurazioni_a_tempo 
-            (setup_name, setup_value, valid_from_date, valid_to_date, priority, valid_from_ora, valid_to_ora, days_of_week)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-        """, (setup_name, setup_value, valid_from_date, valid_to_date, priority, valid_from_ora, valid_to_ora, days_of_week))
+            (setup_name, setup_value, valid_from_date, valid_to_date, priority, valid_from_ora, valid_to_ora, days_of_week,
+             valid_from_epoch, valid_to_epoch, days_mask)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, (setup_name, setup_value, valid_from_date, valid_to_date, priority, valid_from_ora, valid_to_ora, days_of_week,
+              to_epoch(valid_from_date), to_epoch(valid_to_date), parse_days_mask(days_of_week)))
         
         # Salva nello storico
         self._save_to_history(
@@ -972,12 +1560,13 @@ class ConfigDatabase:
             'INSERT'
         )
         
-        self.conn.commit()
+        self._commit()
         _LOGGER.debug(f"Set time config: {setup_name} = {setup_value} ({valid_from_date} - {valid_to_date})")
         
-        # Invalida tutte le cache dopo modifica configurazione
-        self._invalidate_caches()
+        # Aggiorna la cache in-memory col delta e invalida solo i nomi coinvolti
+        self._invalidate_caches(self._sync_cache_rows('configurazioni_a_tempo', 'setup_name', setup_name))
     
+    @_writer
     def set_schedule_config(
         self, 
         setup_name: str, 
@@ -992,9 +1581,9 @@ class ConfigDatabase:
         cursor = self.conn.cursor()
         cursor.execute("""
             INSERT INTO configurazioni_a_orario 
-            (setup_name, setup_value, valid_from_ora, valid_to_ora, days_of_week, priority)
-            VALUES (?, ?, ?, ?, ?, ?)
-        """, (setup_name, setup_value, valid_from_ora, valid_to_ora, days_of_week, priority))
+            (setup_name, setup_value, valid_from_ora, valid_to_ora, days_of_week, priority, days_mask)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, (setup_name, setup_value, valid_from_ora, valid_to_ora, days_of_week, priority, parse_days_mask(days_of_week)))
         
         # Salva nello storico
         self._save_to_history(
@@ -1008,12 +1597,13 @@ class ConfigDatabase:
             'INSERT'
         )
         
-        self.conn.commit()
+        self._commit()
         _LOGGER.debug(f"Set schedule config: {setup_name} = {setup_value} ({valid_from_ora} - {valid_to_ora}) Days: {days_of_week}")
         
-        # Invalida tutte le cache dopo modifica configurazione
-        self._invalidate_caches()
+        # Aggiorna la cache in-memory col delta e invalida solo i nomi coinvolti
+        self._invalidate_caches(self._sync_cache_rows('configurazioni_a_orario', 'setup_name', setup_name))
     
+    @_writer
     def set_conditional_config(
         self,
         setup_name: str,
@@ -1068,56 +1658,279 @@ class ConfigDatabase:
             'INSERT'
         )
         
-        self.conn.commit()
+        self._commit()
         _LOGGER.debug(f"Set conditional config: {setup_name} = {setup_value} if {conditional_config} {conditional_operator} {conditional_value}")
         
-        # Invalida tutte le cache dopo modifica configurazione
-        self._invalidate_caches()
+        # Aggiorna la cache in-memory col delta e invalida solo i nomi coinvolti
+        self._invalidate_caches(self._sync_cache_rows('configurazioni_condizionali', 'setup_name', setup_name))
     
-    def _check_circular_dependency(self, setup_name: str, conditional_config: str, visited: set = None) -> bool:
-        """Verifica se aggiungere una dipendenza creerebbe un loop ciclico.
+    @_writer
+    def apply_batch(self, rules: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """Inserisce in blocco una lista di regole in un'unica transazione.
         
-        Args:
-            setup_name: Nome della configurazione che stiamo aggiungendo
-            conditional_config: Configurazione da cui dipende
-            visited: Set di configurazioni già visitate (per rilevare cicli)
+        Ogni regola è un dict con 'type' ('standard', 'schedule', 'time', 'conditional')
+        e gli stessi campi dei servizi set_*_config. Le regole vengono validate tutte
+        prima di scrivere (nomi, campi obbligatori, orari tra 0 e 24, giorni tra 0 e 6,
+        conflitti di priorità e dipendenze circolari contro la cache in-memory più le
+        regole del lotto stesso): se una regola non è valida non viene scritto nulla.
+        
+        A differenza delle chiamate singole usa un solo inserimento in blocco nello
+        storico, un solo commit e un solo aggiornamento delle cache (il delta delle
+        righe inserite, come le scritture singole). La pulizia dello storico resta al cleanup giornaliero.
         
         Returns:
-            True se esiste un ciclo, False altrimenti
-        """
-        if visited is None:
-            visited = set()
+            Dict con il numero di regole inserite per tipo e i setup_name coinvolti
         
-        # Se conditional_config punta direttamente a setup_name, è un ciclo diretto
-        if conditional_config == setup_name:
-            return True
+        Raises:
+            ValueError: Se una regola non è valida (con l'indice della regola)
+        """
+        if not self._memory_cache['loaded']:
+            self._load_all_to_memory()
         
-        # Se abbiamo già visitato conditional_config, abbiamo trovato un ciclo
-        if conditional_config in visited:
-            return True
+        rows = {table: [] for table in RULE_TABLES}
+        history = []
+        descriptions = {}
+        standard_priorities = {(row['setup_name'], row['priority']) for row in self._memory_cache['configurazioni']}
+        dependency_edges = []
         
-        visited.add(conditional_config)
+        for index, rule in enumerate(rules):
+            try:
+                config_type = rule.get('type')
+                setup_name = self.validate_setup_name(rule.get('setup_name'))
+                setup_value = rule.get('setup_value')
+                if setup_value is None:
+                    raise ValueError("setup_value obbligatorio")
+                setup_value = str(setup_value)
+                priority = int(rule.get('priority', 99))
+                
+                if config_type == 'standard':
+                    if (setup_name, priority) in standard_priorities:
+                        raise ValueError(f"Esiste già una configurazione '{setup_name}' con priorità {priority}")
+                    standard_priorities.add((setup_name, priority))
+                    rows['configurazioni'].append((setup_name, setup_value, priority))
+                    if rule.get('description') is not None:
+                        descriptions[setup_name] = rule['description']
+                    history.append((setup_name, 'standard', setup_value, priority, None, None, None, None, None, 'INSERT'))
+                
+                elif config_type == 'schedule':
+                    valid_from_ora = self._validate_batch_hour(rule['valid_from_ora'], 'valid_from_ora')
+                    valid_to_ora = self._validate_batch_hour(rule['valid_to_ora'], 'valid_to_ora')
+                    if valid_from_ora is None or valid_to_ora is None:
+                        raise ValueError("valid_from_ora e valid_to_ora obbligatori per le configurazioni a orario")
+                    days_of_week = self._normalize_batch_days(rule.get('days_of_week', '0,1,2,3,4,5,6'))
+                    rows['configurazioni_a_orario'].append(
+                        (setup_name, setup_value, valid_from_ora, valid_to_ora, days_of_week, priority,
+                         parse_days_mask(days_of_week))
+                    )
+                    history.append((setup_name, 'schedule', setup_value, None, valid_from_ora, valid_to_ora, days_of_week, None, None, 'INSERT'))
+                
+                elif config_type == 'time':
+                    valid_from_date = self._normalize_batch_date(rule.get('valid_from', rule.get('valid_from_date')))
+                    valid_to_date = self._normalize_batch_date(rule.get('valid_to', rule.get('valid_to_date')))
+                    valid_from_ora = self._validate_batch_hour(rule.get('valid_from_ora'), 'valid_from_ora')
+                    valid_to_ora = self._validate_batch_hour(rule.get('valid_to_ora'), 'valid_to_ora')
+                    days_of_week = self._normalize_batch_days(rule.get('days_of_week'))
+                    rows['configurazioni_a_tempo'].append(
+                        (setup_name, setup_value, valid_from_date, valid_to_date, priority, valid_from_ora, valid_to_ora, days_of_week,
+                         to_epoch(valid_from_date), to_epoch(valid_to_date), parse_days_mask(days_of_week))
+                    )
+                    history.append((setup_name, 'time', setup_value, priority, None, None, None, valid_from_date, valid_to_date, 'INSERT'))
+                
+                elif config_type == 'conditional':
+                    conditional_config = self.validate_setup_name(rule.get('conditional_config'))
+                    operator = rule.get('conditional_operator')
+                    if operator not in CONDITIONAL_OPERATORS:
+                        raise ValueError(f"Operatore non valido: {operator}")
+                    if setup_name == conditional_config:
+                        raise ValueError("Una configurazione non può dipendere da se stessa")
+                    conditional_value = rule.get('conditional_value')
+                    if conditional_value is None:
+                        raise ValueError("conditional_value obbligatorio")
+                    valid_from_ora = self._validate_batch_hour(rule.get('valid_from_ora'), 'valid_from_ora')
+                    valid_to_ora = self._validate_batch_hour(rule.get('valid_to_ora'), 'valid_to_ora')
+                    dependency_edges.append((index, setup_name, conditional_config))
+                    rows['configurazioni_condizionali'].append(
+                        (setup_name, setup_value, conditional_config, operator, str(conditional_value),
+                         valid_from_ora, valid_to_ora, priority)
+                    )
+                    history.append((setup_name, 'conditional', setup_value, priority, valid_from_ora, valid_to_ora, None, None, None, 'INSERT'))
+                
+                else:
+                    raise ValueError(f"Tipo di configurazione non valido: {config_type}")
+            except (KeyError, TypeError, ValueError) as err:
+                if isinstance(err, KeyError):
+                    err = f"campo obbligatorio mancante {err}"
+                raise ValueError(f"Regola {index}: {err}") from None
+        
+        # Dipendenze circolari: grafo inverso in memoria più gli archi del lotto, nell'ordine del lotto
+        graph = {name: set(dependents) for name, dependents in self._memory_cache['dependents'].items()}
+        for index, setup_name, conditional_config in dependency_edges:
+            if self._is_reachable(graph, setup_name, conditional_config):
+                raise ValueError(
+                    f"Regola {index}: dipendenza ciclica rilevata: '{setup_name}' non può dipendere da "
+                    f"'{conditional_config}' perché creerebbe un loop infinito"
+                )
+            graph.setdefault(conditional_config, set()).add(setup_name)
         
-        # Trova tutte le configurazioni condizionali dove conditional_config è il setup_name
-        # (cioè dove conditional_config a sua volta dipende da altre configurazioni)
         cursor = self.conn.cursor()
-        cursor.row_factory = sqlite3.Row
-        cursor.execute("""
-            SELECT conditional_config FROM configurazioni_condizionali
-            WHERE setup_name = ?
-        """, (conditional_config,))
-        
-        for row in cursor.fetchall():
-            next_dependency = row['conditional_config']
-            # Se questa dipendenza punta a setup_name, abbiamo un ciclo
-            if next_dependency == setup_name:
-                return True
-            # Ricorsivamente controlla le dipendenze
-            if self._check_circular_dependency(setup_name, next_dependency, visited.copy()):
+        new_ids = {}
+        try:
+            for table, columns in BATCH_INSERT_COLUMNS.items():
+                if not rows[table]:
+                    continue
+                placeholders = ', '.join('?' for _ in columns)
+                insert_sql = f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({placeholders})"
+                # Un execute per riga (statement già preparato) per raccogliere gli id inseriti
+                table_ids = new_ids[table] = []
+                for row in rows[table]:
+                    cursor.execute(insert_sql, row)
+                    table_ids.append(cursor.lastrowid)
+            if descriptions:
+                cursor.executemany("""
+                    INSERT OR REPLACE INTO configurazioni_descrizioni (setup_name, description)
+                    VALUES (?, ?)
+                """, list(descriptions.items()))
+            cursor.executemany("""
+                INSERT INTO configurazioni_storico 
+                (setup_name, config_type, setup_value, priority, valid_from_ora, valid_to_ora, 
+                 days_of_week, valid_from_date, valid_to_date, operation)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, history)
+            self._history_inserts += len(history)
+            self._commit()
+        except Exception:
+            # In una sessione batch() l'annullamento spetta alla sessione (come il commit)
+            if not self._batch_depth:
+                self.conn.rollback()
+            raise
+        
+        # Delta della cache in-memory per le sole righe inserite, poi invalidazione mirata
+        touched = set()
+        for table, table_ids in new_ids.items():
+            touched |= self._sync_cache_ids(table, table_ids)
+        for setup_name in descriptions:
+            self._sync_cache_description(setup_name)
+        self._invalidate_caches(touched)
+        
+        counts = {
+            'standard': len(rows['configurazioni']),
+            'schedule': len(rows['configurazioni_a_orario']),
+            'time': len(rows['configurazioni_a_tempo']),
+            'conditional': len(rows['configurazioni_condizionali']),
+        }
+        _LOGGER.info(f"Import in blocco: {len(rules)} regole per {len(touched)} configurazioni ({counts})")
+        return {
+            'imported': len(rules),
+            'by_type': counts,
+            'setup_names': sorted(touched),
+        }
+    
+    def _normalize_batch_date(self, value: Any) -> str:
+        """Converte una data del lotto (datetime o stringa ISO) nel formato naive locale del DB."""
+        if value is None:
+            raise ValueError("valid_from e valid_to obbligatori per le configurazioni a tempo")
+        if isinstance(value, datetime):
+            return self._ensure_local_dt(value).replace(tzinfo=None).isoformat()
+        return self._to_local_datetime(str(value)).replace(tzinfo=None).isoformat()
+    
+    @staticmethod
+    def _validate_batch_hour(value: Any, field: str) -> Optional[float]:
+        """Valida un orario decimale del lotto: tra 0 e 24 (24.0 = mezzanotte del giorno dopo)."""
+        if value is None:
+            return None
+        hour = float(value)
+        # Il confronto esclude anche NaN
+        if not 0 <= hour <= 24:
+            raise ValueError(f"{field} deve essere tra 0 e 24, ricevuto: {value}")
+        return hour
+    
+    @staticmethod
+    def _normalize_batch_days(days: Any) -> Optional[str]:
+        """Valida days_of_week del lotto (lista o stringa '0,2,4') e lo restituisce nel formato del DB."""
+        if days is None:
+            return None
+        values = days if isinstance(days, (list, tuple)) else [d for d in str(days).split(',') if d.strip()]
+        normalized = []
+        for day in values:
+            try:
+                day_number = int(day)
+            except (TypeError, ValueError):
+                raise ValueError(f"Giorno della settimana non valido: {day!r}") from None
+            if not 0 <= day_number <= 6:
+                raise ValueError(f"Giorno della settimana non valido: {day} (ammessi 0-6, 0 = lunedì)")
+            normalized.append(day_number)
+        return ','.join(map(str, normalized))
+    
+    @staticmethod
+    def _is_reachable(graph: Dict[str, set], start: str, target: str) -> bool:
+        """True se target è raggiungibile da start seguendo gli archi del grafo (DFS iterativa)."""
+        seen = {start}
+        stack = [start]
+        while stack:
+            name = stack.pop()
+            if name == target:
                 return True
-        
+            for neighbour in graph.get(name, ()):
+                if neighbour not in seen:
+                    seen.add(neighbour)
+                    stack.append(neighbour)
         return False
     
+    def _check_circular_dependency(self, setup_name: str, conditional_config: str) -> bool:
+        """Verifica se aggiungere una dipendenza creerebbe un loop ciclico.
+        
+        Il nuovo arco setup_name -> conditional_config chiude un ciclo se
+        conditional_config dipende già (anche indirettamente) da setup_name, cioè se
+        è raggiungibile da setup_name nel grafo inverso in memoria ('dependents',
+        regole abilitate e non). Il grafo è mantenuto in sync con la cache, quindi
+        include anche le scritture pendenti di una sessione batch(), e la visita si
+        ferma appena trova conditional_config.
+        
+        Args:
+            setup_name: Nome della configurazione che stiamo aggiungendo
+            conditional_config: Configurazione da cui dipende
+        
+        Returns:
+            True se esiste un ciclo, False altrimenti
+        """
+        if not self._memory_cache['loaded']:
+            self._load_all_to_memory()
+        return self._is_reachable(self._memory_cache['dependents'], setup_name, conditional_config)
+    
+    @_reader
+    def get_dependents(self, setup_name: str) -> List[str]:
+        """Setup_name che dipendono (anche indirettamente) da setup_name, escluso se stesso."""
+        self._ensure_loaded()
+        return sorted(self._get_transitive_dependents({setup_name}) - {setup_name})
+    
+    @_reader
+    def get_max_dependency_depth(self) -> int:
+        """Lunghezza (in archi) della catena di dipendenze condizionali più lunga.
+        
+        Calcolata con una DFS iterativa in post-ordine sul grafo inverso: ogni nodo
+        viene visitato una sola volta (O(nomi + archi)); i cicli sono rifiutati in
+        scrittura, quindi il grafo è aciclico.
+        """
+        self._ensure_loaded()
+        dependents = self._memory_cache['dependents']
+        heights = {}
+        for root in dependents:
+            if root in heights:
+                continue
+            stack = [(root, False)]
+            while stack:
+                name, expanded = stack.pop()
+                if expanded:
+                    heights[name] = max((heights[child] + 1 for child in dependents.get(name, ())), default=0)
+                    continue
+                if name in heights:
+                    continue
+                stack.append((name, True))
+                for child in dependents.get(name, ()):
+                    if child not in heights:
+                        stack.append((child, False))
+        return max(heights.values(), default=0)
+    
     def _evaluate_condition(self, actual_value: str, operator: str, expected_value: str) -> bool:
         """Valuta una condizione confrontando due valori.
         
@@ -1157,6 +1970,7 @@ class ConfigDatabase:
         
         return False
     
+    @_writer
     def delete_config(self, setup_name: str, config_type: str = "all") -> None:
         """Elimina una configurazione."""
         cursor = self.conn.cursor()
@@ -1225,36 +2039,36 @@ class ConfigDatabase:
                 )
             cursor.execute("DELETE FROM configurazioni_condizionali WHERE setup_name = ?", (setup_name,))
         
-        # Invalida cache descrizioni (potrebbero essere state rimosse insieme alle config)
-        self._descriptions_cache = None
-        
-        self.conn.commit()
+        self._commit()
         _LOGGER.debug(f"Deleted config: {setup_name} (type: {config_type})")
         
-        # Invalida tutte le cache dopo eliminazione configurazione
-        self._invalidate_caches()
+        # Aggiorna la cache in-memory col delta e invalida solo i nomi coinvolti
+        touched = {setup_name}
+        for table, kind in (
+            ('configurazioni', 'standard'),
+            ('configurazioni_a_tempo', 'time'),
+            ('configurazioni_a_orario', 'schedule'),
+            ('configurazioni_condizionali', 'conditional'),
+        ):
+            if config_type in ["all", kind]:
+                touched |= self._sync_cache_rows(table, 'setup_name', setup_name)
+        self._sync_cache_description(setup_name)
+        self._invalidate_caches(touched)
     
+    @_reader
     def get_all_setup_names(self) -> List[str]:
         """Ottiene tutti i nomi delle configurazioni esistenti usando la cache in-memory."""
         # Assicurati che la cache sia caricata
-        if not self._memory_cache['loaded']:
-            self._load_all_to_memory()
+        self._ensure_loaded()
         
-        names = set()
-        
-        # Estrai nomi dalla cache invece di fare query dirette
-        names.update(row['setup_name'] for row in self._memory_cache['configurazioni'])
-        names.update(row['setup_name'] for row in self._memory_cache['configurazioni_a_orario'])
-        names.update(row['setup_name'] for row in self._memory_cache['configurazioni_a_tempo'])
-        names.update(row['setup_name'] for row in self._memory_cache['configurazioni_condizionali'])
-        
-        return sorted(list(names))
+        # Estrai nomi dall'indice per nome invece di fare query dirette
+        return sorted(self._memory_cache['by_name'])
     
+    @_reader
     def get_all_configurations_detailed(self) -> Dict[str, List[Dict[str, Any]]]:
         """Ottiene tutte le configurazioni con tutti i dettagli, raggruppate per nome usando la cache in-memory."""
         # Assicurati che la cache sia caricata
-        if not self._memory_cache['loaded']:
-            self._load_all_to_memory()
+        self._ensure_loaded()
         
         result = {}
         
@@ -1281,14 +2095,13 @@ class ConfigDatabase:
             name = row['setup_name']
             if name not in result:
                 result[name] = []
-            days_str = row['days_of_week'] if row['days_of_week'] else '0,1,2,3,4,5,6'  # Default a tutti i giorni se None o vuoto
             result[name].append({
                 'type': 'schedule',
                 'id': row['id'],
                 'value': row['setup_value'],
                 'valid_from_ora': row['valid_from_ora'],
                 'valid_to_ora': row['valid_to_ora'],
-                'days_of_week': [int(d) for d in days_str.split(',') if d],
+                'days_of_week': mask_to_days(row['days_mask'] or None),  # Default a tutti i giorni se None o vuoto
                 'priority': row['priority'],
                 'enabled': bool(row['enabled'])
             })
@@ -1312,8 +2125,8 @@ class ConfigDatabase:
                 config_dict['valid_from_ora'] = row['valid_from_ora']
             if row['valid_to_ora'] is not None:
                 config_dict['valid_to_ora'] = row['valid_to_ora']
-            if row['days_of_week'] is not None:
-                config_dict['days_of_week'] = [int(d) for d in row['days_of_week'].split(',') if d]
+            if row['days_mask'] is not None:
+                config_dict['days_of_week'] = mask_to_days(row['days_mask'])
             
             result[name].append(config_dict)
         
@@ -1340,45 +2153,70 @@ class ConfigDatabase:
             result[name].append(config_dict)
         return result
     
-    def get_history(self, setup_name: Optional[str] = None, limit: int = 50, offset: int = 0) -> List[Dict[str, Any]]:
-        """Ottiene lo storico delle configurazioni con paginazione."""
-        cursor = self.conn.cursor()
-        
+    def get_history(
+        self,
+        setup_name: Optional[str] = None,
+        limit: int = 50,
+        offset: int = 0,
+        before_timestamp: Optional[str] = None,
+        before_id: Optional[int] = None
+    ) -> List[Dict[str, Any]]:
+        """Ottiene lo storico delle configurazioni, dal più recente, con paginazione.
+        
+        Con before_timestamp/before_id (la voce più vecchia della pagina precedente)
+        usa la paginazione keyset: WHERE (timestamp, id) < (?, ?) parte direttamente
+        dal punto giusto dell'indice e il costo non dipende da quante pagine sono già
+        state lette. offset resta supportato (relativo al cursore, se presente). In
+        entrambi i casi la pagina viene cercata sull'indice (setup_name, timestamp, id)
+        e vengono lette solo le righe complete della pagina.
+        """
+        conditions = []
+        params = []
         if setup_name:
-            cursor.execute("""
-                SELECT * FROM configurazioni_storico 
-                WHERE setup_name = ?
-                ORDER BY timestamp DESC
-                LIMIT ? OFFSET ?
-            """, (setup_name, limit, offset))
-        else:
-            cursor.execute("""
-                SELECT * FROM configurazioni_storico 
-                ORDER BY timestamp DESC
+            conditions.append("setup_name = ?")
+            params.append(setup_name)
+        if before_timestamp is not None and before_id is not None:
+            conditions.append("(timestamp, id) < (?, ?)")
+            params.extend([before_timestamp, before_id])
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        
+        cursor = self._read_connection().cursor()
+        cursor.execute(f"""
+            SELECT s.* FROM configurazioni_storico s
+            JOIN (
+                SELECT id FROM configurazioni_storico
+                {where}
+                ORDER BY timestamp DESC, id DESC
                 LIMIT ? OFFSET ?
-            """, (limit, offset))
+            ) page ON page.id = s.id
+            ORDER BY s.timestamp DESC, s.id DESC
+        """, (*params, limit, offset))
         
         return [dict(row) for row in cursor.fetchall()]
     
     def get_history_count(self, setup_name: Optional[str] = None) -> int:
-        """Ottiene il numero totale di record nello storico."""
-        cursor = self.conn.cursor()
+        """Ottiene il numero totale di record nello storico (dai conteggi per setup_name)."""
+        cursor = self._read_connection().cursor()
         
         if setup_name:
             cursor.execute("""
-                SELECT COUNT(*) as count FROM configurazioni_storico 
+                SELECT entries AS count FROM configurazioni_storico_conteggi 
                 WHERE setup_name = ?
             """, (setup_name,))
         else:
             cursor.execute("""
-                SELECT COUNT(*) as count FROM configurazioni_storico
+                SELECT COALESCE(SUM(entries), 0) AS count FROM configurazioni_storico_conteggi
             """)
         
         result = cursor.fetchone()
         return result['count'] if result else 0
     
     def _save_to_history(self, setup_name: str, config_type: str, config_data: Dict[str, Any], operation: str) -> None:
-        """Salva una configurazione nello storico."""
+        """Salva una configurazione nello storico.
+        
+        Il commit è quello del metodo di scrittura chiamante; la retention non viene
+        applicata qui ma in blocco da trim_history (vedi history_trim_due).
+        """
         cursor = self.conn.cursor()
         cursor.execute("""
             INSERT INTO configurazioni_storico 
@@ -1397,67 +2235,81 @@ class ConfigDatabase:
             config_data.get('valid_to_date'),
             operation
         ))
-        self.conn.commit()
-        
-        # Dopo aver salvato, esegui il cleanup dello storico
-        self._cleanup_history(setup_name)
+        self._history_inserts += 1
+    
+    @property
+    def history_trim_due(self) -> bool:
+        """True se dall'ultima retention sono state inserite almeno HISTORY_TRIM_THRESHOLD voci nello storico."""
+        return self._history_inserts >= HISTORY_TRIM_THRESHOLD
     
-    def _cleanup_history(self, setup_name: str, retention_days: int = 730, max_entries_per_name: int = 100, min_entries_per_name: int = 10) -> None:
+    @_writer
+    def trim_history(
+        self,
+        retention_days: int = DEFAULT_HISTORY_RETENTION_DAYS,
+        max_entries_per_name: int = DEFAULT_MAX_HISTORY_PER_NAME,
+        min_entries_per_name: int = DEFAULT_MIN_HISTORY_PER_NAME,
+        setup_name: Optional[str] = None
+    ) -> int:
         """
-        Pulisce lo storico applicando le regole:
+        Applica la retention dello storico a tutti i setup_name con un'unica DELETE:
         1. Mantieni sempre almeno min_entries_per_name entry più recenti (anche se oltre retention_days)
         2. Elimina entry oltre retention_days solo se abbiamo più di min_entries_per_name
         3. Mantieni massimo max_entries_per_name entry
-        """
-        cursor = self.conn.cursor()
         
-        # Conta quante entry abbiamo per questo setup_name
-        cursor.execute("""
-            SELECT COUNT(*) as count FROM configurazioni_storico 
-            WHERE setup_name = ?
-        """, (setup_name,))
-        total_count = cursor.fetchone()['count']
+        Il rango di ogni voce all'interno del proprio setup_name è calcolato con
+        ROW_NUMBER() OVER (PARTITION BY setup_name ORDER BY timestamp DESC).
         
-        # Se abbiamo più di max_entries_per_name, elimina le più vecchie oltre il massimo
-        if total_count > max_entries_per_name:
-            cursor.execute("""
-                DELETE FROM configurazioni_storico
-                WHERE id NOT IN (
-                    SELECT id FROM configurazioni_storico
-                    WHERE setup_name = ?
-                    ORDER BY timestamp DESC
-                    LIMIT ?
-                )
-                AND setup_name = ?
-            """, (setup_name, max_entries_per_name, setup_name))
-            
-            # Aggiorna il conteggio
-            cursor.execute("""
-                SELECT COUNT(*) as count FROM configurazioni_storico 
-                WHERE setup_name = ?
-            """, (setup_name,))
-            total_count = cursor.fetchone()['count']
+        Args:
+            setup_name: Limita la retention a un solo setup_name (default: tutti)
         
-        # Elimina record più vecchi di retention_days SOLO se abbiamo più di min_entries_per_name
-        if total_count > min_entries_per_name:
-            cursor.execute("""
-                DELETE FROM configurazioni_storico
-                WHERE id IN (
-                    SELECT id FROM configurazioni_storico
-                    WHERE setup_name = ?
-                    AND datetime(timestamp) < datetime('now', '-' || ? || ' days')
-                    AND id NOT IN (
-                        SELECT id FROM configurazioni_storico
-                        WHERE setup_name = ?
-                        ORDER BY timestamp DESC
-                        LIMIT ?
-                    )
+        Returns:
+            Numero di voci eliminate
+        """
+        name_filter = "WHERE setup_name = ?" if setup_name else ""
+        params = [setup_name] if setup_name else []
+        cursor = self.conn.cursor()
+        cursor.execute(f"""
+            DELETE FROM configurazioni_storico
+            WHERE id IN (
+                SELECT id FROM (
+                    SELECT id, timestamp,
+                           ROW_NUMBER() OVER (
+                               PARTITION BY setup_name ORDER BY timestamp DESC, id DESC
+                           ) AS position
+                    FROM configurazioni_storico
+                    {name_filter}
                 )
-            """, (setup_name, retention_days, setup_name, min_entries_per_name))
+                WHERE position > ?
+                   OR (position > ? AND datetime(timestamp) < datetime('now', '-' || ? || ' days'))
+            )
+        """, (*params, max_entries_per_name, min_entries_per_name, retention_days))
+        deleted_count = cursor.rowcount
+        self._commit()
         
-        self.conn.commit()
-        _LOGGER.debug(f"Cleanup storico per '{setup_name}': retention={retention_days} giorni, max={max_entries_per_name}, min={min_entries_per_name}")
+        if setup_name is None:
+            if self._batch_depth:
+                # Commit differito: se la sessione viene annullata la DELETE va persa
+                # e il contatore deve continuare a richiedere la retention
+                self._batch_history_trimmed = self._history_inserts
+            else:
+                self._history_inserts = 0
+        _LOGGER.debug(
+            f"Retention storico {'per ' + repr(setup_name) if setup_name else 'globale'}: {deleted_count} voci eliminate "
+            f"(retention={retention_days} giorni, max={max_entries_per_name}, min={min_entries_per_name})"
+        )
+        return deleted_count
+    
+    def _cleanup_history(
+        self,
+        setup_name: str,
+        retention_days: int = DEFAULT_HISTORY_RETENTION_DAYS,
+        max_entries_per_name: int = DEFAULT_MAX_HISTORY_PER_NAME,
+        min_entries_per_name: int = DEFAULT_MIN_HISTORY_PER_NAME
+    ) -> None:
+        """Pulisce lo storico di un singolo setup_name (vedi trim_history)."""
+        self.trim_history(retention_days, max_entries_per_name, min_entries_per_name, setup_name)
     
+    @_writer
     def delete_single_config(self, config_type: str, config_id: str) -> None:
         """Elimina una singola configurazione per ID."""
         cursor = self.conn.cursor()
@@ -1524,12 +2376,22 @@ class ConfigDatabase:
                 )
             cursor.execute("DELETE FROM configurazioni WHERE setup_name = ?", (config_id,))
         
-        self.conn.commit()
+        self._commit()
         _LOGGER.info(f"Configurazione {config_type} con ID {config_id} eliminata")
         
-        # Invalida tutte le cache dopo eliminazione configurazione
-        self._invalidate_caches()
+        # Aggiorna la cache in-memory col delta e invalida solo i nomi coinvolti
+        table_map = {
+            'schedule': ('configurazioni_a_orario', 'id'),
+            'time': ('configurazioni_a_tempo', 'id'),
+            'conditional': ('configurazioni_condizionali', 'id'),
+            'standard': ('configurazioni', 'setup_name')
+        }
+        if config_type in table_map:
+            table, column = table_map[config_type]
+            key = config_id if column == 'setup_name' else int(config_id)
+            self._invalidate_caches(self._sync_cache_rows(table, column, key))
     
+    @_writer
     def set_config_enabled(self, config_type: str, config_id: int, enabled: bool) -> None:
         """Abilita o disabilita una configurazione."""
         cursor = self.conn.cursor()
@@ -1601,25 +2463,28 @@ class ConfigDatabase:
                     'priority': row['priority']
                 }
         cursor.execute(f"UPDATE {table} SET enabled = ? WHERE id = ?", (enabled_value, config_id))
-        self.conn.commit()
         
         if history_name and history_data:
             operation = 'ENABLE' if enabled else 'DISABLE'
             self._save_to_history(history_name, config_type, history_data, operation)
+        
+        self._commit()
 
         status = "abilitata" if enabled else "disabilitata"
         _LOGGER.info(f"Configurazione {config_type} con ID {config_id} {status}")
         
-        # Invalida tutte le cache dopo modifica enable/disable
-        self._invalidate_caches()
+        # Aggiorna la cache in-memory col delta e invalida solo i nomi coinvolti
+        self._invalidate_caches(self._sync_cache_rows(table, 'id', config_id))
     
-    def get_next_changes(self, setup_name: str, limit_hours: int = 168, max_results: int = 5, _retry: bool = True) -> List[Dict[str, Any]]:
+    @_reader
+    @_uses_timelines
+    def get_next_changes(self, setup_name: str, limit_hours: int = 168, max_results: int = 5) -> List[Dict[str, Any]]:
         """
         Calcola i prossimi cambiamenti di valore per una configurazione.
         USA LA LOGICA UNIFICATA _get_configurations_at_time per garantire coerenza con runtime e vista settimanale.
         
         OTTIMIZZAZIONE PERFORMANCE:
-        - Cache basata sul valore corrente e config_version
+        - Cache basata sul valore corrente e sulla versione del setup_name (get_config_version)
         - Ricalcolo solo se: valore corrente cambiato O configurazioni modificate
         - La cache viene invalidata automaticamente dopo ogni modifica alle configurazioni
         
@@ -1639,8 +2504,134 @@ class ConfigDatabase:
         now = dt_util.now()
         current_configs = self._get_configurations_at_time(now, target_setup_name=setup_name)
         current_value = current_configs.get(setup_name, {}).get('value')
-        current_source = current_configs.get(setup_name, {}).get('source', 'unknown')
         
+        cached = self._get_cached_next_changes(setup_name, limit_hours, max_results, current_value, now)
+        if cached is not None:
+            return cached
+        
+        # Cache miss o invalidata: ricalcola
+        limit_time = now + timedelta(hours=limit_hours)
+        
+        # FASE 1: Timeline compilata del setup (cambi di stato già risolti agli eventi)
+        # La risoluzione completa avviene una sola volta per config_version, qui si fa solo bisect
+        timeline = self._get_timeline(setup_name, now, limit_time)
+        timeline_state = timeline.state_at(now)
+        if (timeline_state or {}).get('value') != current_value:
+            # La timeline in cache non concorda con il valore attuale: ricostruiscila da adesso
+            _LOGGER.debug(f"[NEXT_CHANGES] {setup_name}: timeline disallineata al valore corrente, ricostruzione da {now}")
+            timeline = self._get_timeline(setup_name, now, limit_time, force=True)
+        
+        # FASE 2: Calcolo cambiamenti di valore
+        # I punti della timeline sono già cambi di stato: resta da filtrare i cambi di valore
+        changes = []
+        last_value = current_value
+        
+        for event_time, state in timeline.changes_between(now, limit_time):
+            if state is None:
+                continue
+            # Aggiungi solo se il valore cambia effettivamente
+            if state['value'] != last_value:
+                change_entry = self._build_change_entry(setup_name, event_time, state, now)
+                if change_entry is None:
+                    continue
+                changes.append(change_entry)
+                
+                last_value = state['value']
+                if len(changes) >= max_results:
+                    break
+        
+        return self._store_next_changes(setup_name, limit_hours, max_results, current_value, now, changes)
+    
+    @_reader
+    def get_next_changes_all(
+        self,
+        limit_hours: int = 168,
+        max_results: int = 5,
+        setup_names: Optional[List[str]] = None
+    ) -> Dict[str, List[Dict[str, Any]]]:
+        """Calcola i prossimi cambiamenti di tutti i setup_name in un'unica passata.
+        
+        Invece di una chiamata (e un salto di thread) per nome, percorre UNA volta il
+        flusso unificato degli eventi e ad ogni confine risolve insieme i nomi ancora
+        aperti il cui valore può cambiare (proprietari del confine e loro dipendenti):
+        il memo per istante condivide le dipendenze comuni. I nomi con una voce
+        valida nella cache di get_next_changes non vengono ricalcolati, e i
+        risultati calcolati qui la alimentano.
+        
+        Args:
+            limit_hours: Numero di ore future da considerare (default 168 - 7 giorni)
+            max_results: Numero massimo di eventi per nome (default 5)
+            setup_names: Nomi da calcolare (default: tutti)
+        
+        Returns:
+            Dict {setup_name: lista di cambiamenti} nello stesso formato di get_next_changes
+        """
+        now = dt_util.now()
+        current = self._get_configurations_at_time(now)
+        if setup_names is None:
+            setup_names = self.get_all_setup_names()
+        return self._get_next_changes_batch(now, current, limit_hours, max_results, setup_names)
+    
+    def _get_next_changes_batch(
+        self,
+        now: datetime,
+        current: Dict[str, Any],
+        limit_hours: int,
+        max_results: int,
+        setup_names: List[str]
+    ) -> Dict[str, List[Dict[str, Any]]]:
+        """Passata unica di get_next_changes_all a partire dai valori correnti già risolti a `now`."""
+        results = {}
+        last_values = {}
+        for name in setup_names:
+            current_value = current.get(name, {}).get('value')
+            cached = self._get_cached_next_changes(name, limit_hours, max_results, current_value, now)
+            if cached is not None:
+                results[name] = cached
+            else:
+                results[name] = []
+                last_values[name] = current_value
+        
+        pending = set(last_values)
+        if pending:
+            limit_time = now + timedelta(hours=limit_hours)
+            affected_by_owner = {}
+            for event_time, owners in self._iter_event_owners(now):
+                if event_time > limit_time or not pending:
+                    break
+                affected = set()
+                for owner in owners:
+                    if owner not in affected_by_owner:
+                        affected_by_owner[owner] = self._get_transitive_dependents({owner})
+                    affected |= affected_by_owner[owner]
+                for name in sorted(affected & pending):
+                    state = self._resolve_state(name, event_time)
+                    if state is None or state['value'] == last_values[name]:
+                        continue
+                    change_entry = self._build_change_entry(name, event_time, state, now)
+                    if change_entry is None:
+                        continue
+                    results[name].append(change_entry)
+                    last_values[name] = state['value']
+                    if len(results[name]) >= max_results:
+                        pending.discard(name)
+            
+            for name in last_values:
+                current_value = current.get(name, {}).get('value')
+                results[name] = self._store_next_changes(name, limit_hours, max_results, current_value, now, results[name])
+        
+        _LOGGER.debug(f"[NEXT_CHANGES] Calcolo batch: {len(last_values)} nomi ricalcolati, {len(results) - len(last_values)} dalla cache")
+        return results
+    
+    def _get_cached_next_changes(
+        self,
+        setup_name: str,
+        limit_hours: int,
+        max_results: int,
+        current_value: Optional[str],
+        now: datetime
+    ) -> Optional[List[Dict[str, Any]]]:
+        """Restituisce i prossimi cambiamenti dalla cache se ancora validi, altrimenti None."""
         # Controlla cache: ricalcola solo se valore corrente cambiato O configurazioni modificate
         # Cache key include parametri per evitare collisioni tra chiamate con parametri diversi
         cache_key = (setup_name, limit_hours, max_results)
@@ -1649,9 +2640,8 @@ class ConfigDatabase:
         if cached is not None:
             # Cache hit: verifica se è ancora valida
             if (cached['value'] == current_value and 
-                cached['config_version'] == self._config_version):
+                cached['config_version'] == self.get_config_version(setup_name)):
                 # Cache valida: aggiorna seconds_until/minutes_until basandosi sul tempo trascorso
-                now = dt_util.now()
                 cached_timestamp = dt_util.parse_datetime(cached['timestamp'])
                 # Usa round per evitare drift nei calcoli temporali
                 elapsed_seconds = round((now - cached_timestamp).total_seconds())
@@ -1682,122 +2672,116 @@ class ConfigDatabase:
                     pass  # forza ricalcolo
                 else:
                     return updated_changes[:max_results]
-        
-        # Cache miss o invalidata: ricalcola
-        now = dt_util.now()
-        limit_time = now + timedelta(hours=limit_hours)
-        
-        # Costanti per la gestione degli eventi
-        MAX_DAYS_TO_CHECK = 7  # Numero massimo di giorni futuri da considerare per eventi ricorrenti
-        
-        # Helper per calcolare giorni da verificare basato su limit_hours
-        def get_days_to_check(hours: int) -> int:
-            """Calcola quanti giorni verificare per eventi ricorrenti, max MAX_DAYS_TO_CHECK."""
-            return min(int(hours / 24) + 2, MAX_DAYS_TO_CHECK)  # +2 per sicurezza (oggi e domani)
-        
-        # FASE 1: Raccolta timestamp eventi potenziali
-        # Usa cache globale degli event_times per evitare ricalcoli continui
-        # Filtra solo gli eventi nel periodo richiesto
-        all_event_times = self._get_all_event_times(limit_time)
-        event_times = {t for t in all_event_times if t > now and t <= limit_time}
-        
-        # SAFETY CHECK: Se non ci sono eventi ma ci sono configurazioni a orario/tempo, è un errore critico
-        if not event_times:
-            schedule_count = len([r for r in self._memory_cache['configurazioni_a_orario'] if r['enabled'] and r['setup_name'] == setup_name])
-            time_count = len([r for r in self._memory_cache['configurazioni_a_tempo'] if r['enabled'] and r['setup_name'] == setup_name])
-            if schedule_count > 0 or time_count > 0:
-                _LOGGER.error(f"[CRITICAL] {setup_name}: No events found but {schedule_count} schedule + {time_count} time configs exist! Forcing event_times regeneration")
-                self._event_times_cache.clear()
-                self._event_times_config_version = None
-                all_event_times = self._get_all_event_times(limit_time)
-                event_times = {t for t in all_event_times if t > now and t <= limit_time}
-        
-        # FASE 2: Calcolo cambiamenti di valore
-        # Per ogni timestamp potenziale, calcoliamo se il setup_name target cambia valore
-        # Usiamo la logica ottimizzata che calcola solo le configurazioni rilevanti
-        changes = []
-        last_value = current_value
-        last_source = current_source
-        
-        for event_time in sorted(event_times):
-            # CRITICO: Verifica che l'evento sia futuro (può essere passato durante il processing)
-            if event_time <= now:
-                continue
-                
-            # Verifica se a questo timestamp il valore del setup_name cambia
-            # _get_configurations_at_time con target_setup_name calcola solo ciò che serve
-            all_configs_at_time = self._get_configurations_at_time(event_time, target_setup_name=setup_name)
-            
-            # Estrai il valore per il setup specifico
-            if setup_name in all_configs_at_time:
-                config_at_time = all_configs_at_time[ setup_name]
-                new_value = config_at_time['value']
-                new_source = config_at_time['source']
-                new_id = config_at_time.get('id')
-                
-                # Aggiungi solo se il valore cambia effettivamente
-                if new_value != last_value:
-                    seconds_until = (event_time - now).total_seconds()
-                    if seconds_until <= 0:
-                        _LOGGER.warning(f"[NEXT_CHANGES] Skipping past event: {event_time} (now={now})")
-                        continue
-                    seconds_until = int(math.ceil(seconds_until))
-                    minutes_until = max(1, int(math.ceil(seconds_until / 60)))
-                    
-                    change_entry = {
-                        'value': new_value,
-                        'minutes_until': minutes_until,
-                        'seconds_until': seconds_until,
-                        'timestamp': event_time.isoformat(),
-                        'type': new_source  # Il tipo è la sorgente che ha vinto (time, schedule, conditional, standard)
-                    }
-                    if new_id is not None:
-                        change_entry['id'] = new_id
-                    changes.append(change_entry)
-                    
-                    last_value = new_value
-                    last_source = new_source
-
-        
-        # Salva in cache prima di restituire
+        return None
+    
+    def _build_change_entry(self, setup_name: str, event_time: datetime, state: Dict[str, Any], now: datetime) -> Optional[Dict[str, Any]]:
+        """Costruisce la voce di un cambiamento futuro (None se l'evento è già passato)."""
+        seconds_until = (event_time - now).total_seconds()
+        if seconds_until <= 0:
+            _LOGGER.warning(f"[NEXT_CHANGES] Skipping past event: {event_time} (now={now})")
+            return None
+        seconds_until = int(math.ceil(seconds_until))
+        minutes_until = max(1, int(math.ceil(seconds_until / 60)))
+        
+        change_entry = {
+            'value': state['value'],
+            'minutes_until': minutes_until,
+            'seconds_until': seconds_until,
+            'timestamp': event_time.isoformat(),
+            'type': state['source']  # Il tipo è la sorgente che ha vinto (time, schedule, conditional, standard)
+        }
+        if state.get('id') is not None:
+            change_entry['id'] = state['id']
+        return change_entry
+    
+    def _store_next_changes(
+        self,
+        setup_name: str,
+        limit_hours: int,
+        max_results: int,
+        current_value: Optional[str],
+        now: datetime,
+        changes: List[Dict[str, Any]]
+    ) -> List[Dict[str, Any]]:
+        """Salva in cache i prossimi cambiamenti calcolati e li restituisce."""
         result = changes[:max_results]
-        self._next_changes_cache[cache_key] = {
+        self._next_changes_cache[(setup_name, limit_hours, max_results)] = {
             'value': current_value,
-            'config_version': self._config_version,
+            'config_version': self.get_config_version(setup_name),
             'result': result,
             'timestamp': now.isoformat()
         }
         _LOGGER.debug(f"[NEXT_CHANGES] {setup_name}: found {len(changes)} changes (returning {len(result)}), current_value={current_value}")
         if result:
             _LOGGER.info(f"[NEXT_CHANGES] {setup_name}: Next change to '{result[0]['value']}' in {result[0]['seconds_until']}s at {result[0]['timestamp']}")
-
-        # Salvaguardia startup: se il risultato è vuoto al primo calcolo, forza una rigenerazione
-        # degli event_times e riprova una sola volta. Questo evita lo stato bloccato "nessun evento"
-        # quando la cache eventi è vuota allo startup pur avendo configurazioni valide.
-        if not result and _retry:
-            self._event_times_cache = set()
-            self._event_times_config_version = None
-            self._event_times_generation_start = None
-            self._event_times_generation_end = None
-            return self.get_next_changes(setup_name, limit_hours, max_results, _retry=False)
-        
         return result
     
+    @_writer
+    def run_maintenance(
+        self,
+        retention_days: int = DEFAULT_HISTORY_RETENTION_DAYS,
+        max_entries_per_name: int = DEFAULT_MAX_HISTORY_PER_NAME,
+        min_entries_per_name: int = DEFAULT_MIN_HISTORY_PER_NAME,
+        cleanup_days: int = DEFAULT_CLEANUP_DAYS
+    ) -> Dict[str, Any]:
+        """Manutenzione periodica completa in un'unica transazione.
+        
+        Esegue, in una sessione batch() (un solo commit e una sola invalidazione):
+        - retention dello storico per tutti i setup_name (trim_history)
+        - rimozione delle configurazioni a tempo scadute da più di cleanup_days giorni
+          (saltata se cleanup_days è 0)
+        - rimozione dei valori validi orfani
+        Dopo il commit lancia PRAGMA optimize per aggiornare le statistiche del planner.
+        
+        Returns:
+            Dict con le righe eliminate per tipo e la durata in millisecondi
+        """
+        started = time.perf_counter()
+        with self.batch():
+            history_deleted = self.trim_history(retention_days, max_entries_per_name, min_entries_per_name)
+            expired_deleted = self.cleanup_expired_events(cleanup_days) if cleanup_days > 0 else 0
+            orphans_deleted = self.cleanup_orphan_valid_values()
+        self.conn.execute("PRAGMA optimize")
+        
+        stats = {
+            'history_deleted': history_deleted,
+            'expired_deleted': expired_deleted,
+            'orphan_values_deleted': orphans_deleted,
+            'duration_ms': round((time.perf_counter() - started) * 1000, 2),
+        }
+        _LOGGER.info(f"Manutenzione completata: {stats}")
+        return stats
+    
+    @_writer
     def cleanup_expired_events(self, days: int = 30) -> int:
         """
         Rimuove gli eventi a tempo scaduti da più di X giorni.
         Returns: numero di righe eliminate.
         """
         cursor = self.conn.cursor()
-        cutoff_date = dt_util.now() - timedelta(days=days)
+        # Confronto su epoch interi: range scan su idx_tempo_epoch
+        cutoff_epoch = int((dt_util.now() - timedelta(days=days)).timestamp())
+        
+        cursor.execute("""
+            SELECT DISTINCT setup_name FROM configurazioni_a_tempo
+            WHERE valid_to_epoch < ?
+        """, (cutoff_epoch,))
+        expired_names = [row['setup_name'] for row in cursor.fetchall()]
         
         cursor.execute("""
             DELETE FROM configurazioni_a_tempo
-            WHERE datetime(valid_to_date) < datetime(?)
-        """, (cutoff_date.isoformat(),))
+            WHERE valid_to_epoch < ?
+        """, (cutoff_epoch,))
         
         deleted_count = cursor.rowcount
-        self.conn.commit()
+        self._commit()
+        
+        # Allinea la cache in-memory: le regole scadute non devono restare nel resolver
+        if deleted_count:
+            touched = set()
+            for setup_name in expired_names:
+                touched |= self._sync_cache_rows('configurazioni_a_tempo', 'setup_name', setup_name)
+            self._invalidate_caches(touched)
         
         return deleted_count
     
@@ -1805,7 +2789,7 @@ class ConfigDatabase:
     
     def get_valid_values(self, setup_name: str) -> List[Dict[str, Any]]:
         """Ottiene la lista dei valori validi per una configurazione."""
-        cursor = self.conn.cursor()
+        cursor = self._read_connection().cursor()
         cursor.execute("""
             SELECT id, value, description, sort_order
             FROM configurazioni_valori_validi
@@ -1815,6 +2799,20 @@ class ConfigDatabase:
         
         return [dict(row) for row in cursor.fetchall()]
     
+    def get_all_valid_values(self) -> Dict[str, List[Dict[str, Any]]]:
+        """Ottiene tutti i valori validi raggruppati per setup_name."""
+        cursor = self._read_connection().cursor()
+        cursor.execute("""
+            SELECT setup_name, value, description, sort_order, id
+            FROM configurazioni_valori_validi
+            ORDER BY setup_name, sort_order, value
+        """)
+        all_values = {}
+        for row in cursor.fetchall():
+            all_values.setdefault(row['setup_name'], []).append(dict(row))
+        return all_values
+    
+    @_writer
     def add_valid_value(self, setup_name: str, value: str, description: str = None, sort_order: int = 0) -> None:
         """Aggiunge un valore valido per una configurazione."""
         cursor = self.conn.cursor()
@@ -1823,7 +2821,7 @@ class ConfigDatabase:
                 INSERT INTO configurazioni_valori_validi (setup_name, value, description, sort_order)
                 VALUES (?, ?, ?, ?)
             """, (setup_name, value, description, sort_order))
-            self.conn.commit()
+            self._commit()
             _LOGGER.info(f"Valore valido aggiunto: {setup_name} = {value}")
         except sqlite3.IntegrityError:
             # Valore già esiste, aggiorna descrizione
@@ -1832,16 +2830,18 @@ class ConfigDatabase:
                 SET description = ?, sort_order = ?
                 WHERE setup_name = ? AND value = ?
             """, (description, sort_order, setup_name, value))
-            self.conn.commit()
+            self._commit()
             _LOGGER.info(f"Valore valido aggiornato: {setup_name} = {value}")
     
+    @_writer
     def delete_valid_value(self, valid_value_id: int) -> None:
         """Elimina un valore valido."""
         cursor = self.conn.cursor()
         cursor.execute("DELETE FROM configurazioni_valori_validi WHERE id = ?", (valid_value_id,))
-        self.conn.commit()
+        self._commit()
         _LOGGER.info(f"Valore valido eliminato: ID {valid_value_id}")
     
+    @_writer
     def cleanup_orphan_valid_values(self) -> int:
         """
         Rimuove i valori validi per configurazioni che non esistono più.
@@ -1872,13 +2872,15 @@ class ConfigDatabase:
             """, tuple(active_names))
         
         deleted_count = cursor.rowcount
-        self.conn.commit()
+        self._commit()
         
         if deleted_count > 0:
             _LOGGER.info(f"Rimossi {deleted_count} valori validi orfani")
         
         return deleted_count
     
+    @_reader
+    @_uses_timelines
     def simulate_configuration_schedule(
         self,
         setup_name: str,
@@ -1888,8 +2890,8 @@ class ConfigDatabase:
     ) -> List[Dict[str, Any]]:
         """Simula la configurazione per un periodo di tempo specificato.
         USA LA LOGICA UNIFICATA _get_configurations_at_time per garantire coerenza con il runtime.
-        USA CAMPIONAMENTO EVENT-DRIVEN: considera tutti gli event times esistenti da TUTTE le configurazioni
-        per garantire accuratezza anche con dipendenze condizionali indirette.
+        USA CAMPIONAMENTO EVENT-DRIVEN: campiona ai cambi di stato della timeline del setup, costruita
+        dagli eventi delle sue configurazioni e di quelle delle dipendenze condizionali (anche indirette).
         
         Args:
             setup_name: Nome della configurazione da simulare
@@ -1913,17 +2915,18 @@ class ConfigDatabase:
         # Normalizza l'inizio simulazione a mezzanotte per evitare offset di minuti ereditati
         start_date = start_date.replace(hour=0, minute=0, second=0, microsecond=0)
 
-        # Pre-carica i metadata per tipo - usa cache in-memory
-        schedule_configs = {row['id']: row for row in self._memory_cache['configurazioni_a_orario'] if row['setup_name'] == setup_name}
+        # Pre-carica i metadata per tipo - usa l'indice per nome della cache in-memory
+        self._ensure_loaded()
+        schedule_configs = {row['id']: row for row in self._get_rules('configurazioni_a_orario', setup_name)}
         
-        time_configs = {row['id']: row for row in self._memory_cache['configurazioni_a_tempo'] if row['setup_name'] == setup_name}
+        time_configs = {row['id']: row for row in self._get_rules('configurazioni_a_tempo', setup_name)}
         
-        conditional_configs = {row['id']: row for row in self._memory_cache['configurazioni_condizionali'] if row['setup_name'] == setup_name}
+        conditional_configs = {row['id']: row for row in self._get_rules('configurazioni_condizionali', setup_name)}
 
-        # Raccogli tutti i timestamp eventi per il periodo di simulazione filtrando il cache globale
+        # Timeline compilata del setup: i suoi punti sono già i cambi di stato del periodo,
+        # campionare agli altri eventi restituirebbe lo stesso stato
         end_date = start_date + timedelta(days=days)
-        all_event_times = self._get_all_event_times(end_date)
-        event_times = {t for t in all_event_times if start_date <= t < end_date}
+        timeline = self._get_timeline(setup_name, start_date, end_date)
 
         # Simula giorno per giorno
         for day_offset in range(days):
@@ -1934,7 +2937,7 @@ class ConfigDatabase:
             # Filtra eventi per questo giorno specifico
             day_start = current_date
             day_end = current_date + timedelta(days=1)
-            day_events = sorted([t for t in event_times if t.date() == current_date.date()])
+            day_events = [t for t, _ in timeline.changes_between(day_start, day_end) if t < day_end]
             
             # Aggiungi sempre l'inizio del giorno per garantire campionamento a mezzanotte
             if day_start not in day_events:
@@ -1950,19 +2953,12 @@ class ConfigDatabase:
                 sample_minute = int(minutes_since_midnight)
                 
                 if 0 <= sample_minute < 1440:
-                    # Usa la logica unificata ottimizzata
-                    all_configs = self._get_configurations_at_time(event_time, target_setup_name=setup_name)
-                    
-                    # Trova la configurazione per questo setup_name
-                    sample_config = None
-                    if setup_name in all_configs:
-                        config = all_configs[setup_name]
-                        sample_config = {
-                            'value': config['value'],
-                            'source': config['source'],
-                            'priority': config['priority'],
-                            'id': config['id']
-                        }
+                    # La mezzanotte viene risolta esattamente (può non essere un evento),
+                    # gli altri eventi leggono lo stato dalla timeline compilata
+                    if event_time == day_start:
+                        sample_config = self._resolve_state(setup_name, event_time)
+                    else:
+                        sample_config = timeline.state_at(event_time)
                     
                     # Riempie i minuti dal sample corrente fino al prossimo evento (o fine giorno)
                     next_event_minute = 1440
@@ -2017,7 +3013,7 @@ class ConfigDatabase:
                         current_segment['metadata'] = {
                             'valid_from_ora': sched['valid_from_ora'],
                             'valid_to_ora': sched['valid_to_ora'],
-                            'days_of_week': [int(d) for d in sched['days_of_week'].split(',') if d] if sched['days_of_week'] else [0,1,2,3,4,5,6]
+                            'days_of_week': mask_to_days(sched['days_mask'] or None)
                         }
                     elif config['source'] == 'time' and config_id in time_configs:
                         time_cfg = time_configs[config_id]
@@ -2044,11 +3040,124 @@ class ConfigDatabase:
         return segments
     
     def close(self) -> None:
-        """Chiude la connessione al database."""
+        """Chiude la connessione al database e termina il thread di scrittura."""
+        self.run_write(self._close_connection)
+        self._writer.shutdown(wait=threading.get_ident() != self._writer_ident)
+    
+    def _close_connection(self) -> None:
+        """Chiude le connessioni (nel thread di scrittura, dopo le scritture accodate)."""
+        self._close_read_connections()
         if self.conn:
             self.conn.close()
             _LOGGER.info("Database chiuso")
     
+    @_writer
+    def restore_from_file(self, backup_file: str, pre_restore_file: str) -> None:
+        """Ripristina il contenuto di un backup nel database e ricarica tutte le cache.
+        
+        Il database corrente viene prima salvato in pre_restore_file. Entrambe le
+        copie usano l'API di backup di SQLite sulla connessione di scrittura, senza
+        sostituire file: il ripristino è un'unica transazione, quindi le connessioni
+        in sola lettura (e un backup_to_file in corso) vedono lo stato precedente o
+        quello ripristinato, mai un file a metà, e nessun -wal residuo può essere
+        riapplicato sul file nuovo. Eseguito nel thread di scrittura, nessuna
+        modifica può inserirsi prima del ricaricamento; i lettori usano lo snapshot
+        precedente fino alla pubblicazione di quello nuovo.
+        """
+        pre_restore = sqlite3.connect(pre_restore_file)
+        try:
+            self.conn.backup(pre_restore)
+            pre_restore.execute("PRAGMA journal_mode=DELETE")
+        finally:
+            pre_restore.close()
+        
+        source = sqlite3.connect(backup_file)
+        try:
+            # In un unico passo: se fallisce la transazione viene annullata e il DB resta intatto
+            source.backup(self.conn)
+        finally:
+            source.close()
+        self._ensure_schema()
+        self._invalidate_caches()
+    
+    def backup_to_file(self, backup_file: str) -> Dict[str, Any]:
+        """Crea un backup online e consistente con l'API di backup di SQLite.
+        
+        Copia BACKUP_PAGES_PER_STEP pagine per passo da una connessione in sola
+        lettura dedicata, con una breve pausa tra un passo e l'altro, senza passare
+        dal thread di scrittura. Il file contiene sempre uno stato confermato:
+        
+        - journal WAL: la connessione tiene aperta una transazione di lettura, la
+          copia è lo snapshot dell'ultimo commit e le scritture proseguono senza
+          attese e senza far ripartire il backup;
+        - journal legacy: le scritture attendono al massimo un passo, ma ogni commit
+          fa ricominciare la copia; oltre BACKUP_MAX_RESTARTS ripartenze il resto
+          viene copiato in un unico passo.
+        
+        La copia avviene su un file temporaneo rinominato solo a backup completato.
+        
+        Returns:
+            Dict con pagine copiate/totali, passi, ripartenze, dimensione e durata
+        """
+        started = time.monotonic()
+        progress = {'steps': 0, 'restarts': 0, 'pages_total': 0, 'pages_remaining': 0}
+        
+        def _on_step(status: int, remaining: int, total: int) -> None:
+            # Le pagine rimanenti crescono solo se SQLite ha ricominciato la copia
+            if progress['steps'] and remaining > progress['pages_remaining']:
+                progress['restarts'] += 1
+                if progress['restarts'] > BACKUP_MAX_RESTARTS:
+                    raise _BackupRestarted()
+            progress['steps'] += 1
+            progress['pages_total'] = total
+            progress['pages_remaining'] = remaining
+            _LOGGER.debug(f"Backup in corso: {total - remaining}/{total} pagine")
+            if remaining:
+                # Cede il database alle scritture in attesa prima del passo successivo
+                time.sleep(BACKUP_STEP_PAUSE_MS / 1000)
+        
+        partial_file = Path(f"{backup_file}.part")
+        source = self._open_read_connection()
+        try:
+            if self.sqlite_profile == SQLITE_PROFILE_WAL:
+                # Fissa lo snapshot di lettura per tutta la durata della copia
+                source.execute("BEGIN")
+                source.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+            target = sqlite3.connect(partial_file)
+            try:
+                try:
+                    source.backup(target, pages=BACKUP_PAGES_PER_STEP, progress=_on_step)
+                except _BackupRestarted:
+                    _LOGGER.warning(
+                        f"Backup ripartito {progress['restarts']} volte per scritture concorrenti: "
+                        f"copia del resto in un unico passo"
+                    )
+                    source.backup(target, progress=_on_step)
+                # La copia eredita la modalità WAL dall'header: il backup deve restare un file autonomo
+                target.execute("PRAGMA journal_mode=DELETE")
+                page_size = target.execute("PRAGMA page_size").fetchone()[0]
+            finally:
+                target.close()
+            partial_file.replace(backup_file)
+        except Exception:
+            partial_file.unlink(missing_ok=True)
+            raise
+        finally:
+            source.close()
+        
+        result = {
+            'pages_total': progress['pages_total'],
+            'pages_copied': progress['pages_total'] - progress['pages_remaining'],
+            'steps': progress['steps'],
+            'restarts': progress['restarts'],
+            'page_size': page_size,
+            'size_bytes': Path(backup_file).stat().st_size,
+            'duration_ms': round((time.monotonic() - started) * 1000, 2),
+        }
+        _LOGGER.info(f"Backup completato: {backup_file} ({result['pages_total']} pagine in {result['steps']} passi)")
+        return result
+    
+    @_reader
     def get_all_configurations(self) -> Dict[str, Any]:
         """Ottiene tutte le configurazioni attive calcolate con la logica di priorità.
         
@@ -2058,22 +3167,68 @@ class ConfigDatabase:
         Returns:
             Dict[setup_name -> {'value': str, 'source': str, 'priority': int, ...}]
         """
-        now = dt_util.now()
-        result = self._get_configurations_at_time(now)
+        return self._get_all_configurations_at(dt_util.now())
+    
+    @_reader
+    def get_refresh_data(
+        self,
+        limit_hours: int = 168,
+        max_results: int = 5,
+        needs_recalc: Optional[Callable[[str, Dict[str, Any]], bool]] = None
+    ) -> Dict[str, Any]:
+        """Dati completi per un refresh del coordinator in un'unica chiamata (un solo job nell'executor).
         
-        # Cache delle descrizioni per 60 secondi (raramente cambiano)
-        current_time = now.timestamp()
-        if (self._descriptions_cache is None or 
-            self._cache_timestamp is None or 
-            current_time - self._cache_timestamp > 60):
-            
-            cursor = self.conn.cursor()
-            cursor.execute("SELECT setup_name, description FROM configurazioni_descrizioni")
-            self._descriptions_cache = {row['setup_name']: row['description'] for row in cursor.fetchall()}
-            self._cache_timestamp = current_time
+        Risolve valori correnti e descrizioni di tutti i setup_name e, allo stesso
+        istante, i prossimi cambiamenti dei soli nomi da ricalcolare.
         
-        # Aggiungi le descrizioni al risultato dalla cache
-        for name in result:
-            result[name]['description'] = self._descriptions_cache.get(name)
+        Args:
+            limit_hours: Ore future considerate per i prossimi cambiamenti
+            max_results: Numero massimo di cambiamenti per nome
+            needs_recalc: Funzione (setup_name, configurazione corrente) -> bool che seleziona
+                          i nomi da ricalcolare (default: tutti)
         
-        return result
+        Returns:
+            Dict con 'configs' (come get_all_configurations), 'next_changes' ({setup_name: lista}
+            solo per i nomi ricalcolati), 'timing' (durate in millisecondi e nomi ricalcolati)
+            e 'max_dependency_depth' (vedi get_max_dependency_depth)
+        """
+        started = time.perf_counter()
+        now = dt_util.now()
+        configs = self._get_all_configurations_at(now)
+        configs_done = time.perf_counter()
+        
+        if needs_recalc is None:
+            recalc_names = list(configs)
+        else:
+            recalc_names = [name for name, config in configs.items() if needs_recalc(name, config)]
+        # Stesso istante dei valori correnti: il memo della risoluzione è già popolato
+        next_changes = {}
+        if recalc_names:
+            next_changes = self._get_next_changes_batch(now, configs, limit_hours, max_results, recalc_names)
+        finished = time.perf_counter()
+        
+        timing = {
+            'configs_ms': round((configs_done - started) * 1000, 2),
+            'next_changes_ms': round((finished - configs_done) * 1000, 2),
+            'total_ms': round((finished - started) * 1000, 2),
+            'recalculated': len(recalc_names),
+        }
+        _LOGGER.debug(f"[REFRESH] {len(configs)} configurazioni, {len(recalc_names)} ricalcolate in {timing['total_ms']} ms")
+        return {
+            'configs': configs,
+            'next_changes': next_changes,
+            'timing': timing,
+            'max_dependency_depth': self.get_max_dependency_depth(),
+        }
+    
+    def _get_all_configurations_at(self, now: datetime) -> Dict[str, Any]:
+        """Configurazioni vincenti a `now` con le descrizioni."""
+        configs = self._get_configurations_at_time(now)
+        
+        # Descrizioni dallo stesso snapshot delle regole (aggiornate ad ogni scrittura), su
+        # copie: i dict vincenti sono quelli del memo della risoluzione e non vanno modificati
+        descriptions = self._memory_cache['descrizioni']
+        return {
+            name: {**config, 'description': descriptions.get(name)}
+            for name, config in configs.items()
+        }
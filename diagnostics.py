@@ -0,0 +1,26 @@
+"""Diagnostica per Mia Config."""
+from typing import Any, Dict
+
+from homeassistant.config_entries import ConfigEntry
+from homeassistant.core import HomeAssistant
+
+from .const import DOMAIN
+
+
+async def async_get_config_entry_diagnostics(
+    hass: HomeAssistant, entry: ConfigEntry
+) -> Dict[str, Any]:
+    """Restituisce opzioni dell'entry e profilo effettivo della connessione SQLite."""
+    entry_data = hass.data[DOMAIN][entry.entry_id]
+    db = entry_data["db"]
+    
+    return {
+        "entry": {
+            "data": dict(entry.data),
+            "options": dict(entry.options),
+        },
+        "database": {
+            "path": db.db_path,
+            "sqlite": await hass.async_add_executor_job(db.get_connection_info),
+        },
+    }
@@ -0,0 +1,334 @@
+"""Regole compilate per Mia Config.
+
+Le righe della cache in-memory vengono convertite UNA SOLA VOLTA per
+config_version in record immutabili: date già convertite in datetime aware,
+orari espressi in minuti dalla mezzanotte e giorni della settimana come
+bitmask a 7 bit (bit 0 = lunedì). Il resolver lavora solo su questi record,
+senza ri-parsare stringhe o float ad ogni valutazione.
+
+Ogni regola espone anche ``boundaries(after)``: un generatore pigro e ordinato
+degli istanti successivi ad ``after`` in cui la sua attivazione può cambiare.
+"""
+import math
+from datetime import datetime, time, timedelta
+from typing import Any, Dict, Iterator, List, Optional
+
+from homeassistant.util import dt as dt_util
+
+# Bitmask con tutti i giorni della settimana abilitati (lun-dom)
+ALL_DAYS_MASK = 0x7F
+
+
+def hours_to_minutes(value: Any) -> Optional[int]:
+    """Converte un orario decimale (es. 18.5) in minuti dalla mezzanotte (1110).
+
+    Usa l'arrotondamento per eccesso: un orario decimale che non cade
+    esattamente su un minuto diventa attivo dal primo minuto intero successivo,
+    esattamente come il confronto ``ora + minuti / 60 >= valore`` del resolver.
+    Restituisce None se il valore non è convertibile.
+    """
+    if value is None:
+        return None
+    try:
+        # round() assorbe l'errore di rappresentazione (es. 7.333333 * 60 = 439.99998)
+        return int(math.ceil(round(float(value) * 60, 6)))
+    except (ValueError, TypeError):
+        return None
+
+
+def parse_days_mask(days: Any) -> Optional[int]:
+    """Converte days_of_week ('0,2,4' o [0, 2, 4]) in bitmask a 7 bit.
+
+    Restituisce None se days è None (nessun filtro sui giorni).
+    Una stringa vuota produce 0 (nessun giorno valido).
+    """
+    if days is None:
+        return None
+    if isinstance(days, (list, tuple, set)):
+        values = days
+    else:
+        values = [d for d in str(days).split(',') if d.strip()]
+    mask = 0
+    for day in values:
+        mask |= 1 << int(day)
+    return mask
+
+
+def to_local_datetime(value: Any) -> Optional[datetime]:
+    """Converte una stringa ISO naive (nel fuso locale) in datetime aware locale."""
+    if value is None:
+        return None
+    parsed = datetime.fromisoformat(str(value))
+    return parsed.replace(tzinfo=dt_util.DEFAULT_TIME_ZONE)
+
+
+def to_epoch(value: Any) -> Optional[int]:
+    """Converte una stringa ISO naive (nel fuso locale) in secondi epoch (None se assente)."""
+    local = to_local_datetime(value)
+    return None if local is None else int(local.timestamp())
+
+
+def mask_to_days(mask: Optional[int]) -> List[int]:
+    """Converte una bitmask a 7 bit nella lista ordinata dei giorni (None = tutti i giorni)."""
+    if mask is None:
+        mask = ALL_DAYS_MASK
+    return [day for day in range(7) if mask >> day & 1]
+
+
+def row_days_mask(row: Dict[str, Any]) -> Optional[int]:
+    """Bitmask dei giorni di una riga: colonna days_mask, o days_of_week se la riga non la ha."""
+    if 'days_mask' in row:
+        return row['days_mask']
+    return parse_days_mask(row['days_of_week'])
+
+
+def _in_window(from_minute: int, to_minute: int, minute: int) -> bool:
+    """Verifica una fascia oraria [from, to) che può attraversare la mezzanotte."""
+    # Caso speciale: se from == to significa 24 ore (sempre attivo)
+    if from_minute == to_minute:
+        return True
+    if to_minute < from_minute:  # Attraversa la mezzanotte
+        return minute >= from_minute or minute < to_minute
+    return from_minute <= minute < to_minute
+
+
+def _days_from(after: datetime) -> Iterator[datetime]:
+    """Mezzanotti locali a partire dal giorno di `after` (aritmetica sull'orario locale)."""
+    day = datetime.combine(after.date(), time(), tzinfo=after.tzinfo)
+    while True:
+        yield day
+        day += timedelta(days=1)
+
+
+def _daily_boundaries(after: datetime, minutes_for_day) -> Iterator[datetime]:
+    """Istanti > after ottenuti dai minuti restituiti per ogni giorno da minutes_for_day(giorno)."""
+    for day in _days_from(after):
+        for minute in minutes_for_day(day):
+            moment = day + timedelta(minutes=minute)
+            if moment > after:
+                yield moment
+
+
+class CompiledRule:
+    """Record immutabile di una regola, comune a tutti i tipi."""
+
+    __slots__ = ('id', 'setup_name', 'value', 'priority', 'enabled')
+
+    # Sovrascritti dalle sottoclassi: sorgente e ordine a parità di priorità
+    source = None
+    source_order = None
+
+    def __init__(self, row: Dict[str, Any]) -> None:
+        """Inizializza i campi comuni dalla riga della cache."""
+        object.__setattr__(self, 'id', row['id'])
+        object.__setattr__(self, 'setup_name', row['setup_name'])
+        object.__setattr__(self, 'value', row['setup_value'])
+        object.__setattr__(self, 'priority', row['priority'])
+        object.__setattr__(self, 'enabled', bool(row['enabled']))
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        raise AttributeError(f"{type(self).__name__} è immutabile")
+
+    def __delattr__(self, name: str) -> None:
+        raise AttributeError(f"{type(self).__name__} è immutabile")
+
+    def __repr__(self) -> str:
+        return f"<{type(self).__name__} id={self.id} {self.setup_name}={self.value!r} p={self.priority}>"
+    
+    def boundaries(self, after: datetime) -> Iterator[datetime]:
+        """Istanti (ordinati, > after) in cui l'attivazione della regola può cambiare."""
+        return iter(())
+
+
+class StandardRule(CompiledRule):
+    """Configurazione standard: sempre attiva se abilitata."""
+
+    __slots__ = ()
+
+    source = 'standard'
+    source_order = 3
+
+
+class ScheduleRule(CompiledRule):
+    """Configurazione a orario con fascia giornaliera e giorni della settimana."""
+
+    __slots__ = ('from_minute', 'to_minute', 'days_mask')
+
+    source = 'schedule'
+    source_order = 1
+
+    def __init__(self, row: Dict[str, Any]) -> None:
+        super().__init__(row)
+        days_mask = row_days_mask(row)
+        object.__setattr__(self, 'from_minute', hours_to_minutes(row['valid_from_ora']))
+        object.__setattr__(self, 'to_minute', hours_to_minutes(row['valid_to_ora']))
+        object.__setattr__(self, 'days_mask', ALL_DAYS_MASK if days_mask is None else days_mask)
+
+    @property
+    def is_valid(self) -> bool:
+        """False se gli orari non sono convertibili (la regola viene ignorata)."""
+        return self.from_minute is not None and self.to_minute is not None
+
+    def is_active(self, minute: int, weekday: int) -> bool:
+        """Verifica se la fascia è attiva al minuto/giorno indicati (logica v2.1)."""
+        if not self.is_valid:
+            return False
+        from_minute = self.from_minute
+        to_minute = self.to_minute
+        if from_minute == to_minute:
+            # All-day schedule (0.0-0.0): match only on specified days
+            return bool(self.days_mask >> weekday & 1)
+        if to_minute < from_minute:  # Attraversa la mezzanotte
+            # Dopo valid_from vale il giorno della fascia, prima di valid_to il giorno precedente
+            if minute >= from_minute:
+                return bool(self.days_mask >> weekday & 1)
+            if minute < to_minute:
+                return bool(self.days_mask >> ((weekday - 1) % 7) & 1)
+            return False
+        return from_minute <= minute < to_minute and bool(self.days_mask >> weekday & 1)
+    
+    def boundaries(self, after: datetime) -> Iterator[datetime]:
+        """Inizio e fine fascia di ogni giorno abilitato (la fine di una fascia che
+        attraversa la mezzanotte cade il giorno dopo), mezzanotti per le fasce 24h."""
+        if not self.is_valid or not self.days_mask:
+            return iter(())
+        from_minute = self.from_minute
+        to_minute = self.to_minute
+        days_mask = self.days_mask
+        
+        def minutes_for_day(day: datetime) -> list:
+            enabled = days_mask >> day.weekday() & 1
+            previous_enabled = days_mask >> ((day.weekday() - 1) % 7) & 1
+            if from_minute == to_minute:
+                return [0] if enabled != previous_enabled else []
+            minutes = []
+            if to_minute < from_minute:
+                if previous_enabled:
+                    minutes.append(to_minute)
+                if enabled:
+                    minutes.append(from_minute)
+            elif enabled:
+                minutes += [from_minute, to_minute]
+            return minutes
+        
+        return _daily_boundaries(after, minutes_for_day)
+
+
+class TimeRule(CompiledRule):
+    """Configurazione a tempo con periodo di validità e filtri opzionali."""
+
+    __slots__ = ('valid_from', 'valid_to', 'from_minute', 'to_minute', 'days_mask')
+
+    source = 'time'
+    source_order = 0
+
+    def __init__(self, row: Dict[str, Any]) -> None:
+        super().__init__(row)
+        from_minute = hours_to_minutes(row['valid_from_ora'])
+        to_minute = hours_to_minutes(row['valid_to_ora'])
+        # Il filtro orario si applica solo se entrambi gli estremi sono presenti
+        if from_minute is None or to_minute is None:
+            from_minute = to_minute = None
+        object.__setattr__(self, 'valid_from', to_local_datetime(row['valid_from_date']))
+        object.__setattr__(self, 'valid_to', to_local_datetime(row['valid_to_date']))
+        object.__setattr__(self, 'from_minute', from_minute)
+        object.__setattr__(self, 'to_minute', to_minute)
+        object.__setattr__(self, 'days_mask', row_days_mask(row))
+
+    @property
+    def has_hours(self) -> bool:
+        """True se la regola ha un filtro orario giornaliero."""
+        return self.from_minute is not None
+
+    def is_active(self, when: datetime, minute: int, weekday: int) -> bool:
+        """Verifica periodo di validità [valid_from, valid_to), fascia oraria e giorni."""
+        if when < self.valid_from:
+            return False
+        if self.valid_to is not None and when >= self.valid_to:
+            return False
+        if self.from_minute is not None and not _in_window(self.from_minute, self.to_minute, minute):
+            return False
+        if self.days_mask is not None and not self.days_mask >> weekday & 1:
+            return False
+        return True
+    
+    def boundaries(self, after: datetime) -> Iterator[datetime]:
+        """Estremi del periodo di validità più, al suo interno, gli estremi giornalieri
+        della fascia oraria e le mezzanotti se il filtro giorni è parziale."""
+        valid_from = self.valid_from
+        valid_to = self.valid_to
+        if valid_to is not None and valid_to <= after:
+            return
+        if valid_from > after:
+            yield valid_from
+        
+        daily = []
+        if self.from_minute is not None and self.from_minute != self.to_minute:
+            daily = sorted({self.from_minute, self.to_minute})
+        days_mask = self.days_mask
+        if days_mask == 0:
+            daily = []  # Mai attiva: restano solo gli estremi del periodo
+        elif days_mask is not None and days_mask != ALL_DAYS_MASK and 0 not in daily:
+            daily.insert(0, 0)
+        
+        if daily:
+            for moment in _daily_boundaries(max(after, valid_from), lambda day: daily):
+                if valid_to is not None and moment >= valid_to:
+                    break
+                yield moment
+        if valid_to is not None:
+            yield valid_to
+
+
+class ConditionalRule(CompiledRule):
+    """Configurazione condizionale, con fascia oraria opzionale."""
+
+    __slots__ = ('conditional_config', 'conditional_operator', 'conditional_value', 'from_minute', 'to_minute')
+
+    source = 'conditional'
+    source_order = 2
+
+    def __init__(self, row: Dict[str, Any]) -> None:
+        super().__init__(row)
+        from_minute = hours_to_minutes(row['valid_from_ora'])
+        to_minute = hours_to_minutes(row['valid_to_ora'])
+        if from_minute is None or to_minute is None:
+            from_minute = to_minute = None
+        object.__setattr__(self, 'conditional_config', row['conditional_config'])
+        object.__setattr__(self, 'conditional_operator', row['conditional_operator'])
+        object.__setattr__(self, 'conditional_value', row['conditional_value'])
+        object.__setattr__(self, 'from_minute', from_minute)
+        object.__setattr__(self, 'to_minute', to_minute)
+
+    @property
+    def has_hours(self) -> bool:
+        """True se la regola ha una fascia oraria."""
+        return self.from_minute is not None
+
+    def in_window(self, minute: int) -> bool:
+        """Verifica la fascia oraria opzionale (sempre vera se assente)."""
+        if self.from_minute is None:
+            return True
+        return _in_window(self.from_minute, self.to_minute, minute)
+    
+    def boundaries(self, after: datetime) -> Iterator[datetime]:
+        """Estremi giornalieri della fascia oraria; senza fascia i cambi dipendono
+        solo dalla configurazione da cui il condizionale dipende."""
+        if self.from_minute is None or self.from_minute == self.to_minute:
+            return iter(())
+        daily = sorted((self.from_minute, self.to_minute))
+        return _daily_boundaries(after, lambda day: daily)
+
+
+# Classe compilata per ogni tabella della cache in-memory
+RULE_CLASSES = {
+    'configurazioni': StandardRule,
+    'configurazioni_a_orario': ScheduleRule,
+    'configurazioni_a_tempo': TimeRule,
+    'configurazioni_condizionali': ConditionalRule,
+}
+
+
+def compile_rule(table: str, row: Dict[str, Any]) -> CompiledRule:
+    """Compila una riga della tabella indicata nel record immutabile corrispondente."""
+    return RULE_CLASSES[table](row)
@@ -6,7 +6,9 @@ from typing import Any, Optional
 
 from homeassistant.components.sensor import SensorEntity
 from homeassistant.config_entries import ConfigEntry
-from homeassistant.core import HomeAssistant
+from homeassistant.core import HomeAssistant, callback
+from homeassistant.helpers.debounce import Debouncer
+from homeassistant.helpers.event import async_track_point_in_time
 from homeassistant.helpers.entity_platform import AddEntitiesCallback
 from homeassistant.helpers.typing import ConfigType, DiscoveryInfoType
 
@@ -18,7 +20,7 @@ from homeassistant.helpers.update_coordinator import (
 )
 from homeassistant.helpers import entity_registry as er
 
-from .const import DOMAIN
+from .const import CHANGE_DEBOUNCE_SECONDS, DOMAIN
 from .database import ConfigDatabase
 from homeassistant.util import dt as dt_util
 
@@ -44,142 +46,105 @@ async def async_setup_entry(
     predictive_cache = {}
     last_configs = {}
     last_recalc_time = {}  # Traccia ultimo ricalcolo per ogni setup
-    last_config_version = None  # Traccia versione configurazioni per invalidare cache
+    boundary_timer = {}  # Timer del prossimo cambio previsto: {'unsub', 'at'}
+    changed_names = set()  # setup_name notificati come modificati dal database dall'ultimo refresh
     
     async def async_update_data():
         """Aggiorna i dati dal database."""
-        nonlocal last_config_version
-        configs = await hass.async_add_executor_job(db.get_all_configurations)
         # Usa timestamp epoch reale, non il clock monotono dell'event loop
         current_time = time.time()
         
-        # Controlla se le configurazioni sono cambiate (nuova versione)
-        current_config_version = db._config_version
-        config_changed = last_config_version != current_config_version
-        if config_changed:
-            _LOGGER.debug(f"Configurazione cambiata (versione {current_config_version}), invalido cache predittive")
-            predictive_cache.clear()  # Invalida tutta la cache predittiva
-            last_config_version = current_config_version
+        # Istantanee dello stato del coordinator: la scelta dei nomi da ricalcolare
+        # avviene nello stesso job dell'executor che risolve i valori
+        cache_snapshot = dict(predictive_cache)
+        last_values = {name: config.get('value') for name, config in last_configs.items()}
+        recalc_snapshot = dict(last_recalc_time)
+        changed_snapshot = set(changed_names)
+        changed_names.clear()
+        config_versions = {}
         
-        # Calcola i dati predittivi SOLO se necessario
-        predictive_data = {}
-        for setup_name in configs.keys():
-            current_value = configs[setup_name].get('value')
-            last_value = last_configs.get(setup_name, {}).get('value')
+        def needs_recalc(setup_name: str, config: dict) -> bool:
+            """Decide se ricalcolare i dati predittivi di un setup (eseguita nell'executor)."""
+            current_value = config.get('value')
+            last_value = last_values.get(setup_name)
             
-            # Recupera dalla cache se esiste
-            cached = predictive_cache.get(setup_name)
-            needs_recalc = False
-            recalc_reason = None
+            # Versione delle configurazioni che influenzano questo setup (sue o delle dipendenze):
+            # una scrittura su altri nomi non invalida i suoi dati predittivi
+            config_version = db.get_config_version(setup_name)
+            config_versions[setup_name] = config_version
             
+            cached = cache_snapshot.get(setup_name)
+            recalc_reason = None
             if cached is None:
                 # Prima volta, calcola
-                needs_recalc = True
                 recalc_reason = "prima volta"
-            elif config_changed:
-                # Configurazioni cambiate, ricalcola
-                needs_recalc = True
-                recalc_reason = "configurazioni cambiate"
+            elif setup_name in changed_snapshot:
+                # Modifica notificata dal database (sul nome o su una sua dipendenza)
+                recalc_reason = "modifica notificata"
+            elif cached.get('config_version') != config_version:
+                # Configurazioni del setup (o delle sue dipendenze) cambiate, ricalcola
+                recalc_reason = f"configurazioni cambiate (versione {config_version})"
             elif current_value != last_value:
                 # Valore cambiato, ricalcola
-                needs_recalc = True
                 recalc_reason = f"valore cambiato da {last_value} a {current_value}"
-            else:
+            elif current_time - recalc_snapshot.get(setup_name, 0) > 3600:  # 1 ora
                 # Nessun evento nei prossimi lookahead_hours: ricalcola ogni ora per vedere se ne compaiono
-                last_calc = last_recalc_time.get(setup_name, 0)
-                if current_time - last_calc > 3600:  # 1 ora
-                    needs_recalc = True
-                    recalc_reason = "ricalcolo periodico (nessun evento visibile)"
+                recalc_reason = "ricalcolo periodico (nessun evento visibile)"
             
-            if needs_recalc:
-                if recalc_reason:
-                    _LOGGER.debug(f"{setup_name}: {recalc_reason}, ricalcolo predittivi")
-                try:
-                    next_changes = await hass.async_add_executor_job(
-                        db.get_next_changes, setup_name, next_change_lookahead_hours
-                    )
-                    predictive_data[setup_name] = {
-                        'next_changes': next_changes,
-                        'last_recalc': current_time
-                    }
-                    predictive_cache[setup_name] = {
-                        'next_changes': next_changes,
-                        'last_update': configs[setup_name].get('value'),  # Traccia il valore a cui corrisponde
-                        'last_recalc': current_time
-                    }
-                    last_recalc_time[setup_name] = current_time  # Aggiorna timestamp ricalcolo
-                except Exception as e:
-                    _LOGGER.error(f"Errore calcolo dati predittivi per {setup_name}: {e}")
-                    predictive_data[setup_name] = {
-                        'next_changes': [],
-                        'last_recalc': current_time
-                    }
-            else:
+            if recalc_reason:
+                _LOGGER.debug(f"{setup_name}: {recalc_reason}, ricalcolo predittivi")
+                return True
+            return False
+        
+        # Un solo job nell'executor: valori, descrizioni e predittivi dei nomi da ricalcolare
+        try:
+            refresh = await hass.async_add_executor_job(
+                db.get_refresh_data, next_change_lookahead_hours, 5, needs_recalc
+            )
+        except Exception as e:
+            raise UpdateFailed(f"Errore aggiornamento dati dal database: {e}") from e
+        
+        configs = refresh['configs']
+        all_changes = refresh['next_changes']
+        timing = refresh['timing']
+        _LOGGER.debug(
+            f"[COORDINATOR] Refresh in {timing['total_ms']} ms "
+            f"(valori {timing['configs_ms']} ms, predittivi {timing['next_changes_ms']} ms, "
+            f"{timing['recalculated']}/{len(configs)} ricalcolati)"
+        )
+        
+        predictive_data = {}
+        for setup_name in configs.keys():
+            if setup_name in all_changes:
+                next_changes = all_changes[setup_name]
+                predictive_data[setup_name] = {
+                    'next_changes': next_changes,
+                    'last_recalc': current_time
+                }
+                predictive_cache[setup_name] = {
+                    'next_changes': next_changes,
+                    'last_update': configs[setup_name].get('value'),  # Traccia il valore a cui corrisponde
+                    'config_version': config_versions[setup_name],
+                    'last_recalc': current_time
+                }
+                last_recalc_time[setup_name] = current_time  # Aggiorna timestamp ricalcolo
+            elif setup_name in predictive_cache:
                 # Mantieni i dati predittivi già calcolati, così non spariscono a ogni refresh
-                if cached:
-                    predictive_data[setup_name] = {
-                        'next_changes': cached.get('next_changes', []),
-                        'last_recalc': cached.get('last_recalc')
-                    }
+                cached = predictive_cache[setup_name]
+                predictive_data[setup_name] = {
+                    'next_changes': cached.get('next_changes', []),
+                    'last_recalc': cached.get('last_recalc')
+                }
         
         # Salva stato corrente per il prossimo ciclo
         last_configs.clear()
         last_configs.update(configs)
         
-        # Calcola scheduling dinamico basato su next_change_at più vicino
-        next_update_seconds = None
-        earliest_change = None
-        
-        for setup_name, pred_data in predictive_data.items():
-            next_changes = pred_data.get('next_changes', [])
-            if next_changes and len(next_changes) > 0:
-                # Prendi il primo cambio (il più vicino)
-                seconds_until = next_changes[0].get('seconds_until', None)
-                if seconds_until is None:
-                    minutes_until = next_changes[0].get('minutes_until', None)
-                    if minutes_until is not None:
-                        seconds_until = minutes_until * 60
-
-                if seconds_until is not None and seconds_until > 0:
-                    if earliest_change is None or seconds_until < earliest_change:
-                        earliest_change = seconds_until
-        
-        if earliest_change is not None:
-            # Applica limiti: min 5s, max 24h
-            MIN_INTERVAL = 5
-            MAX_INTERVAL = 86400  # 24 ore
-            
-            if earliest_change < MIN_INTERVAL:
-                next_update_seconds = MIN_INTERVAL
-                _LOGGER.debug(f"Next change in {earliest_change}s, scheduling update in {MIN_INTERVAL}s (minimum)")
-            elif earliest_change > MAX_INTERVAL:
-                next_update_seconds = MAX_INTERVAL
-                _LOGGER.debug(f"Next change in {earliest_change}s, scheduling update in {MAX_INTERVAL}s (maximum)")
-            else:
-                # CRITICO: Schedula DOPO l'evento (+ 2s buffer) per garantire che sia attivo
-                # Se scheduliamo PRIMA, potremmo leggere ancora il valore vecchio
-                next_update_seconds = max(MIN_INTERVAL, earliest_change + 2)
-                _LOGGER.info(f"[REFRESH TIMING] Next change in {earliest_change}s, scheduling update AFTER event at {next_update_seconds}s")
-        else:
-            # Nessun cambio previsto: usa intervallo lungo di default (1 ora)
-            next_update_seconds = 3600
-            _LOGGER.debug(f"No changes predicted, using fallback interval: {next_update_seconds}s")
-        
-        # Aggiorna dinamicamente l'intervallo del coordinator
-        if next_update_seconds and next_update_seconds != coordinator.update_interval.total_seconds():
-            coordinator.update_interval = timedelta(seconds=next_update_seconds)
-            _LOGGER.info(f"[COORDINATOR] Update interval dynamically adjusted to {next_update_seconds}s")
-        
-        # Log stato per debugging (ogni 10 minuti o se interval < 60s)
-        log_state = (next_update_seconds and next_update_seconds < 60) or (int(time.time()) % 600 == 0)
-        if log_state:
-            _LOGGER.info(f"[COORDINATOR] State: {len(configs)} configs, next_update={next_update_seconds}s, earliest_change={earliest_change}s")
-        if log_state:
-            _LOGGER.info(f"[COORDINATOR] State: {len(configs)} configs, next_update={next_update_seconds}s, earliest_change={earliest_change}s")
-        
         return {
             'configs': configs,
-            'predictive': predictive_data
+            'predictive': predictive_data,
+            'timing': timing,
+            'max_dependency_depth': refresh['max_dependency_depth']
         }
     
     coordinator = DataUpdateCoordinator(
@@ -187,7 +152,9 @@ async def async_setup_entry(
         _LOGGER,
         name="mia_config",
         update_method=async_update_data,
-        update_interval=timedelta(seconds=3600),  # Verrà aggiornato dinamicamente
+        # I cambi previsti sono gestiti dai timer puntuali: il refresh periodico serve solo
+        # a scoprire eventi oltre il lookahead e a riallinearsi in caso di errori
+        update_interval=timedelta(seconds=3600),
     )
     
     # Esegui il primo aggiornamento
@@ -232,11 +199,154 @@ async def async_setup_entry(
                 await sensor.async_remove(force_remove=True)
                 _LOGGER.debug(f"Removed sensor: {setup_name}")
     
+    def first_change_at(pred_data: dict) -> Optional[datetime]:
+        """Istante del primo cambio previsto per un setup (None se assente o non valido)."""
+        for change in pred_data.get('next_changes', []):
+            when = dt_util.parse_datetime(change.get('timestamp') or '')
+            if when is not None:
+                return when
+        return None
+    
+    def compute_boundary(previous_configs: dict, due_names: list) -> dict:
+        """Ricalcola i valori al confine e i prossimi cambi dei soli setup coinvolti (executor)."""
+        due = set(due_names)
+        config_versions = {}
+        
+        def needs_recalc(setup_name: str, config: dict) -> bool:
+            # Versione letta nello snapshot fissato da get_refresh_data, lo stesso dei
+            # predittivi: una scrittura successiva non deve marcare come aggiornati dati vecchi
+            config_versions[setup_name] = db.get_config_version(setup_name)
+            return setup_name in due or config != previous_configs.get(setup_name)
+        
+        refresh = db.get_refresh_data(next_change_lookahead_hours, 5, needs_recalc)
+        refresh['config_versions'] = config_versions
+        return refresh
+    
+    async def handle_boundary(now: datetime) -> None:
+        """Al confine esatto aggiorna solo le entità il cui valore cambia e ripianifica."""
+        boundary_timer.pop('unsub', None)
+        data = coordinator.data or {}
+        previous_configs = dict(data.get('configs', {}))
+        predictive_data = data.get('predictive', {})
+        due_names = []
+        for setup_name, pred_data in predictive_data.items():
+            when = first_change_at(pred_data)
+            if when is not None and when <= now:
+                due_names.append(setup_name)
+        try:
+            refresh = await hass.async_add_executor_job(
+                compute_boundary, previous_configs, due_names
+            )
+        except Exception as e:
+            _LOGGER.error(f"Errore aggiornamento al cambio previsto delle {now.isoformat()}: {e}")
+            await coordinator.async_request_refresh()
+            return
+        
+        if coordinator.data is not data:
+            # Un refresh completo è arrivato durante il calcolo: i suoi dati sono più recenti
+            # di quelli appena calcolati, che vanno scartati invece di sovrascriverli
+            _LOGGER.debug(f"[BOUNDARY] {now.isoformat()}: superato da un refresh completo")
+            schedule_next_boundary()
+            return
+        
+        configs = refresh['configs']
+        if configs.keys() != previous_configs.keys():
+            # Setup aggiunti o rimossi: serve il refresh completo per creare/rimuovere le entità
+            await coordinator.async_request_refresh()
+            return
+        
+        all_changes = refresh['next_changes']
+        config_versions = refresh['config_versions']
+        flipped = {name for name in configs if configs[name] != previous_configs.get(name)}
+        current_time = time.time()
+        data['configs'] = configs
+        data['timing'] = refresh['timing']
+        for setup_name, next_changes in all_changes.items():
+            predictive_data[setup_name] = {
+                'next_changes': next_changes,
+                'last_recalc': current_time
+            }
+            predictive_cache[setup_name] = {
+                'next_changes': next_changes,
+                'last_update': configs[setup_name].get('value'),
+                'config_version': config_versions[setup_name],
+                'last_recalc': current_time
+            }
+            last_recalc_time[setup_name] = current_time
+        last_configs.clear()
+        last_configs.update(configs)
+        
+        updated = 0
+        for setup_name in flipped | set(due_names):
+            sensor = existing_sensors.get(setup_name)
+            if sensor is not None and sensor.hass is not None:
+                sensor.async_write_ha_state()
+                updated += 1
+        _LOGGER.debug(f"[BOUNDARY] {now.isoformat()}: {len(flipped)} valori cambiati, {updated} entità aggiornate")
+        schedule_next_boundary()
+    
+    @callback
+    def schedule_next_boundary() -> None:
+        """Registra un timer all'istante esatto del prossimo cambio previsto fra tutti i setup."""
+        earliest = None
+        for pred_data in (coordinator.data or {}).get('predictive', {}).values():
+            when = first_change_at(pred_data)
+            if when is not None and (earliest is None or when < earliest):
+                earliest = when
+        
+        if earliest == boundary_timer.get('at') and 'unsub' in boundary_timer:
+            return
+        unsub = boundary_timer.pop('unsub', None)
+        if unsub is not None:
+            unsub()
+        boundary_timer['at'] = earliest
+        if earliest is None:
+            _LOGGER.debug("[BOUNDARY] Nessun cambio previsto, resta il refresh periodico")
+            return
+        boundary_timer['unsub'] = async_track_point_in_time(hass, handle_boundary, earliest)
+        _LOGGER.debug(f"[BOUNDARY] Prossimo cambio previsto alle {earliest.isoformat()}")
+    
+    @callback
+    def cancel_boundary_timer() -> None:
+        """Annulla il timer pendente allo scaricamento dell'integrazione."""
+        unsub = boundary_timer.pop('unsub', None)
+        if unsub is not None:
+            unsub()
+    
+    entry.async_on_unload(cancel_boundary_timer)
+    
+    # Raffiche di scritture (es. import o più servizi in sequenza) producono un solo refresh
+    refresh_debouncer = Debouncer(
+        hass, _LOGGER, cooldown=CHANGE_DEBOUNCE_SECONDS, immediate=False,
+        function=coordinator.async_refresh,
+    )
+    
+    @callback
+    def handle_db_change(event: dict) -> None:
+        """Accumula i setup_name modificati e pianifica il refresh (nell'event loop)."""
+        if event['affected'] is None:
+            # Ricaricamento completo (es. ripristino): ricalcola tutti i predittivi
+            predictive_cache.clear()
+            last_recalc_time.clear()
+        else:
+            changed_names.update(event['affected'])
+        _LOGGER.debug(f"Modifica notificata dal database (versione {event['config_version']}): {event['affected']}")
+        hass.async_create_task(refresh_debouncer.async_call())
+    
+    # Il database notifica dal proprio thread di scrittura: rimanda all'event loop
+    entry.async_on_unload(db.subscribe(
+        lambda event: hass.loop.call_soon_threadsafe(handle_db_change, event)
+    ))
+    entry.async_on_unload(refresh_debouncer.async_cancel)
+    
     # Initial sensor creation for configs
     await async_update_sensors()
+    schedule_next_boundary()
     
     # Add listener to coordinator to update sensors on data change
     coordinator.async_add_listener(lambda: hass.async_create_task(async_update_sensors()))
+    # Dopo ogni refresh ripianifica il timer sul nuovo cambio più vicino
+    coordinator.async_add_listener(schedule_next_boundary)
     
     # Salva il coordinator per aggiornamenti futuri
     entry_data = hass.data[DOMAIN].setdefault(entry.entry_id, {})
@@ -288,6 +398,8 @@ class MiaConfigMainSensor(CoordinatorEntity, SensorEntity):
             "entry_id": self._entry.entry_id,
             "total_configs": len(configs),
             "config_names": list(configs.keys()),
+            "last_refresh_ms": self.coordinator.data.get('timing', {}).get('total_ms'),
+            "max_dependency_depth": self.coordinator.data.get('max_dependency_depth'),
         }
     
     @property
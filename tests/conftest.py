@@ -0,0 +1,57 @@
+"""Fixture comuni dei test di Mia Config.
+
+Il repository contiene direttamente i file dell'integrazione (content_in_root):
+il pacchetto ``mia_config`` viene registrato puntando alla radice senza eseguire
+``__init__.py``, che richiede un'istanza di Home Assistant in esecuzione. I test
+coprono lo strato database, che dipende solo da ``homeassistant.util.dt``.
+"""
+import sys
+import types
+from datetime import datetime
+from pathlib import Path
+from zoneinfo import ZoneInfo
+
+import pytest
+from homeassistant.util import dt as dt_util
+
+ROOT = Path(__file__).resolve().parent.parent
+
+if 'mia_config' not in sys.modules:
+    package = types.ModuleType('mia_config')
+    package.__path__ = [str(ROOT)]
+    sys.modules['mia_config'] = package
+
+# Fuso con cambio ora legale (29/03 e 25/10 nel 2026): i casi DST dei test dipendono da questo
+TIME_ZONE = ZoneInfo('Europe/Rome')
+
+
+@pytest.fixture(autouse=True)
+def local_time_zone(monkeypatch):
+    """Imposta il fuso locale di Home Assistant per tutti i test."""
+    monkeypatch.setattr(dt_util, 'DEFAULT_TIME_ZONE', TIME_ZONE)
+
+
+@pytest.fixture
+def frozen_now(monkeypatch):
+    """Congela dt_util.now(): restituisce la funzione che imposta l'istante corrente."""
+    current = {'now': datetime(2026, 3, 25, 12, 0, tzinfo=TIME_ZONE)}
+
+    def _now(time_zone=None):
+        return current['now'].astimezone(time_zone or TIME_ZONE)
+
+    def set_now(value: datetime) -> None:
+        current['now'] = value
+
+    monkeypatch.setattr(dt_util, 'now', _now)
+    return set_now
+
+
+@pytest.fixture
+def db(tmp_path):
+    """Database inizializzato su un file temporaneo, chiuso a fine test."""
+    from mia_config.database import ConfigDatabase
+
+    database = ConfigDatabase(str(tmp_path / 'mia_config.db'))
+    database.initialize()
+    yield database
+    database.close()
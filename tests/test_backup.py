@@ -0,0 +1,93 @@
+"""Backup online con l'API di backup di SQLite e ripristino, per entrambi i profili."""
+import sqlite3
+import threading
+from pathlib import Path
+
+import pytest
+
+from mia_config.const import SQLITE_PROFILE_LEGACY, SQLITE_PROFILE_WAL
+from mia_config.database import ConfigDatabase
+
+
+@pytest.fixture(params=[SQLITE_PROFILE_WAL, SQLITE_PROFILE_LEGACY])
+def profile_db(request, tmp_path):
+    """Database inizializzato con il profilo dei pragma del parametro."""
+    database = ConfigDatabase(str(tmp_path / 'mia_config.db'), sqlite_profile=request.param)
+    database.initialize()
+    database.run_write(database.apply_batch, [
+        {'type': 'standard', 'setup_name': f"n{i}", 'setup_value': 'x' * 200, 'priority': 99}
+        for i in range(2000)
+    ])
+    yield database
+    database.close()
+
+
+def inspect_backup(backup_file: str) -> dict:
+    """Legge integrità, journal e numero di regole del file di backup."""
+    conn = sqlite3.connect(backup_file)
+    try:
+        return {
+            'integrity': conn.execute("PRAGMA integrity_check").fetchone()[0],
+            'journal_mode': conn.execute("PRAGMA journal_mode").fetchone()[0],
+            'rules': conn.execute("SELECT COUNT(*) FROM configurazioni").fetchone()[0],
+        }
+    finally:
+        conn.close()
+
+
+def test_backup_is_complete_standalone_file(profile_db, tmp_path):
+    """Il backup copia tutte le pagine in un file autonomo, senza temporanei residui."""
+    backup_file = str(tmp_path / 'backup.db')
+
+    result = profile_db.backup_to_file(backup_file)
+
+    assert result['pages_copied'] == result['pages_total'] > 0
+    assert result['steps'] >= 1
+    assert result['size_bytes'] == Path(backup_file).stat().st_size
+    assert inspect_backup(backup_file) == {'integrity': 'ok', 'journal_mode': 'delete', 'rules': 2000}
+    assert not Path(f"{backup_file}.part").exists()
+    assert not Path(f"{backup_file}-wal").exists()
+
+
+def test_backup_during_concurrent_writes_is_consistent(profile_db, tmp_path):
+    """Con scritture continue il backup termina e contiene uno stato confermato."""
+    backup_file = str(tmp_path / 'backup.db')
+    stop = threading.Event()
+    written = []
+
+    def write_loop() -> None:
+        while not stop.is_set():
+            profile_db.set_config(f"live{len(written)}", 'v', 1)
+            written.append(True)
+
+    writer = threading.Thread(target=write_loop)
+    writer.start()
+    try:
+        result = profile_db.backup_to_file(backup_file)
+    finally:
+        stop.set()
+        writer.join()
+
+    assert result['pages_copied'] == result['pages_total']
+    backup = inspect_backup(backup_file)
+    assert backup['integrity'] == 'ok'
+    assert 2000 <= backup['rules'] <= 2000 + len(written)
+    if profile_db.sqlite_profile == SQLITE_PROFILE_WAL:
+        # Lo snapshot di lettura resta fissato: le scritture non fanno ripartire la copia
+        assert result['restarts'] == 0
+
+
+def test_restore_round_trip(profile_db, tmp_path):
+    """Il ripristino riporta le regole del backup e salva prima lo stato corrente."""
+    backup_file = str(tmp_path / 'backup.db')
+    pre_restore_file = str(tmp_path / 'pre_restore.db')
+    profile_db.backup_to_file(backup_file)
+    profile_db.set_config('dopo_il_backup', 'v', 1)
+
+    profile_db.restore_from_file(backup_file, pre_restore_file)
+
+    assert 'dopo_il_backup' not in profile_db.get_all_setup_names()
+    assert len(profile_db.get_all_setup_names()) == 2000
+    assert inspect_backup(pre_restore_file) == {'integrity': 'ok', 'journal_mode': 'delete', 'rules': 2001}
+    journal_mode = profile_db.get_connection_info()['journal_mode']
+    assert (journal_mode == 'wal') == (profile_db.sqlite_profile == SQLITE_PROFILE_WAL)
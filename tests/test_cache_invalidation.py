@@ -0,0 +1,136 @@
+"""Invalidazione mirata delle cache contro il ricaricamento completo.
+
+Le scritture singole aggiornano la cache in-memory col delta delle righe toccate e
+invalidano solo i setup_name coinvolti (e i loro dipendenti): lo stato risultante
+deve coincidere con quello di un database appena aperto sullo stesso file.
+"""
+from datetime import datetime
+
+import pytest
+
+from conftest import TIME_ZONE
+from mia_config.database import ConfigDatabase
+
+NOW = datetime(2026, 4, 15, 23, 0, tzinfo=TIME_ZONE)
+
+
+def build_rules(db) -> None:
+    """Tre setup_name, di cui 'pompa' dipende da 'caldaia' tramite un condizionale."""
+    db.set_config('caldaia', 'off', 99)
+    db.set_schedule_config('caldaia', 'on', 6.0, 22.0, '0,1,2,3,4', 50)
+    db.set_config('luce', 'spenta', 99)
+    db.set_time_config('luce', 'accesa', '2026-04-10T00:00:00', '2026-04-20T00:00:00', 20, 20.0, 23.5)
+    db.set_config('pompa', 'ferma', 99)
+    db.set_conditional_config('pompa', 'attiva', 'caldaia', '==', 'on', 10)
+
+
+def resolved_state(db) -> tuple:
+    """Stato osservabile dai lettori: regole, valori risolti e prossimi cambiamenti."""
+    return (
+        db.get_all_configurations_detailed(),
+        db.get_all_configurations(),
+        db.get_next_changes_all(48, 5),
+    )
+
+
+def test_targeted_write_invalidates_only_affected_names(db, frozen_now):
+    """Una scrittura notifica il nome toccato e i suoi dipendenti, le altre versioni non cambiano."""
+    frozen_now(NOW)
+    build_rules(db)
+    events = []
+    db.subscribe(events.append)
+    versions = {name: db.get_config_version(name) for name in ('caldaia', 'luce', 'pompa')}
+
+    db.set_config('caldaia', 'manuale', 30)
+
+    assert len(events) == 1
+    assert events[0]['setup_names'] == ['caldaia']
+    assert events[0]['affected'] == ['caldaia', 'pompa']
+    assert db.get_config_version('luce') == versions['luce']
+    assert db.get_config_version('caldaia') > versions['caldaia']
+    assert db.get_config_version('pompa') > versions['pompa']
+
+
+def test_targeted_invalidation_matches_full_reload(db, frozen_now):
+    """Dopo scritture di ogni tipo la cache aggiornata col delta coincide con un ricaricamento."""
+    frozen_now(NOW)
+    build_rules(db)
+    # Popola le cache derivate prima delle modifiche
+    resolved_state(db)
+
+    db.set_config('caldaia', 'manuale', 30)
+    standard_id = db.get_all_configurations_detailed()['luce'][0]['id']
+    db.update_standard_config(standard_id, 'soffusa', 98)
+    schedule_id = next(
+        config['id'] for config in db.get_all_configurations_detailed()['caldaia'] if config['type'] == 'schedule'
+    )
+    db.set_config_enabled('schedule', schedule_id, False)
+    db.run_write(db.apply_batch, [
+        {'type': 'standard', 'setup_name': 'nuovo', 'setup_value': 'x', 'priority': 99},
+        {'type': 'schedule', 'setup_name': 'nuovo', 'setup_value': 'y', 'priority': 10,
+         'valid_from_ora': 22.0, 'valid_to_ora': 6.0, 'days_of_week': [0, 1, 2, 3, 4, 5, 6]},
+        {'type': 'conditional', 'setup_name': 'pompa', 'setup_value': 'notte', 'priority': 5,
+         'conditional_config': 'nuovo', 'conditional_operator': '==', 'conditional_value': 'y'},
+    ])
+    db.delete_config('luce', 'time')
+    targeted = resolved_state(db)
+
+    reloaded_db = ConfigDatabase(db.db_path)
+    reloaded_db.initialize()
+    try:
+        assert resolved_state(reloaded_db) == targeted
+    finally:
+        reloaded_db.close()
+
+    db.run_write(db._invalidate_caches)
+    assert resolved_state(db) == targeted
+
+
+def test_full_reload_notifies_all_names(db, frozen_now, tmp_path):
+    """Il ripristino da backup ricarica tutto e lo notifica senza elenco di nomi."""
+    frozen_now(NOW)
+    build_rules(db)
+    backup_file = str(tmp_path / 'backup.db')
+    db.backup_to_file(backup_file)
+    db.set_config('luce', 'accesa', 1)
+    events = []
+    db.subscribe(events.append)
+
+    db.restore_from_file(backup_file, str(tmp_path / 'pre_restore.db'))
+
+    assert [(event['setup_names'], event['affected']) for event in events] == [(None, None)]
+    assert db.get_all_configurations()['luce']['value'] == 'accesa'
+    assert db.get_all_configurations()['luce']['source'] == 'time'
+    assert db.get_config_version('caldaia') == db.get_config_version('luce')
+
+
+def test_rejected_write_after_unpublished_commit_is_silent(db):
+    """Un commit senza pubblicazione (valori ammessi, storico) non rende rumorosa una scrittura rifiutata."""
+    db.set_config('caldaia', 'off', 5)
+    events = []
+    db.subscribe(events.append)
+    version = db.get_config_version('caldaia')
+
+    db.add_valid_value('caldaia', 'off', 'Spenta')
+    db.trim_history()
+    with pytest.raises(ValueError):
+        db.set_config('caldaia', 'on', 5)
+
+    assert events == []
+    assert db.get_config_version('caldaia') == version
+
+
+def test_resolved_configs_do_not_share_the_resolution_memo(db, frozen_now):
+    """Le configurazioni restituite (con descrizione) sono copie di quelle nel memo dell'istante."""
+    frozen_now(NOW)
+    build_rules(db)
+    db.set_config('tenda', 'chiusa', 99, 'Tenda del soggiorno')
+
+    configs = db.get_all_configurations()
+
+    assert configs['tenda']['description'] == 'Tenda del soggiorno'
+    # Il memo della risoluzione è per thread: i lettori lavorano nel thread chiamante
+    memo = db._local.memo
+    for name, config in configs.items():
+        assert memo[name] is not config
+        assert 'description' not in memo[name]
@@ -0,0 +1,126 @@
+"""Paginazione keyset e conteggi dello storico mantenuti dai trigger."""
+import sqlite3
+
+import pytest
+
+from mia_config.const import HISTORY_TRIM_THRESHOLD
+from mia_config.database import ConfigDatabase
+
+
+def write_history(db, names=('a', 'b', 'c'), rounds: int = 20) -> None:
+    """Genera voci di storico per più setup_name (inserimenti ed eliminazioni)."""
+    for i in range(rounds):
+        for name in names:
+            db.set_config(name, str(i), 10 + i)
+        if i % 5 == 4:
+            db.delete_config(names[0], 'standard')
+
+
+def stored_count(db_path: str, setup_name: str = None) -> int:
+    """Conta le voci direttamente nella tabella dello storico."""
+    conn = sqlite3.connect(db_path)
+    try:
+        if setup_name:
+            query = "SELECT COUNT(*) FROM configurazioni_storico WHERE setup_name = ?"
+            return conn.execute(query, (setup_name,)).fetchone()[0]
+        return conn.execute("SELECT COUNT(*) FROM configurazioni_storico").fetchone()[0]
+    finally:
+        conn.close()
+
+
+def keyset_pages(db, setup_name, limit: int) -> list:
+    """Percorre lo storico a pagine col cursore (timestamp, id) dell'ultima voce letta."""
+    entries = []
+    cursor = (None, None)
+    while True:
+        page = db.get_history(setup_name, limit, 0, *cursor)
+        entries.extend(page)
+        if len(page) < limit:
+            return entries
+        cursor = (page[-1]['timestamp'], page[-1]['id'])
+
+
+def test_keyset_pagination_matches_offset_pagination(db):
+    """Le pagine keyset coprono lo storico come le pagine con offset, in ordine e senza duplicati."""
+    write_history(db)
+    for setup_name in (None, 'b'):
+        full = db.get_history(setup_name, 10000, 0)
+        assert full == sorted(full, key=lambda entry: (entry['timestamp'], entry['id']), reverse=True)
+        assert keyset_pages(db, setup_name, 7) == full
+        offset_pages = []
+        for offset in range(0, len(full), 7):
+            offset_pages.extend(db.get_history(setup_name, 7, offset))
+        assert offset_pages == full
+
+
+def test_keyset_offset_is_relative_to_cursor(db):
+    """Con il cursore l'offset salta voci a partire dal cursore stesso."""
+    write_history(db)
+    full = db.get_history(None, 10000, 0)
+    anchor = full[9]
+    assert db.get_history(None, 5, 3, anchor['timestamp'], anchor['id']) == full[13:18]
+
+
+def test_history_count_follows_inserts_deletes_and_trim(db):
+    """I conteggi mantenuti dai trigger coincidono con COUNT(*) dopo ogni tipo di modifica."""
+    write_history(db)
+    for setup_name in (None, 'a', 'b', 'c', 'sconosciuto'):
+        assert db.get_history_count(setup_name) == stored_count(db.db_path, setup_name)
+
+    deleted = db.trim_history(365, 8, 2)
+
+    assert deleted > 0
+    assert db.get_history_count('b') == stored_count(db.db_path, 'b') == 8
+    assert db.get_history_count() == stored_count(db.db_path)
+
+
+def test_history_counts_migrated_from_previous_schema(tmp_path):
+    """Un database senza la tabella dei conteggi viene migrato con i conteggi dello storico esistente."""
+    db_path = str(tmp_path / 'mia_config.db')
+    db = ConfigDatabase(db_path)
+    db.initialize()
+    write_history(db)
+    db.close()
+    # Schema della versione precedente: niente tabella dei conteggi né trigger
+    conn = sqlite3.connect(db_path)
+    conn.execute("DROP TRIGGER trg_storico_conteggi_insert")
+    conn.execute("DROP TRIGGER trg_storico_conteggi_delete")
+    conn.execute("DROP TABLE configurazioni_storico_conteggi")
+    conn.commit()
+    conn.close()
+
+    db = ConfigDatabase(db_path)
+    db.initialize()
+    try:
+        for setup_name in (None, 'a', 'b'):
+            assert db.get_history_count(setup_name) == stored_count(db_path, setup_name)
+        db.set_config('d', 'nuovo', 1)
+        assert db.get_history_count('d') == 1
+        assert db.get_history_count() == stored_count(db_path)
+    finally:
+        db.close()
+
+
+def test_trim_in_rolled_back_batch_keeps_trim_due(db):
+    """Una retention annullata con la sessione batch() non azzera il contatore degli inserimenti."""
+    db.run_write(db.apply_batch, [
+        {'type': 'standard', 'setup_name': f"n{i}", 'setup_value': 'x', 'priority': 99}
+        for i in range(HISTORY_TRIM_THRESHOLD)
+    ])
+    assert db.history_trim_due
+
+    def trim_and_fail() -> None:
+        with db.batch():
+            db.trim_history()
+            raise RuntimeError("annullata")
+
+    with pytest.raises(RuntimeError):
+        db.run_write(trim_and_fail)
+    assert db.history_trim_due
+
+    def trim_in_batch() -> None:
+        with db.batch():
+            db.trim_history()
+
+    db.run_write(trim_in_batch)
+    assert not db.history_trim_due
@@ -0,0 +1,245 @@
+"""Equivalenza del resolver unificato con gli output registrati del resolver originale.
+
+``fixtures/resolver_baseline.json`` contiene, per ogni scenario costruito qui sotto,
+gli output del resolver originale (versione 2.3.5, prima dell'unificazione in un
+unico passaggio):
+
+- ``full``: ``get_all_configurations()`` (risoluzione completa) su una griglia di istanti;
+- ``next_changes``: ``get_next_changes()`` (risoluzione mirata) per ogni setup_name;
+- ``simulate``: ``simulate_configuration_schedule()`` su finestre con il cambio d'ora.
+
+Le griglie attraversano i cambi d'ora del 29/03 e del 25/10 (ora inesistente e ora
+ripetuta) e lo scenario ``mezzanotte_dst`` contiene fasce orarie a cavallo della
+mezzanotte. Le sole differenze ammesse sono in ``intended_changes``: il resolver
+originale applicava anche la logica pre-2.1 delle fasce a cavallo della mezzanotte
+(estremo finale incluso, nessun controllo sul giorno precedente), rimossa di proposito.
+"""
+import copy
+import json
+import random
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, List
+
+import pytest
+
+from conftest import TIME_ZONE
+
+BASELINE_FILE = Path(__file__).parent / 'fixtures' / 'resolver_baseline.json'
+
+# Prossimi cambi registrati ogni N istanti della griglia (24 ore di orizzonte, 3 risultati)
+NEXT_CHANGES_EVERY = 3
+NEXT_CHANGES_HOURS = 24
+NEXT_CHANGES_MAX = 3
+
+
+def build_midnight_dst_scenario(db) -> None:
+    """Fasce a cavallo della mezzanotte, cambi d'ora, condizionali e una regola disabilitata."""
+    db.set_config('riscaldamento', 'off', 99)
+    db.set_schedule_config('riscaldamento', 'comfort', 6.5, 22.0, '0,1,2,3,4', 50)
+    db.set_schedule_config('riscaldamento', 'notte', 22.0, 6.5, '0,1,2,3,4', 40)
+    db.set_time_config('riscaldamento', 'vacanza', '2026-03-28T00:00:00', '2026-03-30T12:00:00', 10)
+    # Fascia 01:30-03:00 nel giorno con l'ora ripetuta
+    db.set_time_config('riscaldamento', 'boost', '2026-10-24T00:00:00', '2026-10-26T00:00:00', 5, 1.5, 3.0)
+
+    db.set_config('luce', 'spenta', 99)
+    db.set_schedule_config('luce', 'accesa', 23.5, 0.5, '5,6', 20)
+    # Fascia 02:00-03:00, inesistente il 29/03
+    db.set_schedule_config('luce', 'notturna', 2.0, 3.0, '0,1,2,3,4,5,6', 30)
+    db.set_time_config('luce', 'weekend', '2026-10-23T18:00:00', '2026-10-25T02:30:00', 15, None, None, '5,6')
+
+    db.set_config('modalita', 'normale', 99)
+    db.set_conditional_config('modalita', 'risparmio', 'riscaldamento', '==', 'notte', 10)
+    db.set_conditional_config('modalita', 'festa', 'luce', '==', 'accesa', 5, 20.0, 2.0)
+
+    db.set_config('allarme', 'off', 99)
+    # from == to: tutto il giorno, solo la domenica
+    db.set_schedule_config('allarme', 'on', 0.0, 0.0, '6', 10)
+    db.set_time_config('allarme', 'manutenzione', '2026-03-27T00:00:00', '2026-10-27T00:00:00', 1)
+    db.set_config_enabled('time', 4, False)
+
+
+def build_random_scenario(db, seed: int) -> None:
+    """Regole casuali (riproducibili) senza fasce a cavallo della mezzanotte."""
+    rnd = random.Random(seed)
+    names = [f"n{i}" for i in range(8)]
+    values = ['a', 'b', 'c', '1', '2', '3']
+    base = datetime(2026, 3, 25, 0, 0)
+    for i, name in enumerate(names):
+        for priority in rnd.sample(range(1, 99), rnd.randint(0, 2)):
+            db.set_config(name, rnd.choice(values), priority)
+        for _ in range(rnd.randint(0, 3)):
+            from_hour, to_hour = sorted((rnd.randint(0, 95) / 4, rnd.randint(0, 95) / 4))
+            days = ','.join(str(d) for d in sorted(rnd.sample(range(7), rnd.randint(1, 7))))
+            db.set_schedule_config(name, rnd.choice(values), from_hour, to_hour, days, rnd.randint(1, 98))
+        for _ in range(rnd.randint(0, 2)):
+            start = base + timedelta(minutes=15 * rnd.randint(-400, 1200))
+            end = start + timedelta(minutes=15 * rnd.randint(1, 800))
+            from_hour = to_hour = days = None
+            if rnd.random() < 0.5:
+                from_hour, to_hour = rnd.randint(0, 95) / 4, rnd.randint(0, 95) / 4
+            if rnd.random() < 0.4:
+                days = ','.join(str(d) for d in sorted(rnd.sample(range(7), rnd.randint(1, 7))))
+            db.set_time_config(
+                name, rnd.choice(values), start.isoformat(), end.isoformat(), rnd.randint(1, 98),
+                from_hour, to_hour, days
+            )
+        if i > 0:
+            for _ in range(rnd.randint(0, 3)):
+                operator = rnd.choice(['==', '!=', '>', '<', '>=', '<=', 'contains', 'not_contains'])
+                from_hour = to_hour = None
+                if rnd.random() < 0.4:
+                    from_hour, to_hour = sorted((rnd.randint(0, 95) / 4, rnd.randint(0, 95) / 4))
+                db.set_conditional_config(
+                    name, rnd.choice(values), rnd.choice(names[:i]), operator, rnd.choice(values),
+                    rnd.randint(1, 98), from_hour, to_hour
+                )
+
+
+def local_grid(start: datetime, end: datetime, step_minutes: int) -> Iterator[datetime]:
+    """Istanti locali a passo costante in tempo reale (UTC): l'ora ripetuta compare due volte."""
+    moment = start.replace(tzinfo=TIME_ZONE).astimezone(timezone.utc)
+    end_utc = end.replace(tzinfo=TIME_ZONE).astimezone(timezone.utc)
+    while moment < end_utc:
+        yield moment.astimezone(TIME_ZONE)
+        moment += timedelta(minutes=step_minutes)
+
+
+SPRING = (datetime(2026, 3, 27), datetime(2026, 3, 31))
+AUTUMN = (datetime(2026, 10, 23), datetime(2026, 10, 27))
+
+SCENARIOS: Dict[str, Dict[str, Any]] = {
+    'mezzanotte_dst': {
+        'build': build_midnight_dst_scenario,
+        'grids': [(*SPRING, 30), (*AUTUMN, 30)],
+        'simulate': [
+            ('riscaldamento', datetime(2026, 3, 28), 3),
+            ('modalita', datetime(2026, 3, 28), 3),
+            ('luce', datetime(2026, 10, 24), 2),
+            ('modalita', datetime(2026, 10, 24), 2),
+        ],
+    },
+    'casuale_0': {
+        'build': lambda db: build_random_scenario(db, 0),
+        'grids': [(datetime(2026, 3, 25), datetime(2026, 4, 4), 97)],
+        'simulate': [('n3', datetime(2026, 3, 28), 2), ('n7', datetime(2026, 3, 28), 2)],
+    },
+    'casuale_1': {
+        'build': lambda db: build_random_scenario(db, 1),
+        'grids': [(datetime(2026, 3, 25), datetime(2026, 4, 4), 97)],
+        'simulate': [('n5', datetime(2026, 3, 28), 2), ('n6', datetime(2026, 3, 28), 2)],
+    },
+}
+
+
+def record_scenario(db, name: str, set_now: Callable[[datetime], None]) -> Dict[str, Any]:
+    """Costruisce lo scenario su db e ne registra gli output in forma compatta (serializzabile in JSON)."""
+    scenario = SCENARIOS[name]
+    scenario['build'](db)
+    setup_names = db.get_all_setup_names()
+    outputs = {'full': {}, 'next_changes': {}, 'simulate': {}}
+    index = 0
+    for start, end, step in scenario['grids']:
+        for moment in local_grid(start, end, step):
+            set_now(moment)
+            key = moment.isoformat()
+            outputs['full'][key] = {
+                setup_name: [config['value'], config['source'], config['priority'], config['id']]
+                for setup_name, config in sorted(db.get_all_configurations().items())
+            }
+            if index % NEXT_CHANGES_EVERY == 0:
+                outputs['next_changes'][key] = {
+                    setup_name: [
+                        [change['timestamp'], change['value'], change['type'], change['id']]
+                        for change in db.get_next_changes(setup_name, NEXT_CHANGES_HOURS, NEXT_CHANGES_MAX)
+                    ]
+                    for setup_name in setup_names
+                }
+            index += 1
+    for setup_name, start, days in scenario['simulate']:
+        start = start.replace(tzinfo=TIME_ZONE)
+        set_now(start)
+        outputs['simulate'][f"{setup_name}@{start.date().isoformat()}+{days}"] = [
+            [segment['date'], segment['start_minute'], segment['end_minute'], segment['value'],
+             segment['type'], segment['priority'], segment['id']]
+            for segment in db.simulate_configuration_schedule(setup_name, start, days)
+        ]
+    return outputs
+
+
+def expected_outputs(recorded: Dict[str, Any], name: str) -> Dict[str, Any]:
+    """Output di riferimento: baseline registrata con le differenze intenzionali applicate."""
+    expected = copy.deepcopy(recorded['baseline'][name])
+    for kind, changes in recorded['intended_changes'].get(name, {}).items():
+        for key, change in changes.items():
+            if kind == 'simulate':
+                expected[kind][key] = change['current']
+                continue
+            for setup_name, entry in change.items():
+                expected[kind][key][setup_name] = entry['current']
+    return expected
+
+
+@pytest.fixture(scope='module')
+def recorded() -> Dict[str, Any]:
+    with BASELINE_FILE.open(encoding='utf-8') as handle:
+        return json.load(handle)
+
+
+@pytest.mark.parametrize('name', sorted(SCENARIOS))
+def test_resolver_matches_recorded_baseline(name, recorded, db, frozen_now):
+    """Risoluzione completa, mirata e simulazione coincidono con la baseline registrata."""
+    def set_now(moment: datetime) -> None:
+        frozen_now(moment)
+        # La cache di get_next_changes resta valida finché il valore non cambia, anche se
+        # l'orizzonte si sposta: qui si confronta il calcolo, non l'euristica della cache
+        db._next_changes_cache.clear()
+
+    actual = record_scenario(db, name, set_now)
+    expected = expected_outputs(recorded, name)
+
+    mismatches: List[str] = []
+    for kind in ('full', 'next_changes', 'simulate'):
+        assert actual[kind].keys() == expected[kind].keys(), kind
+        for key, value in expected[kind].items():
+            if actual[kind][key] != value:
+                mismatches.append(f"{kind} {key}: {actual[kind][key]!r} != {value!r}")
+    assert not mismatches, '\n'.join(mismatches[:10])
+
+
+def test_intended_changes_only_touch_midnight_crossing_rules(recorded):
+    """Le differenze ammesse riguardano solo setup con fasce a cavallo della mezzanotte (o che ne dipendono)."""
+    allowed = {'riscaldamento', 'luce', 'modalita'}
+    assert set(recorded['intended_changes']) <= {'mezzanotte_dst'}
+    for kind, changes in recorded['intended_changes'].get('mezzanotte_dst', {}).items():
+        for key, change in changes.items():
+            touched = {key.split('@')[0]} if kind == 'simulate' else set(change)
+            assert touched <= allowed, (kind, key)
+
+
+def _at(day: int, hour: int, minute: int = 0) -> datetime:
+    """Istante locale in una settimana di riferimento senza cambi d'ora (lunedì 13/04/2026 = day 0)."""
+    return datetime(2026, 4, 13 + day, hour, minute, tzinfo=TIME_ZONE)
+
+
+def test_midnight_crossing_schedule_continues_from_previous_day(db, frozen_now):
+    """Dopo la mezzanotte vale il giorno in cui la fascia è iniziata, non quello corrente."""
+    db.set_config('riscaldamento', 'off', 99)
+    db.set_schedule_config('riscaldamento', 'notte', 22.0, 6.5, '0,1,2,3,4', 40)
+
+    frozen_now(_at(5, 1))  # sabato 01:00: fascia iniziata venerdì
+    assert db.get_all_configurations()['riscaldamento']['value'] == 'notte'
+    # lunedì 01:00: la domenica non è tra i giorni (la logica pre-2.1 la considerava attiva)
+    frozen_now(_at(0, 1))
+    assert db.get_all_configurations()['riscaldamento']['value'] == 'off'
+
+
+def test_midnight_crossing_schedule_end_is_exclusive(db, frozen_now):
+    """L'estremo finale di una fascia a cavallo della mezzanotte è escluso, come per le altre fasce."""
+    db.set_config('riscaldamento', 'off', 99)
+    db.set_schedule_config('riscaldamento', 'notte', 22.0, 6.5, '0,1,2,3,4', 40)
+
+    frozen_now(_at(1, 6, 29))
+    assert db.get_all_configurations()['riscaldamento']['value'] == 'notte'
+    frozen_now(_at(1, 6, 30))
+    assert db.get_all_configurations()['riscaldamento']['value'] == 'off'
@@ -0,0 +1,128 @@
+"""Timeline a tratti costanti per Mia Config.
+
+Una Timeline descrive il valore vincente di un setup_name su un orizzonte
+temporale come sequenza ordinata di punti di cambiamento: lo stato
+``states[i]`` vale nell'intervallo ``[times[i], times[i + 1])``. Le query
+puntuali sono ricerche binarie e il "prossimo cambiamento" è semplicemente
+l'elemento successivo.
+
+La timeline è pigra: gli eventi candidati arrivano da un iteratore ordinato
+e vengono risolti solo quando una query chiede un istante oltre la parte
+già materializzata (``end``), mai oltre ``horizon``.
+"""
+from bisect import bisect_right
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+# Stato vincente in un intervallo: {'value', 'source', 'priority', 'id'} o None se non risolto
+State = Optional[Dict[str, Any]]
+
+
+class Timeline:
+    """Sequenza ordinata di cambi di stato di un setup_name su [start, horizon]."""
+
+    __slots__ = ('setup_name', 'start', 'end', 'horizon', 'times', 'states', '_events', '_pending', '_resolve')
+
+    def __init__(
+        self,
+        setup_name: str,
+        start: datetime,
+        horizon: datetime,
+        events: Iterator[datetime],
+        resolve: Callable[[datetime], State],
+    ) -> None:
+        """Inizializza la timeline risolvendo solo lo stato a `start`.
+
+        Args:
+            events: Iteratore ordinato degli istanti (> start) in cui lo stato può cambiare
+            resolve: Funzione che restituisce lo stato vincente ad un istante
+        """
+        self.setup_name = setup_name
+        self.start = start
+        self.end = start  # Istante fino a cui la timeline è materializzata
+        self.horizon = horizon
+        self.times: List[datetime] = [start]
+        self.states: List[State] = [resolve(start)]
+        self._events = events
+        self._pending: Optional[datetime] = None
+        self._resolve = resolve
+
+    def _next_event(self) -> Optional[datetime]:
+        """Prossimo evento candidato (> end) senza consumarlo, o None se esauriti."""
+        if self._pending is None:
+            for event_time in self._events:
+                if event_time > self.end:
+                    self._pending = event_time
+                    break
+            else:
+                self._events = iter(())
+        return self._pending
+
+    def _extend(self, until: datetime) -> None:
+        """Materializza la timeline fino a `until` (limitato all'orizzonte)."""
+        until = min(until, self.horizon)
+        while self.end < until:
+            event_time = self._next_event()
+            if event_time is None or event_time > until:
+                self.end = until
+                return
+            self._pending = None
+            self.end = event_time
+            state = self._resolve(event_time)
+            # Registra solo i cambi effettivi: eventi consecutivi con lo stesso stato collassano
+            if state != self.states[-1]:
+                self.times.append(event_time)
+                self.states.append(state)
+
+    def extend_horizon(self, horizon: datetime) -> None:
+        """Sposta in avanti l'orizzonte: i nuovi giorni verranno risolti solo quando richiesti."""
+        if horizon > self.horizon:
+            self.horizon = horizon
+
+    def trim(self, before: datetime) -> None:
+        """Scarta il prefisso già trascorso, mantenendo lo stato in vigore a `before`."""
+        if before <= self.start:
+            return
+        self._extend(before)
+        index = bisect_right(self.times, before) - 1
+        del self.times[:index]
+        del self.states[:index]
+        self.times[0] = before
+        self.start = before
+
+    def covers(self, start: datetime, end: datetime) -> bool:
+        """True se la timeline può rispondere sull'intervallo [start, end]."""
+        return self.start <= start and end <= self.horizon
+
+    def state_at(self, when: datetime) -> State:
+        """Stato vincente all'istante indicato (O(log n) sulla parte materializzata).
+
+        Restituisce None anche se l'istante è fuori dall'orizzonte coperto.
+        """
+        if when < self.start or when > self.horizon:
+            return None
+        self._extend(when)
+        # Bisect direttamente sui datetime: con lo stesso tzinfo il confronto è sull'orario
+        # locale, come nel resolver (rilevante solo nelle ore del cambio ora legale)
+        return self.states[bisect_right(self.times, when) - 1]
+
+    def changes_between(self, after: datetime, until: datetime) -> Iterator[Tuple[datetime, State]]:
+        """Cambi di stato nell'intervallo (after, until], in ordine cronologico.
+
+        Estende la timeline solo man mano che i cambi vengono consumati: chi si
+        ferma dopo N risultati non risolve gli eventi successivi.
+        """
+        until = min(until, self.horizon)
+        self._extend(after)
+        index = bisect_right(self.times, after)
+        while True:
+            while index >= len(self.times) and self.end < until:
+                event_time = self._next_event()
+                self._extend(until if event_time is None else min(event_time, until))
+            if index >= len(self.times) or self.times[index] > until:
+                return
+            yield self.times[index], self.states[index]
+            index += 1
+
+    def __len__(self) -> int:
+        return len(self.times)
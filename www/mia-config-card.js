@@ -1294,7 +1294,7 @@ class MiaConfigCard extends HTMLElement {
                 });
                 
                 if (result.response?.success) {
-                    statusDiv.innerHTML = `<p style="color: var(--success-color);">✅ ${result.response.message}</p><p style="color: var(--secondary-text-color); font-size: 12px;">File: ${result.response.backup_file}</p>`;
+                    statusDiv.innerHTML = `<p style="color: var(--success-color);">✅ ${result.response.message}</p><p style="color: var(--secondary-text-color); font-size: 12px;">File: ${result.response.backup_file}${result.response.pages_total !== undefined ? ` (${result.response.pages_copied}/${result.response.pages_total} pagine)` : ''}</p>`;
                     window.dcRefreshBackupList();
                     setTimeout(() => { statusDiv.innerHTML = ''; }, 5000);
                 } else {